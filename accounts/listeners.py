@@ -1,3 +1,17 @@
 def profile_changed(sender, instance, **kwargs):
     from .services import UserService
-    UserService.invalidate_profile(instance.user_id)
\ No newline at end of file
+    UserService.invalidate_profile(instance.user_id)
+    UserService.invalidate_user_card(instance.user_id)
+
+
+def user_changed(sender, instance, **kwargs):
+    from .services import UserService
+    UserService.invalidate_user_card(instance.id)
+
+
+def create_user_profile(sender, instance, created, **kwargs):
+    # 注册的时候就创建好 profile，读的时候不再需要 get_or_create
+    if not created:
+        return
+    from .models import UserProfile
+    UserProfile.objects.get_or_create(user_id=instance.id)
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.db import migrations
+
+
+def create_missing_user_profiles(apps, schema_editor):
+    # 以前 profile 是第一次读的时候才创建的，现在改成创建 user 的时候创建，老的 user 在这里补上
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    UserProfile = apps.get_model('accounts', 'UserProfile')
+    user_ids = User.objects.filter(userprofile__isnull=True).values_list('id', flat=True)
+    UserProfile.objects.bulk_create(
+        [UserProfile(user_id=user_id) for user_id in user_ids],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_missing_user_profiles, migrations.RunPython.noop),
+    ]
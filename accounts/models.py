@@ -1,8 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import User
-from .listeners import profile_changed
+from .listeners import create_user_profile, profile_changed, user_changed
 from django.db.models.signals import post_save, pre_delete
 from utils.listeners import invalidate_object_cache
+from utils.redis_serializers import CompactModelSerializer
 
 class UserProfile(models.Model):
 
@@ -25,9 +26,27 @@ def get_profile(user):
 
 User.profile = property(get_profile)
 
+# 缓存里 user 的格式，字段变化时注册一个新的 version
+CompactModelSerializer.register(User, version=1, fields=(
+    'id',
+    'password',
+    'last_login',
+    'is_superuser',
+    'username',
+    'first_name',
+    'last_name',
+    'email',
+    'is_staff',
+    'is_active',
+    'date_joined',
+))
+
 # hook up with listeners to invalidate cache
 pre_delete.connect(invalidate_object_cache, sender=User)
 post_save.connect(invalidate_object_cache, sender=User)
+pre_delete.connect(user_changed, sender=User)
+post_save.connect(user_changed, sender=User)
+post_save.connect(create_user_profile, sender=User)
 
 pre_delete.connect(profile_changed, sender=UserProfile)
 post_save.connect(profile_changed, sender=UserProfile)
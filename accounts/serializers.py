@@ -14,19 +14,13 @@ class UserSerializer(serializers.ModelSerializer):
 
         fields = ('id', 'username', 'email')
 
-class UserSerializerWithProfile(UserSerializer):
+class UserSerializerWithProfile(serializers.Serializer):
+    # 序列化的是 UserService.get_user_cards 返回的 user card，不再需要读取 User 和 UserProfile
 
-    nickname = serializers.CharField(source='profile.nickname')
-    avatar_url = serializers.SerializerMethodField()
-
-    def get_avatar_url(self, obj):
-        if obj.profile.avatar:
-            return obj.profile.avatar.url
-        return None
-
-    class Meta:
-        model = User
-        fields = ('id', 'username', 'nickname', 'avatar_url')
+    id = serializers.IntegerField()
+    username = serializers.CharField()
+    nickname = serializers.CharField(allow_null=True)
+    avatar_url = serializers.CharField(allow_null=True)
 
 
 class UserSerializerForTweet(UserSerializerWithProfile):
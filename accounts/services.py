@@ -1,25 +1,109 @@
 from .models import UserProfile
 from django.conf import settings
-from django.core.cache import caches
-from core.cache import USER_PROFILE_PATTERN
-
-cache = caches['testing'] if settings.TESTING else caches['default']
+from django.contrib.auth.models import User
+from core.cache import USER_CARD_PATTERN, USER_LAST_ACTIVE_KEY, USER_PROFILE_PATTERN
+from utils.memcached_helper import MemcachedHelper, NOT_FOUND
+from utils.redis_client import RedisClient
+import time
 
 class UserService:
 
     @classmethod
     def get_profile_through_cache(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        profile = cache.get(key)
-        if profile is not None:
-            return profile
-        
-        profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
-        cache.set(key, profile)
 
-        return profile
+        def load(missing_keys):
+            # profile 在创建 user 的时候就已经创建好了，这里只读不写
+            profile = UserProfile.objects.filter(user_id=user_id).first()
+            return {key: profile if profile is not None else NOT_FOUND}
+
+        profile = MemcachedHelper.get_many_through_cache(
+            [key],
+            load,
+            soft_timeout=settings.USER_PROFILE_SOFT_TIMEOUT,
+        )[key]
+        return profile if profile != NOT_FOUND else None
 
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        cache.delete(key)
\ No newline at end of file
+        MemcachedHelper.invalidate(key)
+
+    @classmethod
+    def to_user_card(cls, user_id, username, nickname, avatar):
+        avatar_url = None
+        if avatar:
+            avatar_url = UserProfile._meta.get_field('avatar').storage.url(avatar)
+        return {
+            'id': user_id,
+            'username': username,
+            'nickname': nickname,
+            'avatar_url': avatar_url,
+        }
+
+    @classmethod
+    def get_user_cards(cls, user_ids):
+        """
+        user card 是 tweets, comments, likes, friendships 里展示一个 user 需要的全部数据
+        user 和 profile 合在一起存成一个 dict，一次 get_many 取出来，没有命中的用一次 join 查询补齐
+        返回 {user_id: card}，不存在的 user 不会出现在结果里
+        """
+        keys = {
+            USER_CARD_PATTERN.format(user_id=user_id): user_id
+            for user_id in user_ids
+            if user_id is not None
+        }
+
+        def load(missing_keys):
+            rows = User.objects.filter(
+                id__in=[keys[key] for key in missing_keys],
+            ).values_list('id', 'username', 'userprofile__nickname', 'userprofile__avatar')
+            cards = {key: NOT_FOUND for key in missing_keys}
+            for user_id, username, nickname, avatar in rows:
+                key = USER_CARD_PATTERN.format(user_id=user_id)
+                cards[key] = cls.to_user_card(user_id, username, nickname, avatar)
+            return cards
+
+        return {
+            keys[key]: card
+            for key, card in MemcachedHelper.get_many_through_cache(list(keys), load).items()
+            if card != NOT_FOUND
+        }
+
+    @classmethod
+    def get_user_card(cls, user_id):
+        return cls.get_user_cards([user_id]).get(user_id)
+
+    @classmethod
+    def invalidate_user_card(cls, user_id):
+        key = USER_CARD_PATTERN.format(user_id=user_id)
+        MemcachedHelper.invalidate(key)
+
+    @classmethod
+    def touch_last_active(cls, user_id):
+        """
+        记录用户最后一次活跃的时间，返回之前记录的时间戳，没有记录过返回 None
+        """
+        pipe = RedisClient.get_connection('counters').pipeline(transaction=False)
+        pipe.zscore(USER_LAST_ACTIVE_KEY, user_id)
+        pipe.zadd(USER_LAST_ACTIVE_KEY, {user_id: time.time()})
+        last_active_at, _ = pipe.execute()
+        return last_active_at
+
+    @classmethod
+    def is_active_at(cls, last_active_at):
+        if last_active_at is None:
+            return False
+        return last_active_at >= time.time() - settings.NEWSFEED_ACTIVE_USER_WINDOW
+
+    @classmethod
+    def get_active_user_ids(cls, user_ids):
+        # 一次 pipeline 读出一批用户的最后活跃时间
+        pipe = RedisClient.get_connection('counters').pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zscore(USER_LAST_ACTIVE_KEY, user_id)
+        return {
+            user_id
+            for user_id, last_active_at in zip(user_ids, pipe.execute())
+            if cls.is_active_at(last_active_at)
+        }
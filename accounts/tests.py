@@ -1,6 +1,7 @@
 from testing.testcases import TestCase
 from rest_framework.test import APIClient
 from .models import UserProfile
+from .services import UserService
 from rest_framework import status
 from django.core.files.uploadedfile import SimpleUploadedFile
 
@@ -146,12 +147,36 @@ class UserProfileTests(TestCase):
         self.alex_client.force_authenticate(self.alex)
 
     def test_profile_property(self):
-        # alex = self. create_user('alex')
-        self.assertEqual(UserProfile.objects.count(), 0)
+        # 创建 user 的时候就会创建 profile
+        self.assertEqual(UserProfile.objects.count(), 1)
         p = self.alex.profile
         self.assertEqual(isinstance(p, UserProfile), True)
         self.assertEqual(UserProfile.objects.count(), 1)
 
+    def test_user_card(self):
+        p = self.alex.profile
+        p.nickname = 'alex nickname'
+        p.save()
+        card = UserService.get_user_card(self.alex.id)
+        self.assertEqual(card, {
+            'id': self.alex.id,
+            'username': 'alex',
+            'nickname': 'alex nickname',
+            'avatar_url': None,
+        })
+        # 一次 get_many 取出来，不存在的 user 不会出现在结果里
+        with self.assertNumQueries(0):
+            self.assertEqual(UserService.get_user_cards([self.alex.id]), {self.alex.id: card})
+
+        # 修改 user 或者 profile 都会让 user card 失效
+        self.alex.username = 'alex2'
+        self.alex.save()
+        self.assertEqual(UserService.get_user_card(self.alex.id)['username'], 'alex2')
+        p.nickname = 'new nickname'
+        p.save()
+        self.assertEqual(UserService.get_user_card(self.alex.id)['nickname'], 'new nickname')
+        self.assertEqual(UserService.get_user_cards([-1]), {})
+
     def test_user_update_profile_nickname(self):
         """
             /api/profile/{}/
@@ -167,8 +192,9 @@ class UserProfileTests(TestCase):
         self.assertEqual(p.nickname, 'new nickname')
 
     def test_user_update_profile_avatar(self):
+        # profile 是从数据库里读出来的，没有头像的时候 avatar 是空的 FieldFile
         p = self.alex.profile
-        self.assertEqual(p.avatar, None)
+        self.assertFalse(p.avatar)
 
         url = USER_PROFILE_DETAIL_URL.format(p.id)
         res = self.alex_client.put(url, {
@@ -93,8 +93,6 @@ class AccountViewSet(viewsets.ViewSet):
             }, status=400)
         user = serializer.save()
 
-        user.profile
-
         django_login(request, user)
         return Response({
                 "success": True,
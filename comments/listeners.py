@@ -1,4 +1,5 @@
 from utils.listeners import invalidate_object_cache
+from django.conf import settings
 from utils.redis_helper import RedisHelper
 
 def incr_comments_count(sender, instance, created, **kwargs):
@@ -12,7 +13,8 @@ def incr_comments_count(sender, instance, created, **kwargs):
     # if model_class != Tweet:
     #     return
     # tweet = instance.content_object
-    Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count')+1)
+    if not settings.COUNTERS_WRITE_BEHIND:
+        Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count')+1)
     RedisHelper.incr_count(instance.tweet, 'comments_count')
 
 def decr_comments_count(sender, instance, **kwargs):
@@ -24,5 +26,6 @@ def decr_comments_count(sender, instance, **kwargs):
     # if model_class != Tweet:
     #     return
     # tweet = instance.content_object
-    Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count')-1)
+    if not settings.COUNTERS_WRITE_BEHIND:
+        Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count')-1)
     RedisHelper.decr_count(instance.tweet, 'comments_count')
\ No newline at end of file
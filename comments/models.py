@@ -6,6 +6,7 @@ from tweets.models import Tweet
 from likes.models import Like
 
 from utils.memcached_helper import MemcachedHelper
+from accounts.services import UserService
 
 from django.db.models.signals import pre_delete, post_save
 from .listeners import incr_comments_count, decr_comments_count
@@ -36,9 +37,19 @@ class Comment(models.Model):
 
 
     @property
-    def cache_user(self):
+    def cached_user(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
+    @property
+    def cached_user_card(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_user_card'):
+            return self._cached_user_card
+        return UserService.get_user_card(self.user_id)
+
 
 pre_delete.connect(decr_comments_count, Comment)
 post_save.connect(incr_comments_count, Comment)
\ No newline at end of file
@@ -1,24 +1,40 @@
 from rest_framework import serializers
 from .models import Comment
 from accounts.serializers import UserSerializerForComment
+from accounts.services import UserService
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
 from likes.services import LikeService
+from functools import partial
+from utils.data_loader import BatchLoadListSerializer, BatchLoadSerializerMixin
 
 
 
-class CommentSerializer(serializers.ModelSerializer):
-    user = UserSerializerForComment()
+class CommentSerializer(BatchLoadSerializerMixin, serializers.ModelSerializer):
+    user = UserSerializerForComment(source='cached_user_card')
     has_liked = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
 
+    def get_batch_loads(self):
+        return [
+            ('user_cards', '_cached_user_card', 'user_id', UserService.get_user_cards),
+            ('comment_has_liked', '_cached_has_liked', 'id', partial(
+                LikeService.get_has_liked_map, self.context['request'].user, Comment,
+            )),
+            ('comment_likes_count', '_cached_likes_count', 'id', partial(
+                LikeService.get_likes_count_map, Comment,
+            )),
+        ]
+
     def get_has_liked(self, obj):
-        return LikeService.has_liked(self.context['request'].user, obj)
+        return obj._cached_has_liked
 
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        return obj._cached_likes_count
+
     class Meta:
         model = Comment
+        list_serializer_class = BatchLoadListSerializer
         fields = ('id', 'tweet_id', 'user', 'content', 'created_at', 'has_liked', 'likes_count')
 
 
@@ -34,7 +50,7 @@ class CommentSerializerForCreate(serializers.ModelSerializer):
 
     def validate(self, data):
         tweet_id = data['tweet_id']
-        if not Tweet.objects.filter(id=tweet_id).exists():
+        if not Tweet.objects.filter(id=tweet_id, has_deleted=False).exists():
             raise ValidationError({'message': 'tweet does not exist'})
 
         return data
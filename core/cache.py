@@ -1,4 +1,30 @@
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
-USER_PROFILE_PATTERN = 'userprofile:{user_id}'
-USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
\ No newline at end of file
+# cache 里数据的格式变化时加一，新版本上线后会使用新的 key，不需要清空整个 cache
+CACHE_SCHEMA_VERSION = 1
+CACHE_KEY_PREFIX = 'v{}:'.format(CACHE_SCHEMA_VERSION)
+
+FOLLOWINGS_PATTERN = CACHE_KEY_PREFIX + 'followings:{user_id}'
+USER_PROFILE_PATTERN = CACHE_KEY_PREFIX + 'userprofile:{user_id}'
+USER_CARD_PATTERN = CACHE_KEY_PREFIX + 'usercard:{user_id}'
+USER_TWEETS_PATTERN = CACHE_KEY_PREFIX + 'user_tweets:{user_id}'
+USER_NEWSFEEDS_PATTERN = CACHE_KEY_PREFIX + 'user_newsfeeds:{user_id}'
+OBJECT_PATTERN = CACHE_KEY_PREFIX + '{model_name}:{object_id}'
+# 每个用户最后一次活跃的时间，sorted set，score 是时间戳
+USER_LAST_ACTIVE_KEY = CACHE_KEY_PREFIX + 'user_last_active'
+# bulk lane 里正在 fanout 的 tweets，以及每条 tweet 进行到哪里了
+FANOUT_BULK_TWEETS_KEY = CACHE_KEY_PREFIX + 'fanout_bulk_tweets'
+FANOUT_BULK_TWEET_PATTERN = CACHE_KEY_PREFIX + 'fanout_bulk_tweet:{tweet_id}'
+# 每个 fanout lane 最近的延迟，单位是秒
+FANOUT_LANE_LAG_PATTERN = CACHE_KEY_PREFIX + 'fanout_lag:{lane}'
+# 每条 tweet 的 fanout 进度，正在进行的 fanout，以及最近完成的 fanout 的耗时
+FANOUT_JOB_PATTERN = CACHE_KEY_PREFIX + 'fanout_job:{tweet_id}'
+FANOUT_JOBS_IN_FLIGHT_KEY = CACHE_KEY_PREFIX + 'fanout_jobs_in_flight'
+FANOUT_JOB_DURATIONS_KEY = CACHE_KEY_PREFIX + 'fanout_job_durations'
+# 不做 fanout 的大 v 的 user id 集合
+CELEBRITY_USER_IDS_KEY = CACHE_KEY_PREFIX + 'celebrity_user_ids'
+
+
+def get_key_namespace(key):
+    # 'v1:userprofile:1' -> 'userprofile'
+    if key.startswith(CACHE_KEY_PREFIX):
+        key = key[len(CACHE_KEY_PREFIX):]
+    return key.split(':', 1)[0]
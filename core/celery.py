@@ -1,6 +1,7 @@
 import os
 
 from celery import Celery
+from celery.signals import task_postrun, task_prerun
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
@@ -17,6 +18,19 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+# 每个 task 使用自己的 identity map，执行完就清空
+@task_prerun.connect
+def begin_identity_map(**kwargs):
+    from utils.identity_map import IdentityMap
+    IdentityMap.begin()
+
+
+@task_postrun.connect
+def end_identity_map(**kwargs):
+    from utils.identity_map import IdentityMap
+    IdentityMap.end()
+
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
\ No newline at end of file
@@ -74,6 +74,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'utils.middleware.IdentityMapMiddleware',
+    'utils.middleware.LastActiveMiddleware',
 ]
 
 
@@ -177,12 +179,88 @@ CACHES = {
         'KEY_PREFIX': 'rl',
     },
 }
+# MemcachedHelper 里 object 的过期时间，实际时间会在上下 JITTER 的比例内随机
+MEMCACHED_OBJECT_TIMEOUT = 86400
+MEMCACHED_OBJECT_TIMEOUT_JITTER = 0.1
+# 不存在的 object 只 cache 很短的时间
+MEMCACHED_NEGATIVE_TIMEOUT = 30
+# generation 比数据活得久，过期了也只是多一次 cache miss
+MEMCACHED_GENERATION_TIMEOUT = MEMCACHED_OBJECT_TIMEOUT * 2
+# 过了 soft timeout 的数据由拿到 lease 的一个请求刷新，其他请求继续使用旧数据，lease 最多持有这么久
+MEMCACHED_LEASE_TIMEOUT = 5
+# memcached 里没有数据的时候，没拿到 lease 的请求每隔 INTERVAL 秒重新读一次，最多读 ATTEMPTS 次
+MEMCACHED_LEASE_WAIT_INTERVAL = 0.02
+MEMCACHED_LEASE_WAIT_ATTEMPTS = 5
+USER_PROFILE_SOFT_TIMEOUT = 600
+FOLLOWINGS_SOFT_TIMEOUT = 600
+
+# 进程内的 LRU cache，放在 memcached 前面给最热的 users, profiles 和 tweets 用
+# 修改时通过 redis pub/sub 通知所有进程删除
+LOCAL_CACHE_ENABLED = not TESTING
+LOCAL_CACHE_NAMESPACES = ('User', 'userprofile', 'usercard', 'Tweet')
+LOCAL_CACHE_MAX_ENTRIES = 10000
+LOCAL_CACHE_MAX_BYTES = 32 * 1024 * 1024
+LOCAL_CACHE_TIMEOUT = 60  # seconds
+LOCAL_CACHE_CHANNEL = 'local_cache:invalidate'
+
+# 每种 cache 每类 key 的 hits, misses, fills, 耗时, 大小和错误次数
+# 进程内累加，定期合并到 redis 的一个 hash 里，通过 /metrics/cache/ 或者 manage.py cache_metrics 查看
+CACHE_METRICS_ENABLED = True
+CACHE_METRICS_FLUSH_INTERVAL = 10  # seconds
+CACHE_METRICS_KEY = 'cache_metrics'
+# 除了 staff 用户，带着 Authorization: Bearer <METRICS_TOKEN> 的请求也可以抓取 /metrics/，比如 prometheus server
+# 不按 ip 放行，nginx 之类的反向代理转发过来的请求 ip 都是 127.0.0.1，在 local_settings 里配置
+METRICS_TOKEN = None
 
 REDIS_HOST = '192.168.56.101'
 REDIS_PORT = '6379'
 REDIS_DB = 0 if TESTING else 1
 REDIS_KEY_EXPIRE_TIME = 7 * 86400
 REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
+# followers 超过这个数量的用户发 tweet 时不再 fanout，由 followers 读取 newsfeeds 时从他的 tweets 里拉取
+NEWSFEED_CELEBRITY_THRESHOLD = 100000
+# 每个进程对同一个用户最多每隔这么久记录一次最后活跃时间
+USER_LAST_ACTIVE_INTERVAL = 300  # seconds
+# 这段时间内没有活跃过的 followers，fanout 的时候不写他们的 redis cache
+# 不能小于 REDIS_KEY_EXPIRE_TIME: 不活跃的用户的 cache 在他最后一次读取之后最多保留这么久，
+# 已经过期了，不会因为没有 push 而读到旧数据，回来之后第一次读取时从数据库重建
+NEWSFEED_ACTIVITY_AWARE_FANOUT = not TESTING
+NEWSFEED_ACTIVE_USER_WINDOW = REDIS_KEY_EXPIRE_TIME
+# fanout 写 newsfeed 记录时每条 INSERT 的行数，以及是否跳过 model 直接拼多行 INSERT
+NEWSFEED_BULK_INSERT_BATCH_SIZE = 500
+NEWSFEED_BULK_INSERT_RAW = True
+# 删除 tweet 之后每个后台任务从 followers 的 newsfeeds 里撤回多少条
+TWEET_RETRACT_BATCH_SIZE = 1000 if not TESTING else 2
+# 不活跃的 followers 连 newsfeed 记录也不写，回来的时候用关注的人最近的 tweets 补上
+NEWSFEED_SKIP_INACTIVE_ROWS = False
+# cache 重建时的锁，同一个 key 同一时间只有一个 worker 在重建
+REDIS_FILL_LOCK_TIMEOUT = 10
+# 每个进程里每个 pool 的连接参数，单位是秒
+REDIS_CONNECTION_OPTIONS = {
+    'max_connections': 50,
+    'socket_timeout': 1,
+    'socket_connect_timeout': 1,
+    'retry_on_timeout': True,
+    'health_check_interval': 30,
+}
+# 不同用途使用不同的 pool，可以单独覆盖 host, port, db 和上面的连接参数
+#   cache: 缓存的列表和锁
+#   counters: likes_count, comments_count 之类的计数
+#   broker: 锁、pub/sub、fanout 状态这类和任务队列相关的数据
+REDIS_POOLS = {
+    'cache': {},
+    'counters': {},
+    'broker': {},
+}
+
+# likes_count, comments_count 先只在 redis 里加减，由定时任务批量写回数据库
+# 避免热门 tweet 的那一行被大量并发的 UPDATE 锁住
+COUNTERS_WRITE_BEHIND = not TESTING
+COUNTERS_FLUSH_INTERVAL = 10  # seconds
+COUNTERS_FLUSH_BATCH_SIZE = 500
+COUNTERS_FLUSH_LOCK_TIMEOUT = 60
+# 写回过的 flush id 保留多久，比 flushing 可能残留的时间长得多就行
+COUNTERS_FLUSH_RECORD_TIMEOUT = 86400 * 7
 
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
@@ -193,7 +271,25 @@ CELERY_TASK_ALWAYS_EAGER = TESTING
 CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
+    Queue('newsfeeds_bulk', routing_key='newsfeeds_bulk'),
 )
+# followers 多的用户的 fanout 走单独的 bulk 队列，不会堵住普通用户的 fanout，两个队列用不同的 worker:
+#   celery -A core worker -Q newsfeeds -l INFO
+#   celery -A core worker -Q newsfeeds_bulk -l INFO
+NEWSFEED_BULK_LANE_THRESHOLD = 10000
+# 每个 lane 保留最近这么多次 fanout 的延迟，用来计算分位数
+NEWSFEED_LANE_LAG_SAMPLES = 1000
+# fanout job 结束之后在 redis 里保留多久
+NEWSFEED_FANOUT_JOB_TIMEOUT = 86400
+# 一条 tweet 的所有 fanout batch 都结束之后执行的 celery task 的名字，参数是 tweet_id
+NEWSFEED_FANOUT_CALLBACK = None
+# 需要同时运行 celery -A core beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    'flush-tweet-counts': {
+        'task': 'tweets.tasks.flush_tweet_counts_task',
+        'schedule': COUNTERS_FLUSH_INTERVAL,
+    },
+}
 
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
@@ -5,10 +5,11 @@ from rest_framework import routers
 from accounts.views import AccountViewSet, UserViewSet, UserProfileViewSet
 from tweets.views import TweetViewSet
 from friendships.views import FriendshipViewSet
-from newsfeeds.views import NewsFeedViewSet
+from newsfeeds.views import NewsFeedViewSet, fanout_metrics_view
 from comments.views import CommentViewSet
 from likes.views import LikeViewSet
 from inbox.views import NotificationViewSet
+from utils.views import cache_metrics_view
 
 router = routers.DefaultRouter()
 router.register(r'api/users', UserViewSet)
@@ -26,4 +27,6 @@ urlpatterns = [
     path('', include(router.urls)),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('notifications/', include('notifications.urls', namespace='notifications')),
+    path('metrics/cache/', cache_metrics_view),
+    path('metrics/fanout/', fanout_metrics_view),
 ]
\ No newline at end of file
@@ -37,12 +37,32 @@ class Friendships(models.Model):
 
     @property
     def cached_from_user(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_from_user'):
+            return self._cached_from_user
         return MemcachedHelper.get_object_through_cache(User, self.from_user_id)
 
+    @property
+    def cached_from_user_card(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_from_user_card'):
+            return self._cached_from_user_card
+        return UserService.get_user_card(self.from_user_id)
+
     @property
     def cached_to_user(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_to_user'):
+            return self._cached_to_user
         return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
 
+    @property
+    def cached_to_user_card(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_to_user_card'):
+            return self._cached_to_user_card
+        return UserService.get_user_card(self.to_user_id)
+
 
 post_save.connect(friendships_changed, sender=Friendships)
 pre_delete.connect(friendships_changed, sender=Friendships)
\ No newline at end of file
@@ -1,8 +1,10 @@
 from friendships.services import FriendshipService
 from rest_framework import serializers
 from accounts.serializers import UserSerializerForFriendship
+from accounts.services import UserService
 from rest_framework.exceptions import ValidationError
 from .models import Friendships
+from utils.data_loader import BatchLoadListSerializer, BatchLoadSerializerMixin
 
 
 class FollowingUserIdSetMixin:
@@ -40,26 +42,38 @@ class FriendshipSerializerForCreate(serializers.ModelSerializer):
         )
 
 
-class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
-    user = UserSerializerForFriendship(source='cached_from_user')
+class FollowerSerializer(BatchLoadSerializerMixin, serializers.ModelSerializer, FollowingUserIdSetMixin):
+    user = UserSerializerForFriendship(source='cached_from_user_card')
     created_at = serializers.DateTimeField()
     has_followed = serializers.SerializerMethodField()
 
+    def get_batch_loads(self):
+        return [
+            ('user_cards', '_cached_from_user_card', 'from_user_id', UserService.get_user_cards),
+        ]
+
     class Meta:
         model = Friendships
+        list_serializer_class = BatchLoadListSerializer
         fields = ('user', 'created_at', 'has_followed')
 
     def get_has_followed(self, obj):
-        return obj.from_user in self.following_user_id_set
+        return obj.from_user_id in self.following_user_id_set
 
-class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
-    user = UserSerializerForFriendship(source='cached_to_user')
+class FollowingSerializer(BatchLoadSerializerMixin, serializers.ModelSerializer, FollowingUserIdSetMixin):
+    user = UserSerializerForFriendship(source='cached_to_user_card')
     created_at = serializers.DateTimeField()
     has_followed = serializers.SerializerMethodField()
 
+    def get_batch_loads(self):
+        return [
+            ('user_cards', '_cached_to_user_card', 'to_user_id', UserService.get_user_cards),
+        ]
+
     class Meta:
         model = Friendships
+        list_serializer_class = BatchLoadListSerializer
         fields = ('user', 'created_at', 'has_followed')
 
     def get_has_followed(self, obj):
-        return obj.to_user in self.following_user_id_set
+        return obj.to_user_id in self.following_user_id_set
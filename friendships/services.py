@@ -1,9 +1,8 @@
-from django.core.cache import caches
 from .models import Friendships
 from django.conf import settings
+from django.db.models import Count
 from core.cache import FOLLOWINGS_PATTERN
-
-cache = caches['testing'] if settings.TESTING else caches['default']
+from utils.memcached_helper import MemcachedHelper
 
 class FriendshipService(object):
 
@@ -14,26 +13,91 @@ class FriendshipService(object):
 
     @classmethod
     def get_follower_ids(cls, to_user_id):
-        friendships = Friendships.objects.filter(to_user_id=to_user_id)
-        return [friendship.from_user_id for friendship in friendships]
+        return list(cls.iter_follower_ids(to_user_id))
+
+    # 按 (to_user_id, id) 做 keyset 分页，每次只读一批，不会一次把所有 followers 读到内存里
+    # to_user_id 上的索引在 innodb 里本身就带着主键 id，不需要另外建索引
+    @classmethod
+    def iter_follower_ids(cls, to_user_id, batch_size=1000, min_id=None, max_id=None):
+        """
+        按 id 从小到大逐个返回 follower 的 user id，id 的范围是 (min_id, max_id]
+        """
+        queryset = Friendships.objects.filter(to_user_id=to_user_id)
+        if max_id is not None:
+            queryset = queryset.filter(id__lte=max_id)
+        last_id = min_id
+        while True:
+            batch = queryset if last_id is None else queryset.filter(id__gt=last_id)
+            rows = list(batch.order_by('id').values_list('id', 'from_user_id')[:batch_size])
+            for last_id, from_user_id in rows:
+                yield from_user_id
+            if len(rows) < batch_size:
+                return
+
+    @classmethod
+    def get_follower_id_range_end(cls, to_user_id, min_id, batch_size):
+        """
+        从 min_id 之后数 batch_size 个 followers，返回这一段的 max_id
+        只读这一段的最后一个 id 和下一个 id，剩下的不超过一段的时候返回 None，最后一段不设上限
+        """
+        queryset = Friendships.objects.filter(to_user_id=to_user_id)
+        if min_id is not None:
+            queryset = queryset.filter(id__gt=min_id)
+        ids = list(queryset.order_by('id').values_list('id', flat=True)[batch_size - 1:batch_size + 1])
+        return ids[0] if len(ids) == 2 else None
+
+    @classmethod
+    def iter_follower_id_ranges(cls, to_user_id, batch_size):
+        """
+        把 followers 按 id 切成每段 batch_size 个，返回每一段的 (min_id, max_id]
+        """
+        min_id = None
+        while True:
+            max_id = cls.get_follower_id_range_end(to_user_id, min_id, batch_size)
+            if max_id is not None:
+                yield min_id, max_id
+                min_id = max_id
+                continue
+            queryset = Friendships.objects.filter(to_user_id=to_user_id)
+            if min_id is not None:
+                queryset = queryset.filter(id__gt=min_id)
+            if queryset.exists():
+                yield min_id, None
+            return
+
+    @classmethod
+    def get_followers_count(cls, to_user_id):
+        return Friendships.objects.filter(to_user_id=to_user_id).count()
+
+    @classmethod
+    def get_user_ids_with_followers(cls, min_followers_count):
+        # 要扫整个表，只在大 v 的集合丢失需要重建的时候用
+        return list(
+            Friendships.objects.values('to_user_id')
+            .annotate(followers_count=Count('id'))
+            .filter(followers_count__gte=min_followers_count)
+            .values_list('to_user_id', flat=True)
+        )
 
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        user_id_set = cache.get(key)
-        if user_id_set is not None:
-            return user_id_set
 
-        friendships = Friendships.objects.filter(from_user_id=from_user_id)
-        user_id_set = set([
-            fs.to_user_id for fs in friendships
-        ])
-        cache.set(key, user_id_set)
-        return user_id_set
+        def load(missing_keys):
+            friendships = Friendships.objects.filter(from_user_id=from_user_id)
+            return {key: set([
+                fs.to_user_id for fs in friendships
+            ])}
+
+        return MemcachedHelper.get_many_through_cache(
+            [key],
+            load,
+            soft_timeout=settings.FOLLOWINGS_SOFT_TIMEOUT,
+        )[key]
 
     @classmethod
     def invalidate_following_cache(cls, from_user_id):
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
+        MemcachedHelper.invalidate(key)
 
     
\ No newline at end of file
@@ -241,3 +241,27 @@ class FriendshipServiceTests(TestCase):
         # FriendshipService.invalidate_following_cache(self.alex.id)
         user_id_set = FriendshipService.get_following_user_id_set(self.alex.id)
         self.assertEqual(user_id_set, {user1.id, user2.id})
+
+    def test_iter_follower_ids(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(7)]
+        for follower in followers:
+            Friendships.objects.create(from_user=follower, to_user=self.alex)
+        Friendships.objects.create(from_user=self.alex, to_user=self.bob)
+        follower_ids = [follower.id for follower in followers]
+
+        self.assertEqual(list(FriendshipService.iter_follower_ids(self.alex.id, batch_size=3)), follower_ids)
+        self.assertEqual(FriendshipService.get_follower_ids(self.bob.id), [self.alex.id])
+
+        # 每段 3 个，最后一段不设上限，每一段各自读出来拼起来就是所有的 followers
+        ranges = list(FriendshipService.iter_follower_id_ranges(self.alex.id, 3))
+        self.assertEqual(len(ranges), 3)
+        self.assertIsNone(ranges[0][0])
+        self.assertIsNone(ranges[-1][1])
+        ids = []
+        for min_id, max_id in ranges:
+            ids.extend(FriendshipService.iter_follower_ids(self.alex.id, min_id=min_id, max_id=max_id))
+        self.assertEqual(ids, follower_ids)
+
+        # 刚好是整数段的时候不会多出一个空的段
+        self.assertEqual(len(list(FriendshipService.iter_follower_id_ranges(self.alex.id, 7))), 1)
+        self.assertEqual(list(FriendshipService.iter_follower_id_ranges(self.bob.id + 100, 3)), [])
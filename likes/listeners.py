@@ -1,3 +1,4 @@
+from django.conf import settings
 from utils.redis_helper import RedisHelper
 
 def incr_likes_count(sender, instance, created, **kwargs):
@@ -10,7 +11,8 @@ def incr_likes_count(sender, instance, created, **kwargs):
     model_class = instance.content_type.model_class()
     if model_class != Tweet:
         return
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count')+1)
+    if not settings.COUNTERS_WRITE_BEHIND:
+        Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count')+1)
     tweet = instance.content_object
     RedisHelper.incr_count(tweet, 'likes_count')
 
@@ -23,6 +25,7 @@ def decr_likes_count(sender, instance, **kwargs):
     model_class = instance.content_type.model_class()
     if model_class != Tweet:
         return
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count')-1)
+    if not settings.COUNTERS_WRITE_BEHIND:
+        Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count')-1)
     tweet = instance.content_object
     RedisHelper.decr_count(tweet, 'likes_count')
\ No newline at end of file
@@ -3,6 +3,7 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from utils.memcached_helper import MemcachedHelper
+from accounts.services import UserService
 from django.db.models.signals import pre_delete, post_save
 from .listeners import incr_likes_count, decr_likes_count
 
@@ -32,8 +33,18 @@ class Like(models.Model):
 
     @property
     def cached_user(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
+    @property
+    def cached_user_card(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_user_card'):
+            return self._cached_user_card
+        return UserService.get_user_card(self.user_id)
+
 
 pre_delete.connect(decr_likes_count, Like)
 post_save.connect(incr_likes_count, Like)
\ No newline at end of file
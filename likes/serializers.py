@@ -6,13 +6,21 @@ from rest_framework import serializers
 from .models import Like
 # from django.contrib.auth.models import User
 from accounts.serializers import UserSerializerForLike
+from accounts.services import UserService
+from utils.data_loader import BatchLoadListSerializer, BatchLoadSerializerMixin
 
-class LikeSerializer(serializers.ModelSerializer):
+class LikeSerializer(BatchLoadSerializerMixin, serializers.ModelSerializer):
 
-    user = UserSerializerForLike(source='cached_user')
+    user = UserSerializerForLike(source='cached_user_card')
+
+    def get_batch_loads(self):
+        return [
+            ('user_cards', '_cached_user_card', 'user_id', UserService.get_user_cards),
+        ]
 
     class Meta:
         model = Like
+        list_serializer_class = BatchLoadListSerializer
         fields = ('user', 'created_at')
 
 
@@ -1,5 +1,6 @@
 from .models import Like
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count
 
 
 class LikeService:
@@ -13,4 +14,29 @@ class LikeService:
             user=user,
             content_type=ContentType.objects.get_for_model(target.__class__),
             object_id=target.id
-        ).exists()
\ No newline at end of file
+        ).exists()
+
+    @classmethod
+    def get_has_liked_map(cls, user, model_class, object_ids):
+        # 一次查询得到 user 是否点赞了这一批 objects，返回 {object_id: bool}
+        if user.is_anonymous:
+            return {object_id: False for object_id in object_ids}
+
+        liked_ids = set(Like.objects.filter(
+            user=user,
+            content_type=ContentType.objects.get_for_model(model_class),
+            object_id__in=object_ids,
+        ).values_list('object_id', flat=True))
+        return {object_id: object_id in liked_ids for object_id in object_ids}
+
+    @classmethod
+    def get_likes_count_map(cls, model_class, object_ids):
+        # 一次 GROUP BY 查询得到一批 objects 的点赞数，返回 {object_id: count}
+        rows = Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(model_class),
+            object_id__in=object_ids,
+        ).values('object_id').annotate(count=Count('id')).order_by()
+        counts = {object_id: 0 for object_id in object_ids}
+        for row in rows:
+            counts[row['object_id']] = row['count']
+        return counts
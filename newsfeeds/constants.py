@@ -1,3 +1,8 @@
 from django.conf import settings
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# fanout 的两个 lane 和对应的 celery 队列
+FANOUT_FAST_LANE = 'newsfeeds'
+FANOUT_BULK_LANE = 'newsfeeds_bulk'
+FANOUT_LANES = (FANOUT_FAST_LANE, FANOUT_BULK_LANE)
\ No newline at end of file
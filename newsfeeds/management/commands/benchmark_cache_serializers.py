@@ -0,0 +1,92 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from newsfeeds.models import NewsFeed
+from tweets.models import Tweet
+from utils.redis_serializers import CompactModelSerializer, DjangoModelSerializer
+from utils.time_helpers import utc_now
+
+
+class Command(BaseCommand):
+    help = 'Compare the compact cache codec with the django json serializer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000)
+
+    def build_objects(self, count):
+        # 只在内存里构造 objects，不需要写数据库
+        now = utc_now()
+        users = [
+            User(
+                id=i + 1,
+                username='user{}'.format(i),
+                email='user{}@example.com'.format(i),
+                password='pbkdf2_sha256$260000$salt$hash',
+                date_joined=now,
+            )
+            for i in range(count)
+        ]
+        tweets = [
+            Tweet(
+                id=i + 1,
+                user_id=i + 1,
+                content='benchmark tweet content number {}'.format(i),
+                created_at=now,
+                likes_count=i,
+                comments_count=i,
+            )
+            for i in range(count)
+        ]
+        newsfeeds = [
+            NewsFeed(id=i + 1, user_id=i + 1, tweet_id=i + 1, created_at=now)
+            for i in range(count)
+        ]
+        return (('User', User, users), ('Tweet', Tweet, tweets), ('NewsFeed', NewsFeed, newsfeeds))
+
+    def measure(self, objects, serialize, deserialize_many):
+        start = time.perf_counter()
+        serialized_list = [serialize(obj) for obj in objects]
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        deserialize_many(serialized_list)
+        decode_time = time.perf_counter() - start
+
+        total_bytes = sum(
+            len(data.encode('utf-8') if isinstance(data, str) else data)
+            for data in serialized_list
+        )
+        count = len(objects)
+        return (
+            encode_time * 10 ** 6 / count,
+            decode_time * 10 ** 6 / count,
+            total_bytes / count,
+        )
+
+    def handle(self, *args, **options):
+        count = options['count']
+        row_format = '{:<10}{:<10}{:>14}{:>14}{:>14}'
+        self.stdout.write(row_format.format('model', 'codec', 'encode us', 'decode us', 'bytes/obj'))
+        for name, model_class, objects in self.build_objects(count):
+            json_stats = self.measure(
+                objects,
+                DjangoModelSerializer.serialize,
+                lambda serialized_list: [
+                    DjangoModelSerializer.deserialize(data) for data in serialized_list
+                ],
+            )
+            compact_stats = self.measure(
+                objects,
+                CompactModelSerializer.serialize,
+                lambda serialized_list: CompactModelSerializer.deserialize_many(
+                    model_class, serialized_list,
+                ),
+            )
+            for codec, stats in (('json', json_stats), ('compact', compact_stats)):
+                self.stdout.write(row_format.format(
+                    name,
+                    codec,
+                    '{:.2f}'.format(stats[0]),
+                    '{:.2f}'.format(stats[1]),
+                    '{:.1f}'.format(stats[2]),
+                ))
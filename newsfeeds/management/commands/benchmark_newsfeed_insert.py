@@ -0,0 +1,65 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedService
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = 'Compare newsfeed insert paths used by fanout, all changes are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10000)
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 500, 1000])
+
+    def measure(self, insert, tweet_id, user_ids):
+        NewsFeed.objects.filter(tweet_id=tweet_id).delete()
+        start = time.perf_counter()
+        insert()
+        first_time = time.perf_counter() - start
+
+        # 第二次全部都是重复的记录，模拟 task 重试
+        start = time.perf_counter()
+        insert()
+        retry_time = time.perf_counter() - start
+        return len(user_ids) / first_time, len(user_ids) / retry_time
+
+    def handle(self, *args, **options):
+        count = options['count']
+        row_format = '{:<24}{:>8}{:>14}{:>14}'
+        self.stdout.write(row_format.format('path', 'batch', 'rows/s', 'retry rows/s'))
+
+        with transaction.atomic():
+            # 先准备好 users 和 tweet，最后整个回滚掉
+            User.objects.bulk_create([
+                User(username='benchmark_newsfeed_{}'.format(i), password='!')
+                for i in range(count)
+            ])
+            user_ids = list(User.objects.filter(
+                username__startswith='benchmark_newsfeed_',
+            ).values_list('id', flat=True))
+            # bulk_create 不触发 post_save，不会写 redis 或者发出 fanout 之类的 task，回滚不了的副作用都没有
+            Tweet.objects.bulk_create([Tweet(user_id=user_ids[0], content='benchmark')])
+            tweet = Tweet.objects.filter(user_id=user_ids[0]).latest('id')
+
+            for batch_size in options['batch_sizes']:
+                for name, raw in (('bulk_create ignore', False), ('raw multi-row insert', True)):
+                    stats = self.measure(
+                        lambda: NewsFeedService.bulk_insert_newsfeeds(
+                            tweet.id,
+                            user_ids,
+                            batch_size=batch_size,
+                            raw=raw,
+                        ),
+                        tweet.id,
+                        user_ids,
+                    )
+                    self.stdout.write(row_format.format(
+                        name,
+                        batch_size,
+                        '{:.0f}'.format(stats[0]),
+                        '{:.0f}'.format(stats[1]),
+                    ))
+            transaction.set_rollback(True)
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from utils.cache_metrics import CacheMetrics
+
+
+class Command(BaseCommand):
+    help = 'Print hit rate, fill latency and size of every cache namespace'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the collected metrics')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            CacheMetrics.reset()
+            self.stdout.write('cache metrics cleared')
+            return
+
+        metrics = CacheMetrics.get_metrics()
+        if not metrics:
+            self.stdout.write('no cache metrics collected yet')
+            return
+
+        self.stdout.write('{:<10} {:<16} {:>10} {:>10} {:>8} {:>8} {:>12} {:>12} {:>8}'.format(
+            'cache', 'namespace', 'hits', 'misses', 'hit%', 'fills', 'fill avg ms', 'bytes', 'errors',
+        ))
+        for (cache_name, namespace), values in sorted(metrics.items()):
+            hits = values.get('hits', 0)
+            misses = values.get('misses', 0)
+            fills = values.get('fills', 0)
+            hit_rate = hits * 100 / (hits + misses) if hits + misses else 0
+            fill_avg_ms = values.get('fill_seconds', 0) * 1000 / fills if fills else 0
+            self.stdout.write('{:<10} {:<16} {:>10} {:>10} {:>7.1f}% {:>8} {:>12.2f} {:>12} {:>8}'.format(
+                cache_name,
+                namespace,
+                int(hits),
+                int(misses),
+                hit_rate,
+                int(fills),
+                fill_avg_ms,
+                int(values.get('bytes', 0)),
+                int(values.get('errors', 0)),
+            ))
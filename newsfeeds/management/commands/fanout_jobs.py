@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.services import FanoutJobService
+import time
+
+
+class Command(BaseCommand):
+    help = 'Print unfinished fanout jobs and how long finished fanout jobs took'
+
+    def handle(self, *args, **options):
+        now = time.time()
+        row_format = '{:<12}{:<16}{:>10}{:>10}{:>8}{:>8}{:>12}{:>10}'
+        self.stdout.write(row_format.format(
+            'tweet', 'lane', 'batches', 'done', 'failed', 'sealed', 'newsfeeds', 'age s',
+        ))
+        for job in FanoutJobService.get_in_flight_jobs():
+            self.stdout.write(row_format.format(
+                job['tweet_id'],
+                job['lane'],
+                job['planned'],
+                job['completed'],
+                job['failed'],
+                'yes' if job['sealed'] else 'no',
+                job['newsfeeds'],
+                '{:.1f}'.format(now - job['started_at']),
+            ))
+
+        percentiles = FanoutJobService.get_duration_percentiles()
+        self.stdout.write('')
+        self.stdout.write('finished jobs: {}'.format(percentiles['samples']))
+        for name in ('p50', 'p90', 'p99', 'max'):
+            value = percentiles[name]
+            self.stdout.write('{:<6}{}'.format(name, '-' if value is None else '{:.2f} s'.format(value)))
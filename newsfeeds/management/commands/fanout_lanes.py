@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.services import FanoutLaneService
+
+
+class Command(BaseCommand):
+    help = 'Print queue depth and fanout lag of every fanout lane'
+
+    def handle(self, *args, **options):
+        row_format = '{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'
+        self.stdout.write(row_format.format(
+            'lane', 'depth', 'pending', 'samples', 'p50 s', 'p99 s', 'max s',
+        ))
+        for lane, stats in FanoutLaneService.get_lane_stats().items():
+            self.stdout.write(row_format.format(
+                lane,
+                _format(stats['queue_depth']),
+                _format(stats.get('pending_tweets')),
+                stats['lag_samples'],
+                _format(stats['lag_p50']),
+                _format(stats['lag_p99']),
+                _format(stats['lag_max']),
+            ))
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.2f}'.format(value)
+    return str(value)
@@ -3,6 +3,7 @@ from django.contrib.auth.models import User
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
 from django.db.models.signals import post_save
+from utils.redis_serializers import CompactModelSerializer
 from .listeners import push_newsfeed_to_cache
 class NewsFeed(models.Model):
     
@@ -20,7 +21,18 @@ class NewsFeed(models.Model):
         return f'{self.created_at} index of {self.user}: {self.tweet}'
 
     def cached_tweet(self):
+        # BatchLoadSerializerMixin 会批量预先填好
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
-    
+
+# redis 里缓存的 newsfeed 格式，字段变化时注册一个新的 version
+CompactModelSerializer.register(NewsFeed, version=1, fields=(
+    'id',
+    'user_id',
+    'tweet_id',
+    'created_at',
+))
+
 post_save.connect(push_newsfeed_to_cache, NewsFeed)
\ No newline at end of file
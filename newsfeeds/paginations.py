@@ -0,0 +1,6 @@
+from utils.paginations import EndlessPagination
+
+
+class NewsFeedPagination(EndlessPagination):
+    # 从大 v 拉取的 newsfeeds 的 id 是负数，和 created_at 的顺序无关，同一个用户的 newsfeeds 里 tweet_id 不会重复
+    cursor_tie_field = 'tweet_id'
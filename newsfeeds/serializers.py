@@ -1,10 +1,21 @@
+from functools import partial
 from rest_framework import serializers
 from .models import NewsFeed
+from tweets.models import Tweet
 from tweets.serializers import TweetSerializer
+from utils.data_loader import BatchLoadListSerializer, BatchLoadSerializerMixin
+from utils.memcached_helper import MemcachedHelper
 
-class NewsFeedSerializer(serializers.ModelSerializer):
+
+class NewsFeedSerializer(BatchLoadSerializerMixin, serializers.ModelSerializer):
     tweet = TweetSerializer(source='cached_tweet')
 
+    def get_batch_loads(self):
+        return [
+            ('tweets', '_cached_tweet', 'tweet_id', partial(MemcachedHelper.get_objects_through_cache, Tweet)),
+        ]
+
     class Meta:
         model = NewsFeed
+        list_serializer_class = BatchLoadListSerializer
         fields = ('id', 'created_at', 'user', 'tweet')
@@ -1,21 +1,717 @@
+from functools import partial
+from accounts.services import UserService
+from celery import current_app
+from django.conf import settings
+from django.db import connection
+from django.db.models import OuterRef, Subquery
+from friendships.services import FriendshipService
 from newsfeeds.models import NewsFeed
+from tweets.models import Tweet
+from tweets.services import TweetService
+from utils.cache_metrics import CacheMetrics
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
-from core.cache import USER_NEWSFEEDS_PATTERN
-from .tasks import fanout_newsfeeds_main_task
+from utils.time_helpers import datetime_to_microseconds, microseconds_to_datetime, utc_now
+from core.cache import (
+    CELEBRITY_USER_IDS_KEY,
+    FANOUT_BULK_TWEETS_KEY,
+    FANOUT_BULK_TWEET_PATTERN,
+    FANOUT_JOB_DURATIONS_KEY,
+    FANOUT_JOB_PATTERN,
+    FANOUT_JOBS_IN_FLIGHT_KEY,
+    FANOUT_LANE_LAG_PATTERN,
+    USER_NEWSFEEDS_PATTERN,
+)
+from newsfeeds.constants import FANOUT_BATCH_SIZE, FANOUT_BULK_LANE, FANOUT_LANES
+import heapq
+import time
+from .tasks import (
+    backfill_newsfeeds_task,
+    fanout_demoted_celebrity_task,
+    fanout_newsfeeds_main_task,
+    rebuild_newsfeeds_cache_task,
+    retract_tweet_task,
+)
 
 class NewsFeedService(object):
     @classmethod
     def fanout_to_followers(cls, tweet):
         fanout_newsfeeds_main_task.delay(tweet.id, tweet.user_id)
 
+    @classmethod
+    def fanout_batch(cls, tweet_id, tweet_user_id, min_id, max_id, lane):
+        """
+        给 friendships id 在 (min_id, max_id] 范围里的 followers 写入 newsfeeds
+        返回写入的数量，tweet 已经被删除的时候返回 None
+        """
+        # fanout 还没完成的时候 tweet 就被删除了，剩下的 batch 不再写入
+        tweet = Tweet.objects.filter(id=tweet_id).values_list('created_at', 'has_deleted').first()
+        if tweet is None or tweet[1]:
+            return None
+
+        follower_ids = list(FriendshipService.iter_follower_ids(
+            tweet_user_id,
+            batch_size=FANOUT_BATCH_SIZE,
+            min_id=min_id,
+            max_id=max_id,
+        ))
+        # 最近不活跃的 followers 不写 cache，也可以选择连 newsfeed 记录也不写
+        active_user_ids = None
+        if settings.NEWSFEED_ACTIVITY_AWARE_FANOUT:
+            active_user_ids = UserService.get_active_user_ids(follower_ids)
+            if settings.NEWSFEED_SKIP_INACTIVE_ROWS:
+                follower_ids = [
+                    follower_id
+                    for follower_id in follower_ids
+                    if follower_id in active_user_ids
+                ]
+        # 已经写过的记录会被忽略，重试的时候不会因为 unique_together 失败
+        # 用 tweet 的时间，补发旧 tweets 的时候翻页的顺序也是对的
+        cls.bulk_insert_newsfeeds(tweet_id, follower_ids, created_at=tweet[0])
+        # mysql 的 bulk_create 不会回填 id，cache 里需要用到 newsfeed id，重新查一次
+        newsfeeds = list(NewsFeed.objects.filter(tweet_id=tweet_id, user_id__in=follower_ids))
+
+        # 一个 pipeline 写完这一批 followers 的 cache
+        cls.push_newsfeeds_to_cache([
+            newsfeed
+            for newsfeed in newsfeeds
+            if active_user_ids is None or newsfeed.user_id in active_user_ids
+        ])
+        FanoutLaneService.record_lag(lane, tweet[0])
+
+        # 开始的时候还没删除，写入的时候撤回可能已经做完了，这一批自己撤回，不留下孤立的记录
+        if Tweet.objects.filter(id=tweet_id, has_deleted=True).exists():
+            cls._remove_newsfeeds(tweet_id, [(newsfeed.id, newsfeed.user_id) for newsfeed in newsfeeds])
+            return None
+        return len(newsfeeds)
+
+    @classmethod
+    def retract_from_followers(cls, tweet):
+        retract_tweet_task.delay(tweet.id)
+
+    @classmethod
+    def retract_newsfeeds_batch(cls, tweet_id, min_id=None):
+        """
+        按 id 做 keyset 分页，撤回一批 id 大于 min_id 的 newsfeeds
+        先从 followers 的 cache 里删掉，再删数据库里的记录，返回这一批最后一个 id，没有更多了返回 None
+        """
+        queryset = NewsFeed.objects.filter(tweet_id=tweet_id)
+        if min_id is not None:
+            queryset = queryset.filter(id__gt=min_id)
+        batch_size = settings.TWEET_RETRACT_BATCH_SIZE
+        rows = list(queryset.order_by('id').values_list('id', 'user_id')[:batch_size])
+        if not rows:
+            return None
+        cls._remove_newsfeeds(tweet_id, rows)
+        return rows[-1][0] if len(rows) == batch_size else None
+
+    @classmethod
+    def _remove_newsfeeds(cls, tweet_id, rows):
+        # rows 是 [(newsfeed_id, user_id), ...]，先从 followers 的 cache 里删掉，再删数据库里的记录
+        pipe = RedisClient.get_connection().pipeline(transaction=False)
+        for newsfeed_id, user_id in rows:
+            pipe.zrem(
+                USER_NEWSFEEDS_PATTERN.format(user_id=user_id),
+                cls.to_member(newsfeed_id, tweet_id),
+            )
+        pipe.execute()
+        NewsFeed.objects.filter(id__in=[newsfeed_id for newsfeed_id, _ in rows]).delete()
+
+    # redis 里每个用户的 newsfeeds 是一个 sorted set
+    # member 是 '{newsfeed_id}:{tweet_id}'，score 是 created_at，不再存整个序列化的 NewsFeed
+    @classmethod
+    def to_member(cls, newsfeed_id, tweet_id):
+        return '{}:{}'.format(newsfeed_id, tweet_id)
+
+    @classmethod
+    def from_member(cls, user_id, member, score):
+        if isinstance(member, bytes):
+            member = member.decode('utf-8')
+        newsfeed_id, tweet_id = member.split(':')
+        return NewsFeed.from_db(
+            None,
+            ['id', 'user_id', 'tweet_id', 'created_at'],
+            [int(newsfeed_id), int(user_id), int(tweet_id), microseconds_to_datetime(score)],
+        )
+
+    @classmethod
+    def load_newsfeed_members(cls, user_id):
+        newsfeeds = NewsFeed.objects.filter(user_id=user_id) \
+            .order_by('-created_at') \
+            .values_list('id', 'tweet_id', 'created_at')[:settings.REDIS_LIST_LENGTH_LIMIT]
+        return {
+            cls.to_member(newsfeed_id, tweet_id): datetime_to_microseconds(created_at)
+            for newsfeed_id, tweet_id, created_at in newsfeeds
+        }
+
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
+        newsfeeds = cls.get_cached_newsfeeds_window(user_id)
+        if newsfeeds is not None:
+            return newsfeeds
         queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+        return list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+
+    @classmethod
+    def get_cached_newsfeeds_window(
+        cls, user_id, created_at__lt=None, created_at__gt=None, limit=None, ascending=False,
+    ):
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        members = RedisHelper.load_members_window(
+            key,
+            partial(rebuild_newsfeeds_cache_task.delay, user_id),
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+            limit=limit,
+            ascending=ascending,
+        )
+        if members is None:
+            return None
+        return [
+            cls.from_member(user_id, member, score)
+            for member, score in members
+        ]
+
+    @classmethod
+    def get_newsfeeds_window(cls, user_id, created_at__lt=None, created_at__gt=None, limit=None, ascending=False):
+        """
+        先读 cache，cache 里没有或者超出 cache 范围的时候读数据库
+        ascending 的时候从 created_at__gt 开始从旧到新取，没有 limit 的时候最多取 cache 的长度那么多
+        """
+        limit = limit or settings.REDIS_LIST_LENGTH_LIMIT
+        newsfeeds = cls.get_cached_newsfeeds_window(user_id, created_at__lt, created_at__gt, limit, ascending)
+        if newsfeeds is not None:
+            return newsfeeds
+        queryset = NewsFeed.objects.filter(user_id=user_id)
+        if created_at__lt is not None:
+            queryset = queryset.filter(created_at__lt=created_at__lt)
+        if created_at__gt is not None:
+            queryset = queryset.filter(created_at__gt=created_at__gt)
+        queryset = queryset.order_by('created_at' if ascending else '-created_at')
+        return list(queryset[:limit])
+
+    # followers 太多的用户（大 v）发 tweet 的时候不做 fanout，每条 tweet 最多只写一次
+    # followers 读取 newsfeeds 的时候再从大 v 的 tweets 里拉取，和自己被 push 的 newsfeeds 合并
+    @classmethod
+    def update_celebrity(cls, user_id, followers_count):
+        """
+        fanout 之前根据 followers 数量更新大 v 的集合，返回这个用户是不是大 v
+        """
+        # 集合丢失的时候先重建，不能只加这一个用户
+        cls.get_celebrity_ids()
+        conn = RedisClient.get_connection('broker')
+        if followers_count >= settings.NEWSFEED_CELEBRITY_THRESHOLD:
+            conn.sadd(CELEBRITY_USER_IDS_KEY, user_id)
+            return True
+        if conn.srem(CELEBRITY_USER_IDS_KEY, user_id):
+            # 掉出大 v 之后 followers 不再拉取这个用户的 tweets，之前没有 fanout 的 tweets 会从 newsfeeds 里消失
+            # 补 fanout 最近的 REDIS_LIST_LENGTH_LIMIT 条，更早的 tweets 只能在用户自己的主页看到
+            # 集合丢失重建的时候已经掉出去的用户不在集合里，这种情况不会补
+            fanout_demoted_celebrity_task.delay(user_id)
+        return False
+
+    @classmethod
+    def fanout_demoted_celebrity(cls, user_id):
+        """
+        给掉出大 v 的用户最近的 tweets 补 fanout，已经写过的 newsfeed 会被忽略，重复执行没有影响
+        """
+        tweet_ids = list(
+            Tweet.objects.filter(user_id=user_id, has_deleted=False)
+            .order_by('-created_at')
+            .values_list('id', flat=True)[:settings.REDIS_LIST_LENGTH_LIMIT]
+        )
+        for tweet_id in tweet_ids:
+            fanout_newsfeeds_main_task.delay(tweet_id, user_id)
+        return len(tweet_ids)
+
+    @classmethod
+    def get_celebrity_ids(cls):
+        """
+        大 v 的 tweets 没有 newsfeed 记录，集合丢失 (redis 被清空或者切换) 的时候从 followers 数量重建，
+        否则 followers 在这些大 v 下一次发 tweet 之前都看不到他们的 tweets
+        重建完成的集合里有一个 0，用来区分没有大 v 和集合丢失
+        """
+        conn = RedisClient.get_connection('broker')
+        celebrity_ids = conn.smembers(CELEBRITY_USER_IDS_KEY)
+        if b'0' not in celebrity_ids:
+            celebrity_ids = FriendshipService.get_user_ids_with_followers(settings.NEWSFEED_CELEBRITY_THRESHOLD)
+            # 只有拿到锁的一个请求写回，其他请求直接用数据库的结果
+            if RedisHelper.acquire_fill_lock(CELEBRITY_USER_IDS_KEY):
+                conn.sadd(CELEBRITY_USER_IDS_KEY, 0, *celebrity_ids)
+        return {int(celebrity_id) for celebrity_id in celebrity_ids} - {0}
+
+    @classmethod
+    def get_followed_celebrity_ids(cls, user_id):
+        # 大 v 的数量很少，全部取出来和关注列表求交集
+        celebrity_ids = cls.get_celebrity_ids()
+        if not celebrity_ids:
+            return []
+        following_user_id_set = FriendshipService.get_following_user_id_set(user_id)
+        return [
+            celebrity_id
+            for celebrity_id in celebrity_ids
+            if celebrity_id in following_user_id_set
+        ]
+
+    @classmethod
+    def from_tweet(cls, user_id, tweet):
+        # 拉取到的 tweet 没有对应的 newsfeed 记录，用负的 tweet id 作为 id，不会和真正的 newsfeed 重复
+        return NewsFeed(id=-tweet.id, user_id=user_id, tweet_id=tweet.id, created_at=tweet.created_at)
+
+    @classmethod
+    def get_merged_newsfeeds_window(
+        cls, user_id, created_at__lt=None, created_at__gt=None, limit=None, ascending=False,
+    ):
+        """
+        被 push 的 newsfeeds 和关注的大 v 的 tweets 各自按 created_at 倒序 (ascending 的时候正序) 取出同一个窗口，
+        再用堆做 k 路归并，每一路最多读 limit 条
+        大 v 在成为大 v 之前被 push 过的 tweets 会出现在两路里，按 tweet_id 去重
+        """
+        # 正在撤回或者撤回之后又被 fanout 写进来的 tweets 还会在 cache 和数据库里，
+        # 按读出来的 tweet 的 has_deleted 过滤，不够 limit 的时候多读几条补上
+        limit = limit or settings.REDIS_LIST_LENGTH_LIMIT
+        read_limit = limit
+        while True:
+            merged = cls._merge_newsfeeds(user_id, created_at__lt, created_at__gt, read_limit, ascending)
+            visible = cls._filter_deleted_newsfeeds(merged)
+            if len(merged) < read_limit or len(visible) >= limit:
+                return visible[:limit]
+            read_limit += len(merged) - len(visible)
+
+    @classmethod
+    def _merge_newsfeeds(cls, user_id, created_at__lt, created_at__gt, limit, ascending):
+        newsfeeds = cls.get_newsfeeds_window(user_id, created_at__lt, created_at__gt, limit, ascending)
+        sources = [newsfeeds]
+        # 所有关注的大 v 的窗口一次 pipeline 读出来，cache 里没有的一条查询补齐
+        celebrity_ids = cls.get_followed_celebrity_ids(user_id)
+        windows = TweetService.get_tweets_windows(celebrity_ids, created_at__lt, created_at__gt, limit, ascending)
+        for celebrity_id in celebrity_ids:
+            sources.append([cls.from_tweet(user_id, tweet) for tweet in windows[celebrity_id]])
+
+        merged = []
+        seen_tweet_ids = set()
+        newsfeeds = heapq.merge(*sources, key=lambda newsfeed: newsfeed.created_at, reverse=not ascending)
+        for newsfeed in newsfeeds:
+            if newsfeed.tweet_id in seen_tweet_ids:
+                continue
+            seen_tweet_ids.add(newsfeed.tweet_id)
+            merged.append(newsfeed)
+            if limit is not None and len(merged) >= limit:
+                break
+        return merged
+
+    @classmethod
+    def _filter_deleted_newsfeeds(cls, newsfeeds):
+        # 一次 get_many 取出这一页的 tweets，顺便填好 cached_tweet，序列化的时候不用再读
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        visible = []
+        for newsfeed in newsfeeds:
+            tweet = tweets.get(newsfeed.tweet_id)
+            if tweet is None or tweet.has_deleted:
+                continue
+            newsfeed._cached_tweet = tweet
+            visible.append(newsfeed)
+        return visible
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
-        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, queryset)
+        RedisHelper.push_member(
+            key,
+            cls.to_member(newsfeed.id, newsfeed.tweet_id),
+            datetime_to_microseconds(newsfeed.created_at),
+            partial(rebuild_newsfeeds_cache_task.delay, newsfeed.user_id),
+        )
+
+    @classmethod
+    def bulk_insert_newsfeeds(cls, tweet_id, user_ids, created_at=None, batch_size=None, raw=None):
+        """
+        给一批用户写入同一条 tweet 的 newsfeed 记录，已经存在的 (user, tweet) 会被忽略，
+        task 重试或者重复执行都不会报错
+        raw 的时候不创建 NewsFeed 对象，直接拼多行的 INSERT IGNORE，每条 INSERT 最多 batch_size 行
+        """
+        if created_at is None:
+            created_at = utc_now()
+        if batch_size is None:
+            batch_size = settings.NEWSFEED_BULK_INSERT_BATCH_SIZE
+        if raw is None:
+            raw = settings.NEWSFEED_BULK_INSERT_RAW
+
+        if not raw:
+            NewsFeed.objects.bulk_create(
+                [
+                    NewsFeed(user_id=user_id, tweet_id=tweet_id, created_at=created_at)
+                    for user_id in user_ids
+                ],
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+            return
+
+        created_at = connection.ops.adapt_datetimefield_value(created_at)
+        sql = '{} {} ({}, {}, {}) VALUES {{}} {}'.format(
+            connection.ops.insert_statement(ignore_conflicts=True),
+            connection.ops.quote_name(NewsFeed._meta.db_table),
+            connection.ops.quote_name('user_id'),
+            connection.ops.quote_name('tweet_id'),
+            connection.ops.quote_name('created_at'),
+            connection.ops.ignore_conflicts_suffix_sql(ignore_conflicts=True),
+        )
+        with connection.cursor() as cursor:
+            for index in range(0, len(user_ids), batch_size):
+                batch_user_ids = user_ids[index:index + batch_size]
+                params = []
+                for user_id in batch_user_ids:
+                    params.extend((user_id, tweet_id, created_at))
+                cursor.execute(
+                    sql.format(', '.join(['(%s, %s, %s)'] * len(batch_user_ids))),
+                    params,
+                )
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        # fanout 的时候批量写入，只写已经在 cache 里的用户，其他用户读取的时候再重建
+        return RedisHelper.push_members([
+            (
+                USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id),
+                cls.to_member(newsfeed.id, newsfeed.tweet_id),
+                datetime_to_microseconds(newsfeed.created_at),
+            )
+            for newsfeed in newsfeeds
+        ])
+
+    @classmethod
+    def on_user_returned(cls, user_id, last_active_at):
+        # fanout 的时候跳过了这个用户的 newsfeed 记录，用关注的人这段时间里的 tweets 补上
+        if settings.NEWSFEED_SKIP_INACTIVE_ROWS:
+            backfill_newsfeeds_task.delay(user_id, last_active_at)
+
+    @classmethod
+    def backfill_newsfeeds(cls, user_id, since=None):
+        """
+        把关注的人 since 之后发的 tweets 补成 newsfeed 记录，最多 REDIS_LIST_LENGTH_LIMIT 条
+        已经存在的记录会被忽略，补完之后删掉 cache，下一次读取的时候重建
+        """
+        following_user_ids = FriendshipService.get_following_user_id_set(user_id)
+        queryset = Tweet.objects.filter(user_id__in=following_user_ids, has_deleted=False)
+        if since is not None:
+            queryset = queryset.filter(created_at__gt=microseconds_to_datetime(since * 10 ** 6))
+        tweet_ids = list(
+            queryset.order_by('-created_at')
+            .values_list('id', flat=True)[:settings.REDIS_LIST_LENGTH_LIMIT]
+        )
+        NewsFeed.objects.bulk_create(
+            [NewsFeed(user_id=user_id, tweet_id=tweet_id) for tweet_id in tweet_ids],
+            ignore_conflicts=True,
+        )
+        # bulk_create 会把 created_at 设成现在，改成 tweet 的时间，翻页的顺序才是对的
+        NewsFeed.objects.filter(user_id=user_id, tweet_id__in=tweet_ids).update(
+            created_at=Subquery(
+                Tweet.objects.filter(id=OuterRef('tweet_id')).values('created_at')[:1],
+            ),
+        )
+        RedisClient.get_connection().delete(USER_NEWSFEEDS_PATTERN.format(user_id=user_id))
+        return len(tweet_ids)
+
+    @classmethod
+    def rebuild_newsfeeds_cache(cls, user_id, token):
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        with CacheMetrics.measure_fill('redis', CacheMetrics.get_namespace(key)):
+            RedisHelper.fill_members(key, cls.load_newsfeed_members(user_id), token)
+
+
+# 已经在 bulk lane 里的 tweet (比如 main task 重试) 不会重复排队，也不会把进度重置
+ADD_BULK_TWEET_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[2], 'user_id', ARGV[2], 'min_id', '')
+redis.call('LPUSH', KEYS[1], ARGV[1])
+return 1
+"""
+
+# min_id 还是读出来的值才能前进，两个 worker 转到同一条 tweet 的时候只有一个能记下这个 batch
+# 新的 min_id 是空字符串表示最后一段已经做完，从列表里删掉
+ADVANCE_BULK_TWEET_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'min_id') ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] == '' then
+    redis.call('DEL', KEYS[2])
+    redis.call('LREM', KEYS[1], 0, ARGV[1])
+else
+    redis.call('HSET', KEYS[2], 'min_id', ARGV[3])
+end
+return 1
+"""
+
+
+class FanoutLaneService(object):
+    """
+    followers 少的 tweets 走 fast lane，一次把所有 batch 都放进队列
+    followers 多的 tweets 走 bulk lane，正在 fanout 的 tweets 在 redis 的一个列表里排队，
+    每个 batch 先用 RPOPLPUSH 把队尾的 tweet 原子地转到队头再处理，全部做完才从列表里删掉，
+    多条 tweets 轮流前进，不会一条做完再做下一条，worker 中途挂掉也不会把 tweet 弄丢
+    """
+
+    script = None
+    advance_script = None
+
+    @classmethod
+    def add_bulk_tweet(cls, tweet_id, tweet_user_id):
+        conn = RedisClient.get_connection('broker')
+        if cls.script is None:
+            cls.script = conn.register_script(ADD_BULK_TWEET_SCRIPT)
+        return bool(cls.script(
+            keys=[FANOUT_BULK_TWEETS_KEY, FANOUT_BULK_TWEET_PATTERN.format(tweet_id=tweet_id)],
+            args=[tweet_id, tweet_user_id],
+            client=conn,
+        ))
+
+    @classmethod
+    def run_bulk_batch(cls):
+        """
+        处理轮到的 tweet 的下一个 batch，返回 (tweet_id, 是否还有剩下的 batch)
+        没有正在 fanout 的 tweets 时返回 None
+        """
+        conn = RedisClient.get_connection('broker')
+        tweet_id = conn.rpoplpush(FANOUT_BULK_TWEETS_KEY, FANOUT_BULK_TWEETS_KEY)
+        if tweet_id is None:
+            return None
+        tweet_id = int(tweet_id)
+        state_key = FANOUT_BULK_TWEET_PATTERN.format(tweet_id=tweet_id)
+        tweet_user_id, min_id = conn.hmget(state_key, ['user_id', 'min_id'])
+        if tweet_user_id is None:
+            conn.lrem(FANOUT_BULK_TWEETS_KEY, 0, tweet_id)
+            return tweet_id, False
+        tweet_user_id = int(tweet_user_id)
+        # 原样保留读出来的 min_id，前进的时候用来比较
+        min_id = min_id.decode()
+        start_id = int(min_id) if min_id else None
+
+        # 出错的时候 tweet 还在列表里，min_id 也没有前进，重试的时候从同一个位置继续
+        max_id = FriendshipService.get_follower_id_range_end(tweet_user_id, start_id, FANOUT_BATCH_SIZE)
+        count = NewsFeedService.fanout_batch(tweet_id, tweet_user_id, start_id, max_id, FANOUT_BULK_LANE)
+
+        # 最后一段或者 tweet 已经被删除了
+        finished = max_id is None or count is None
+        if not cls._advance(tweet_id, min_id, '' if finished else max_id):
+            # 别的 worker 已经做完了这一段，写入是幂等的，只是不再重复计数
+            return tweet_id, True
+        FanoutJobService.record_batch(tweet_id, count or 0)
+        if finished:
+            FanoutJobService.seal(tweet_id)
+            return tweet_id, False
+        return tweet_id, True
+
+    @classmethod
+    def _advance(cls, tweet_id, min_id, next_min_id):
+        conn = RedisClient.get_connection('broker')
+        if cls.advance_script is None:
+            cls.advance_script = conn.register_script(ADVANCE_BULK_TWEET_SCRIPT)
+        return bool(cls.advance_script(
+            keys=[FANOUT_BULK_TWEETS_KEY, FANOUT_BULK_TWEET_PATTERN.format(tweet_id=tweet_id)],
+            args=[tweet_id, min_id, next_min_id],
+            client=conn,
+        ))
+
+    @classmethod
+    def record_lag(cls, lane, created_at):
+        # 从发 tweet 到这一批 followers 能看到的时间，每个 lane 只保留最近的一部分
+        lag = time.time() - created_at.timestamp()
+        key = FANOUT_LANE_LAG_PATTERN.format(lane=lane)
+        pipe = RedisClient.get_connection('broker').pipeline(transaction=False)
+        pipe.lpush(key, lag)
+        pipe.ltrim(key, 0, settings.NEWSFEED_LANE_LAG_SAMPLES - 1)
+        pipe.execute()
+
+    @classmethod
+    def get_queue_depth(cls, lane):
+        # celery 队列里还没有被执行的 task 数量，broker 连不上的时候返回 None
+        from core.celery import app
+        try:
+            with app.connection_or_acquire() as connection:
+                connection.ensure_connection(max_retries=1)
+                return connection.default_channel.queue_declare(
+                    queue=lane,
+                    passive=True,
+                ).message_count
+        except Exception:
+            return None
+
+    @classmethod
+    def get_lane_stats(cls):
+        conn = RedisClient.get_connection('broker')
+        stats = {}
+        for lane in FANOUT_LANES:
+            lags = sorted(
+                float(lag)
+                for lag in conn.lrange(FANOUT_LANE_LAG_PATTERN.format(lane=lane), 0, -1)
+            )
+            stats[lane] = {
+                'queue_depth': cls.get_queue_depth(lane),
+                'lag_samples': len(lags),
+                'lag_p50': _percentile(lags, 50),
+                'lag_p99': _percentile(lags, 99),
+                'lag_max': lags[-1] if lags else None,
+            }
+        stats[FANOUT_BULK_LANE]['pending_tweets'] = conn.llen(FANOUT_BULK_TWEETS_KEY)
+        return stats
+
+
+
+# 一个 batch 结束（或者 fanout 已经全部排进队列）的时候更新 job
+# 全部排进队列并且每个 batch 都结束了，就记录结束时间和耗时，返回 1
+UPDATE_FANOUT_JOB_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[1] ~= '' then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+end
+redis.call('HINCRBY', KEYS[1], 'newsfeeds', ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[1], 'planned', ARGV[3], 'sealed', 1)
+end
+local job = redis.call('HMGET', KEYS[1], 'sealed', 'planned', 'completed', 'failed', 'started_at', 'finished_at')
+if job[1] ~= '1' or job[6] then
+    return 0
+end
+if tonumber(job[3]) + tonumber(job[4]) < tonumber(job[2]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'finished_at', ARGV[4])
+redis.call('ZREM', KEYS[2], ARGV[5])
+redis.call('LPUSH', KEYS[3], tostring(tonumber(ARGV[4]) - tonumber(job[5])))
+redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[6]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+return 1
+"""
+
+
+# main task 重试的时候 job 已经存在，不能把已经记下的 batch 清零
+START_FANOUT_JOB_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1],
+    'tweet_id', ARGV[1], 'user_id', ARGV[2], 'lane', ARGV[3],
+    'planned', 0, 'completed', 0, 'failed', 0, 'newsfeeds', 0, 'started_at', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+return 1
+"""
+
+
+class FanoutJobService(object):
+    """
+    每条 tweet 的 fanout 在 redis 里有一个 job: 计划多少个 batch，完成和失败了多少个，开始和结束的时间
+    batch 可能在 main task 还没把所有 batch 排进队列的时候就完成了，所以排完之后才 seal，
+    seal 之后完成和失败的数量加起来等于计划的数量，job 才算结束
+    """
+
+    script = None
+    start_script = None
+
+    @classmethod
+    def _get_key(cls, tweet_id):
+        return FANOUT_JOB_PATTERN.format(tweet_id=tweet_id)
+
+    @classmethod
+    def start_job(cls, tweet_id, tweet_user_id, lane):
+        # 已经有 job 的时候返回 False，保留原来的进度
+        conn = RedisClient.get_connection('broker')
+        if cls.start_script is None:
+            cls.start_script = conn.register_script(START_FANOUT_JOB_SCRIPT)
+        return bool(cls.start_script(
+            keys=[cls._get_key(tweet_id), FANOUT_JOBS_IN_FLIGHT_KEY],
+            args=[tweet_id, tweet_user_id, lane, time.time(), settings.NEWSFEED_FANOUT_JOB_TIMEOUT],
+            client=conn,
+        ))
+
+    @classmethod
+    def seal(cls, tweet_id, planned=None):
+        """
+        所有的 batch 都已经排进队列了，planned 是 None 的时候用已经结束的 batch 数量，
+        bulk lane 的 batch 一个接一个执行，最后一个 batch 结束之后才 seal
+        """
+        if planned is None:
+            completed, failed = RedisClient.get_connection('broker').hmget(
+                cls._get_key(tweet_id),
+                ['completed', 'failed'],
+            )
+            planned = int(completed or 0) + int(failed or 0)
+        cls._update(tweet_id, '', 0, planned)
+
+    @classmethod
+    def record_batch(cls, tweet_id, newsfeeds_count, failed=False):
+        cls._update(tweet_id, 'failed' if failed else 'completed', newsfeeds_count, '')
+
+    @classmethod
+    def _update(cls, tweet_id, field, newsfeeds_count, planned):
+        conn = RedisClient.get_connection('broker')
+        if cls.script is None:
+            cls.script = conn.register_script(UPDATE_FANOUT_JOB_SCRIPT)
+        finished = cls.script(
+            keys=[cls._get_key(tweet_id), FANOUT_JOBS_IN_FLIGHT_KEY, FANOUT_JOB_DURATIONS_KEY],
+            args=[
+                field,
+                newsfeeds_count,
+                planned,
+                time.time(),
+                tweet_id,
+                settings.NEWSFEED_LANE_LAG_SAMPLES,
+                settings.NEWSFEED_FANOUT_JOB_TIMEOUT,
+            ],
+            client=conn,
+        )
+        if finished and settings.NEWSFEED_FANOUT_CALLBACK:
+            # 和 celery chord 的 callback 一样，所有 batch 都结束之后执行一次
+            current_app.signature(settings.NEWSFEED_FANOUT_CALLBACK, args=(tweet_id,)).delay()
+
+    @classmethod
+    def get_job(cls, tweet_id):
+        job = RedisClient.get_connection('broker').hgetall(cls._get_key(tweet_id))
+        return _decode_job(job) if job else None
+
+    @classmethod
+    def get_in_flight_jobs(cls):
+        conn = RedisClient.get_connection('broker')
+        tweet_ids = conn.zrange(FANOUT_JOBS_IN_FLIGHT_KEY, 0, -1)
+        pipe = conn.pipeline(transaction=False)
+        for tweet_id in tweet_ids:
+            pipe.hgetall(cls._get_key(int(tweet_id)))
+        return [_decode_job(job) for job in pipe.execute() if job]
+
+    @classmethod
+    def get_duration_percentiles(cls, percents=(50, 90, 99)):
+        durations = sorted(
+            float(duration)
+            for duration in RedisClient.get_connection('broker').lrange(FANOUT_JOB_DURATIONS_KEY, 0, -1)
+        )
+        percentiles = {
+            'p{}'.format(percent): _percentile(durations, percent)
+            for percent in percents
+        }
+        percentiles['max'] = durations[-1] if durations else None
+        percentiles['samples'] = len(durations)
+        return percentiles
+
+
+def _decode_job(job):
+    job = {key.decode('utf-8'): value.decode('utf-8') for key, value in job.items()}
+    for field in ('tweet_id', 'user_id', 'planned', 'completed', 'failed', 'newsfeeds', 'sealed'):
+        job[field] = int(job.get(field, 0))
+    for field in ('started_at', 'finished_at'):
+        job[field] = float(job[field]) if field in job else None
+    return job
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
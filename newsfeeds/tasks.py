@@ -1,42 +1,130 @@
-from newsfeeds.constants import FANOUT_BATCH_SIZE
-from celery import shared_task
+from newsfeeds.constants import FANOUT_BATCH_SIZE, FANOUT_BULK_LANE, FANOUT_FAST_LANE
+from celery import Task, shared_task
+from django.conf import settings
+from django.db import DatabaseError
 from friendships.services import FriendshipService
 from .models import NewsFeed
-from tweets.models import Tweet
+from redis import RedisError
 from utils.time_constants import ONE_HOUR
 
-@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
-    from newsfeeds.services import NewsFeedService
+# fanout 的写入都可以重复执行，执行完才 ack，数据库或者 redis 出错的时候自动重试
+FANOUT_TASK_OPTIONS = {
+    'acks_late': True,
+    'autoretry_for': (DatabaseError, RedisError),
+    'retry_backoff': True,
+    'max_retries': 5,
+    'time_limit': ONE_HOUR,
+}
 
-    # tweet = Tweet.objects.get(id=tweet_id)
-    newsfeeds = [
-        NewsFeed(user_id=follower_id, tweet_id=tweet_id)
-        for follower_id in follower_ids
-    ]
 
-    print('created newsfeeeeeeds: ', newsfeeds)
-    # newsfeeds.append(NewsFeed(user=tweet.user, tweet=tweet))
-    NewsFeed.objects.bulk_create(newsfeeds)
+class FanoutBatchTask(Task):
 
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        # 重试用完了还是失败，记到 fanout job 里
+        from newsfeeds.services import FanoutJobService
+        FanoutJobService.record_batch(args[0], 0, failed=True)
 
-    return "{} newsfeeds created".format(len(newsfeeds))
 
-@shared_task(routing_key='default', time_limit=ONE_HOUR)
+@shared_task(base=FanoutBatchTask, routing_key=FANOUT_FAST_LANE, **FANOUT_TASK_OPTIONS)
+def fanout_newsfeeds_batch_task(tweet_id, tweet_user_id, min_id, max_id, lane=FANOUT_FAST_LANE):
+    from newsfeeds.services import FanoutJobService, NewsFeedService
+
+    count = NewsFeedService.fanout_batch(tweet_id, tweet_user_id, min_id, max_id, lane)
+    FanoutJobService.record_batch(tweet_id, count or 0)
+    if count is None:
+        return 'tweet {} has been deleted'.format(tweet_id)
+    return "{} newsfeeds created".format(count)
+
+
+@shared_task(routing_key=FANOUT_BULK_LANE, **FANOUT_TASK_OPTIONS)
+def fanout_bulk_lane_task():
+    from newsfeeds.services import FanoutLaneService
+
+    # bulk lane 里每个 task 只处理排在最前面的那条 tweet 的一个 batch，处理完排到队尾
+    # 队列里的 task 数量和正在 fanout 的 tweets 数量一样，多条 tweets 轮流前进
+    result = FanoutLaneService.run_bulk_batch()
+    if result is None:
+        return 'bulk lane is empty'
+    tweet_id, has_more = result
+    if has_more:
+        fanout_bulk_lane_task.apply_async(queue=FANOUT_BULK_LANE, routing_key=FANOUT_BULK_LANE)
+        return 'one batch of tweet {} fanned out'.format(tweet_id)
+    return 'tweet {} fanned out'.format(tweet_id)
+
+
+@shared_task(routing_key='default', **FANOUT_TASK_OPTIONS)
 def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
-    NewsFeed.objects.create(user_id=tweet_user_id, tweet_id=tweet_id)
+    from newsfeeds.services import FanoutJobService, NewsFeedService
+
+    NewsFeed.objects.get_or_create(user_id=tweet_user_id, tweet_id=tweet_id)
+
+    # 大 v 的 tweets 由 followers 读取的时候自己拉取
+    followers_count = FriendshipService.get_followers_count(tweet_user_id)
+    if NewsFeedService.update_celebrity(tweet_user_id, followers_count):
+        return '{} followers, fanout skipped for celebrity {}.'.format(
+            followers_count,
+            tweet_user_id,
+        )
+
+    # followers 多的用户放到 bulk lane 里和其他大用户轮流 fanout，不占用普通用户的队列
+    if followers_count >= settings.NEWSFEED_BULK_LANE_THRESHOLD:
+        from newsfeeds.services import FanoutLaneService
+        FanoutJobService.start_job(tweet_id, tweet_user_id, FANOUT_BULK_LANE)
+        # 重试的时候 tweet 已经在排队了，再多一个 bulk task 只会和已有的 task 抢同一条 tweet
+        if not FanoutLaneService.add_bulk_tweet(tweet_id, tweet_user_id):
+            return 'fanout of tweet {} already started'.format(tweet_id)
+        fanout_bulk_lane_task.apply_async(queue=FANOUT_BULK_LANE, routing_key=FANOUT_BULK_LANE)
+        return '{} newsfeeds going to fanout in bulk lane.'.format(followers_count)
 
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    # print('follower_ids: ', follower_ids)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index+FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    # 只按 id 切分范围，不把 follower ids 读到内存里，内存占用和 followers 的数量无关
+    # main task 重试的时候 job 已经存在，batches 已经排进队列了，不再重复排
+    if not FanoutJobService.start_job(tweet_id, tweet_user_id, FANOUT_FAST_LANE):
+        return 'fanout of tweet {} already started'.format(tweet_id)
+    batches_count = 0
+    ranges = FriendshipService.iter_follower_id_ranges(tweet_user_id, FANOUT_BATCH_SIZE)
+    for min_id, max_id in ranges:
+        fanout_newsfeeds_batch_task.apply_async(
+            args=(tweet_id, tweet_user_id, min_id, max_id),
+            queue=FANOUT_FAST_LANE,
+            routing_key=FANOUT_FAST_LANE,
+        )
+        batches_count += 1
+    FanoutJobService.seal(tweet_id, batches_count)
 
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids)-1) // FANOUT_BATCH_SIZE + 1,
-    )
\ No newline at end of file
+        followers_count,
+        batches_count,
+    )
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def backfill_newsfeeds_task(user_id, since):
+    from newsfeeds.services import NewsFeedService
+    count = NewsFeedService.backfill_newsfeeds(user_id, since)
+    return '{} newsfeeds of user {} backfilled'.format(count, user_id)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def fanout_demoted_celebrity_task(user_id):
+    from newsfeeds.services import NewsFeedService
+    count = NewsFeedService.fanout_demoted_celebrity(user_id)
+    return '{} tweets of user {} going to fanout'.format(count, user_id)
+
+
+@shared_task(routing_key=FANOUT_FAST_LANE, **FANOUT_TASK_OPTIONS)
+def retract_tweet_task(tweet_id, min_id=None):
+    from newsfeeds.services import NewsFeedService
+
+    # 每个 task 只撤回一批，再带着 cursor 把下一批交给新的 task
+    last_id = NewsFeedService.retract_newsfeeds_batch(tweet_id, min_id)
+    if last_id is not None:
+        retract_tweet_task.delay(tweet_id, last_id)
+        return 'tweet {} retracted up to newsfeed {}'.format(tweet_id, last_id)
+    return 'tweet {} retracted'.format(tweet_id)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def rebuild_newsfeeds_cache_task(user_id, token):
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.rebuild_newsfeeds_cache(user_id, token)
+    return 'newsfeeds cache of user {} rebuilt'.format(user_id)
@@ -1,16 +1,31 @@
+from accounts.services import UserService
+from celery import shared_task
 from core.cache import USER_NEWSFEEDS_PATTERN
 from testing.testcases import TestCase
 from newsfeeds.models import NewsFeed
+from tweets.models import Tweet
 from friendships.models import Friendships
 from rest_framework.test import APIClient
 from rest_framework import status
 from utils.paginations import EndlessPagination
-from .services import NewsFeedService
+from .services import FanoutJobService, FanoutLaneService, NewsFeedService
 from utils.redis_client import RedisClient
 from django.conf import settings
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from .tasks import fanout_newsfeeds_main_task
 
 
+# fanout 结束的 callback 收到的 tweet ids
+finished_fanout_tweet_ids = []
+
+
+@shared_task
+def record_finished_fanout(tweet_id):
+    finished_fanout_tweet_ids.append(tweet_id)
+
+
 NEWSFEEDS_URL = '/api/newsfeeds/'
 POST_TWEETS_URL = '/api/tweets/'
 FOLLOW_URL = '/api/friendships/{}/follow/'
@@ -103,6 +118,18 @@ class NewsFeedApiTest(TestCase):
             newsfeeds[2 * page_size - 1].id,
         )
 
+        # next_cursor 和 created_at__lt 取到的是同一页
+        response = self.alex_client.get(NEWSFEEDS_URL)
+        response = self.alex_client.get(
+            NEWSFEEDS_URL,
+            {'cursor': response.data['next_cursor']},
+        )
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [newsfeed['id'] for newsfeed in response.data['results']],
+            [newsfeed.id for newsfeed in newsfeeds[page_size:]],
+        )
+
         # pull latest newsfeeds
         response = self.alex_client.get(
             NEWSFEEDS_URL,
@@ -221,6 +248,47 @@ class NewsfeedServiceTests(TestCase):
         self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
 
 
+    def test_newsfeeds_cached_as_ids(self):
+        tweet = self.create_tweet(self.bob)
+        newsfeed = self.create_newsfeed(self.alex, tweet)
+
+        conn = RedisClient.get_connection()
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.alex.id)
+        self.assertEqual(
+            conn.zrange(key, 0, -1),
+            ['{}:{}'.format(newsfeed.id, tweet.id).encode('utf-8')],
+        )
+
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.alex.id)
+        self.assertEqual(newsfeeds[0].id, newsfeed.id)
+        self.assertEqual(newsfeeds[0].user_id, self.alex.id)
+        self.assertEqual(newsfeeds[0].created_at, newsfeed.created_at)
+        self.assertEqual(newsfeeds[0].cached_tweet(), tweet)
+
+    def test_list_queries_do_not_grow_with_page_size(self):
+        def count_list_queries():
+            self.clear_cache()
+            with CaptureQueriesContext(connection) as context:
+                response = self.alex_client.get(NEWSFEEDS_URL)
+            return len(response.data['results']), len(context.captured_queries)
+
+        tweet = self.create_tweet(self.bob)
+        self.create_newsfeed(self.alex, tweet)
+        self.create_like(self.alex, tweet)
+        small_page = count_list_queries()
+
+        for i in range(9):
+            user = self.create_user('user{}'.format(i))
+            tweet = self.create_tweet(user)
+            self.create_newsfeed(self.alex, tweet)
+            self.create_like(user, tweet)
+            self.create_comment(user, tweet)
+        large_page = count_list_queries()
+
+        # 每种数据只批量读取一次，查询次数和这一页有多少条 newsfeeds 无关
+        self.assertEqual((small_page[0], large_page[0]), (1, 10))
+        self.assertEqual(small_page[1], large_page[1])
+
     def _paginate_to_get_newsfeeds(self, client):
         # paginate until the end
         res = client.get(NEWSFEEDS_URL)
@@ -308,4 +376,299 @@ class NewsfeedTaskTests(TestCase):
         cached_list = NewsFeedService.get_cached_newsfeeds(self.alex.id)
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.bob.id)
-        self.assertEqual(len(cached_list), 3)
\ No newline at end of file
+        self.assertEqual(len(cached_list), 3)
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=2)
+    def test_celebrity_tweets_are_pulled(self):
+        self.create_friendships(self.bob, self.alex)
+        tweet1 = self.create_tweet(self.alex, 'before celebrity')
+        fanout_newsfeeds_main_task(tweet1.id, self.alex.id)
+        self.assertEqual(NewsFeed.objects.filter(user=self.bob).count(), 1)
+
+        # 超过阈值之后不再 fanout
+        self.create_friendships(self.create_user('charlie'), self.alex)
+        tweet2 = self.create_tweet(self.alex, 'after celebrity')
+        msg = fanout_newsfeeds_main_task(tweet2.id, self.alex.id)
+        self.assertEqual(msg, '2 followers, fanout skipped for celebrity {}.'.format(self.alex.id))
+        self.assertEqual(NewsFeed.objects.filter(user=self.bob).count(), 1)
+        self.assertEqual(NewsFeedService.get_followed_celebrity_ids(self.bob.id), [self.alex.id])
+
+        # 大 v 的集合丢失之后从 followers 数量重建
+        self.clear_cache()
+        self.assertEqual(NewsFeedService.get_followed_celebrity_ids(self.bob.id), [self.alex.id])
+        self.clear_cache()
+        NewsFeedService.update_celebrity(self.bob.id, 0)
+        self.assertEqual(NewsFeedService.get_celebrity_ids(), {self.alex.id})
+
+        # 读取的时候合并 push 的 newsfeeds 和大 v 的 tweets，按时间倒序并且去重
+        dave = self.create_user('dave')
+        self.create_friendships(self.bob, dave)
+        tweet3 = self.create_tweet(dave, 'normal user')
+        fanout_newsfeeds_main_task(tweet3.id, dave.id)
+        newsfeeds = NewsFeedService.get_merged_newsfeeds_window(self.bob.id, limit=10)
+        self.assertEqual(
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+            [tweet3.id, tweet2.id, tweet1.id],
+        )
+        newsfeeds = NewsFeedService.get_merged_newsfeeds_window(self.bob.id, limit=2)
+        self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweet3.id, tweet2.id])
+
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        response = client.get(NEWSFEEDS_URL, {'created_at__lt': newsfeeds[0].created_at})
+        self.assertEqual(
+            [newsfeed['tweet']['id'] for newsfeed in response.data['results']],
+            [tweet2.id, tweet1.id],
+        )
+        # 拉取的 newsfeed 也有一个固定的 id
+        self.assertEqual(response.data['results'][0]['id'], -tweet2.id)
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=1)
+    def test_celebrity_windows_are_batched(self):
+        celebrities = [self.create_user('celebrity{}'.format(i)) for i in range(3)]
+        tweets = []
+        for celebrity in celebrities:
+            self.create_friendships(self.bob, celebrity)
+            tweets.append(self.create_tweet(celebrity))
+            fanout_newsfeeds_main_task(tweets[-1].id, celebrity.id)
+
+        # cache 里都没有的时候，所有大 v 的 tweets 一条查询读出来
+        self.clear_cache()
+        with CaptureQueriesContext(connection) as captured:
+            newsfeeds = NewsFeedService.get_merged_newsfeeds_window(self.bob.id, limit=10)
+        self.assertEqual(
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+            [tweet.id for tweet in reversed(tweets)],
+        )
+        window_queries = [q for q in captured.captured_queries if 'ROW_NUMBER' in q['sql']]
+        self.assertEqual(len(window_queries), 1)
+
+        # cache 重建之后不再查数据库
+        with CaptureQueriesContext(connection) as captured:
+            newsfeeds = NewsFeedService.get_merged_newsfeeds_window(self.bob.id, limit=2)
+        self.assertEqual(
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+            [tweets[2].id, tweets[1].id],
+        )
+        self.assertFalse([q for q in captured.captured_queries if 'tweets_tweet' in q['sql']])
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=2)
+    def test_demoted_celebrity_tweets_are_fanned_out(self):
+        charlie = self.create_user('charlie')
+        self.create_friendships(self.bob, self.alex)
+        self.create_friendships(charlie, self.alex)
+        tweet1 = self.create_tweet(self.alex, 'as celebrity')
+        fanout_newsfeeds_main_task(tweet1.id, self.alex.id)
+        self.assertFalse(NewsFeed.objects.filter(user=self.bob).exists())
+
+        # 掉出大 v 之后，之前没有 fanout 的 tweets 补写进 followers 的 newsfeeds
+        dave = self.create_user('dave')
+        self.create_friendships(self.bob, dave)
+        tweet2 = self.create_tweet(dave, 'normal user')
+        fanout_newsfeeds_main_task(tweet2.id, dave.id)
+        Friendships.objects.filter(from_user=charlie, to_user=self.alex).delete()
+        tweet3 = self.create_tweet(self.alex, 'not a celebrity any more')
+        fanout_newsfeeds_main_task(tweet3.id, self.alex.id)
+        self.assertEqual(NewsFeedService.get_followed_celebrity_ids(self.bob.id), [])
+        newsfeeds = NewsFeedService.get_merged_newsfeeds_window(self.bob.id, limit=10)
+        self.assertEqual(
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+            [tweet3.id, tweet2.id, tweet1.id],
+        )
+        self.assertTrue(all(newsfeed.id > 0 for newsfeed in newsfeeds))
+
+    def test_batch_push_skips_cold_keys(self):
+        # bob 的 newsfeeds 已经在 cache 里，charlie 的不在
+        charlie = self.create_user('charlie')
+        old_tweet = self.create_tweet(self.alex)
+        self.create_newsfeed(self.bob, old_tweet)
+        NewsFeedService.get_cached_newsfeeds(self.bob.id)
+
+        # bulk_create 不会触发 post_save，只通过批量接口写 cache
+        tweet = self.create_tweet(self.alex)
+        NewsFeed.objects.bulk_create([
+            NewsFeed(user=user, tweet=tweet)
+            for user in (self.bob, charlie)
+        ])
+        newsfeeds = NewsFeed.objects.filter(tweet=tweet)
+        self.assertEqual(NewsFeedService.push_newsfeeds_to_cache(newsfeeds), 1)
+
+        conn = RedisClient.get_connection()
+        charlie_key = USER_NEWSFEEDS_PATTERN.format(user_id=charlie.id)
+        self.assertFalse(conn.exists(charlie_key))
+        self.assertFalse(conn.exists('{}:filling'.format(charlie_key)))
+        cached_list = NewsFeedService.get_cached_newsfeeds_window(self.bob.id)
+        self.assertEqual(
+            [newsfeed.tweet_id for newsfeed in cached_list],
+            [tweet.id, old_tweet.id],
+        )
+
+    @override_settings(NEWSFEED_ACTIVITY_AWARE_FANOUT=True)
+    def test_fanout_skips_inactive_followers(self):
+        charlie = self.create_user('charlie')
+        for user in (self.bob, charlie):
+            self.create_friendships(user, self.alex)
+            self.create_newsfeed(user, self.create_tweet(self.alex))
+            NewsFeedService.get_cached_newsfeeds(user.id)
+        # 只有 bob 最近活跃过
+        self.assertIsNone(UserService.touch_last_active(self.bob.id))
+        self.assertEqual(UserService.get_active_user_ids([self.bob.id, charlie.id]), {self.bob.id})
+
+        tweet = self.create_tweet(self.alex)
+        fanout_newsfeeds_main_task(tweet.id, self.alex.id)
+        # 数据库里的记录都写了，cache 只写了活跃的用户
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 3)
+        self.assertEqual(NewsFeedService.get_cached_newsfeeds_window(self.bob.id)[0].tweet_id, tweet.id)
+        self.assertNotEqual(NewsFeedService.get_cached_newsfeeds_window(charlie.id)[0].tweet_id, tweet.id)
+
+        # 连记录也不写的话，用户回来的时候用关注的人的 tweets 补上
+        with self.settings(NEWSFEED_SKIP_INACTIVE_ROWS=True):
+            tweet = self.create_tweet(self.alex)
+            fanout_newsfeeds_main_task(tweet.id, self.alex.id)
+            self.assertFalse(NewsFeed.objects.filter(tweet=tweet, user=charlie).exists())
+            self.assertTrue(NewsFeed.objects.filter(tweet=tweet, user=self.bob).exists())
+
+            NewsFeedService.on_user_returned(charlie.id, None)
+        newsfeed = NewsFeed.objects.get(tweet=tweet, user=charlie)
+        self.assertEqual(newsfeed.created_at, tweet.created_at)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(charlie.id)
+        self.assertEqual(newsfeeds[0].tweet_id, tweet.id)
+
+    def test_fanout_batch_task_is_idempotent(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(5)]
+        for user in users:
+            self.create_friendships(user, self.alex)
+        tweet = self.create_tweet(self.alex)
+
+        for raw in (True, False):
+            NewsFeed.objects.filter(tweet=tweet).delete()
+            user_ids = [user.id for user in users]
+            NewsFeedService.bulk_insert_newsfeeds(tweet.id, user_ids[:3], batch_size=2, raw=raw)
+            NewsFeedService.bulk_insert_newsfeeds(tweet.id, user_ids, batch_size=2, raw=raw)
+            self.assertEqual(
+                sorted(NewsFeed.objects.filter(tweet=tweet).values_list('user_id', flat=True)),
+                user_ids,
+            )
+
+        # task 重试的时候已经写过的记录会被忽略
+        fanout_newsfeeds_main_task(tweet.id, self.alex.id)
+        fanout_newsfeeds_main_task(tweet.id, self.alex.id)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 6)
+
+    def test_fanout_batch_after_retraction(self):
+        for i in range(3):
+            self.create_friendships(self.create_user('follower{}'.format(i)), self.alex)
+        tweet = self.create_tweet(self.alex)
+
+        # 开始的时候 tweet 还在，写入 newsfeeds 的同时 tweet 被删除并且撤回已经做完了
+        def delete_after_insert(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            if sql.startswith('INSERT') and 'newsfeeds_newsfeed' in sql:
+                Tweet.objects.filter(id=tweet.id).update(has_deleted=True)
+            return result
+
+        with connection.execute_wrapper(delete_after_insert):
+            count = NewsFeedService.fanout_batch(tweet.id, self.alex.id, None, None, 'newsfeeds')
+        self.assertIsNone(count)
+        self.assertFalse(NewsFeed.objects.filter(tweet=tweet).exists())
+
+    @override_settings(NEWSFEED_BULK_LANE_THRESHOLD=4)
+    def test_bulk_lane_round_robin(self):
+        for i in range(7):
+            self.create_friendships(self.create_user('alex_follower{}'.format(i)), self.alex)
+        for i in range(4):
+            self.create_friendships(self.create_user('bob_follower{}'.format(i)), self.bob)
+        alex_tweet = self.create_tweet(self.alex)
+        bob_tweet = self.create_tweet(self.bob)
+
+        # 两条 tweets 轮流处理，每次一个 batch
+        self.assertTrue(FanoutLaneService.add_bulk_tweet(alex_tweet.id, self.alex.id))
+        self.assertTrue(FanoutLaneService.add_bulk_tweet(bob_tweet.id, self.bob.id))
+        # 已经在排队的 tweet 不会重复排队
+        self.assertFalse(FanoutLaneService.add_bulk_tweet(alex_tweet.id, self.alex.id))
+        processed = []
+        while True:
+            result = FanoutLaneService.run_bulk_batch()
+            if result is None:
+                break
+            processed.append(result)
+        self.assertEqual(processed, [
+            (alex_tweet.id, True),
+            (bob_tweet.id, True),
+            (alex_tweet.id, True),
+            (bob_tweet.id, False),
+            (alex_tweet.id, False),
+        ])
+        self.assertEqual(NewsFeed.objects.filter(tweet=alex_tweet).count(), 7)
+        self.assertEqual(NewsFeed.objects.filter(tweet=bob_tweet).count(), 4)
+
+        stats = FanoutLaneService.get_lane_stats()['newsfeeds_bulk']
+        self.assertEqual(stats['lag_samples'], 5)
+        self.assertEqual(stats['pending_tweets'], 0)
+        self.assertGreaterEqual(stats['lag_p99'], stats['lag_p50'])
+
+        # 超过阈值的用户通过 main task 进入 bulk lane，不超过的还是走 fast lane
+        tweet = self.create_tweet(self.bob)
+        msg = fanout_newsfeeds_main_task(tweet.id, self.bob.id)
+        self.assertEqual(msg, '4 newsfeeds going to fanout in bulk lane.')
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 5)
+        # 只有成功的 batch 才计入 planned，最后一个 batch 结束之后 job 就结束了
+        job = FanoutJobService.get_job(tweet.id)
+        self.assertEqual((job['planned'], job['completed'], job['failed']), (2, 2, 0))
+        self.assertIsNotNone(job['finished_at'])
+
+        # 两个 worker 读到同一个 min_id，只有先做完的那个能前进，min_id 不会倒退
+        tweet = self.create_tweet(self.bob)
+        FanoutLaneService.add_bulk_tweet(tweet.id, self.bob.id)
+        self.assertTrue(FanoutLaneService._advance(tweet.id, '', 5))
+        self.assertFalse(FanoutLaneService._advance(tweet.id, '', 3))
+        self.assertTrue(FanoutLaneService._advance(tweet.id, '5', ''))
+        self.assertEqual(FanoutLaneService.get_lane_stats()['newsfeeds_bulk']['pending_tweets'], 0)
+
+        tweet = self.create_tweet(self.create_user('charlie'))
+        msg = fanout_newsfeeds_main_task(tweet.id, tweet.user_id)
+        self.assertEqual(msg, '0 newsfeeds going to fanout, 0 batches created.')
+
+    @override_settings(NEWSFEED_FANOUT_CALLBACK='newsfeeds.tests.record_finished_fanout')
+    def test_fanout_job_tracking(self):
+        del finished_fanout_tweet_ids[:]
+        for i in range(7):
+            self.create_friendships(self.create_user('follower{}'.format(i)), self.alex)
+        tweet = self.create_tweet(self.alex)
+
+        # 8 条 newsfeeds (7 个 followers 和自己)，每个 batch 3 个 followers
+        fanout_newsfeeds_main_task(tweet.id, self.alex.id)
+        job = FanoutJobService.get_job(tweet.id)
+        self.assertEqual(job['lane'], 'newsfeeds')
+        self.assertEqual(job['planned'], 3)
+        self.assertEqual(job['completed'], 3)
+        self.assertEqual(job['failed'], 0)
+        self.assertEqual(job['newsfeeds'], 7)
+        self.assertGreaterEqual(job['finished_at'], job['started_at'])
+        # main task 重试的时候不会再排一遍 batches
+        msg = fanout_newsfeeds_main_task(tweet.id, self.alex.id)
+        self.assertEqual(msg, 'fanout of tweet {} already started'.format(tweet.id))
+        job = FanoutJobService.get_job(tweet.id)
+        self.assertEqual((job['planned'], job['completed'], job['newsfeeds']), (3, 3, 7))
+        self.assertEqual(finished_fanout_tweet_ids, [tweet.id])
+        self.assertEqual(FanoutJobService.get_in_flight_jobs(), [])
+        self.assertEqual(FanoutJobService.get_duration_percentiles()['samples'], 1)
+
+        # seal 之前结束的 batch 不会让 job 提前结束，失败的 batch 也算结束
+        tweet = self.create_tweet(self.alex)
+        self.assertTrue(FanoutJobService.start_job(tweet.id, self.alex.id, 'newsfeeds'))
+        FanoutJobService.record_batch(tweet.id, 3)
+        self.assertEqual(len(FanoutJobService.get_in_flight_jobs()), 1)
+        # main task 重试的时候不会把已经完成的 batch 清零
+        self.assertFalse(FanoutJobService.start_job(tweet.id, self.alex.id, 'newsfeeds'))
+        self.assertEqual(FanoutJobService.get_job(tweet.id)['completed'], 1)
+        FanoutJobService.seal(tweet.id, 2)
+        self.assertIsNone(FanoutJobService.get_job(tweet.id)['finished_at'])
+        FanoutJobService.record_batch(tweet.id, 0, failed=True)
+        job = FanoutJobService.get_job(tweet.id)
+        self.assertEqual(job['failed'], 1)
+        self.assertIsNotNone(job['finished_at'])
+        self.assertEqual(finished_fanout_tweet_ids, [tweet.id - 1, tweet.id])
+        # 结束之后重复的 batch 不会再触发 callback
+        FanoutJobService.record_batch(tweet.id, 3)
+        self.assertEqual(len(finished_fanout_tweet_ids), 2)
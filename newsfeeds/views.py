@@ -1,26 +1,66 @@
-from newsfeeds.services import NewsFeedService
+from functools import partial
+from django.http import HttpResponse, HttpResponseForbidden
+from newsfeeds.services import FanoutJobService, FanoutLaneService, NewsFeedService
 from rest_framework import serializers, viewsets, status
 from .models import NewsFeed
 from rest_framework.permissions import IsAuthenticated
 from .serializers import NewsFeedSerializer
-from utils.paginations import EndlessPagination
+from newsfeeds.paginations import NewsFeedPagination
+from utils.views import PROMETHEUS_CONTENT_TYPE, is_metrics_allowed
 from .models import NewsFeed
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
+
+FANOUT_LANE_METRICS = (
+    ('queue_depth', 'gauge', 'Number of fanout tasks waiting in the lane queue'),
+    ('pending_tweets', 'gauge', 'Number of tweets waiting for bulk fanout'),
+    ('lag_p50', 'gauge', 'Median seconds from posting to a fanout batch finishing'),
+    ('lag_p99', 'gauge', '99th percentile seconds from posting to a fanout batch finishing'),
+    ('lag_max', 'gauge', 'Max seconds from posting to a fanout batch finishing'),
+)
+
+
 class NewsFeedViewSet(viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated]
-    pagination_class = EndlessPagination
+    pagination_class = NewsFeedPagination
 
     # def get_queryset(self):
     #     return NewsFeed.objects.filter(user=self.request.user)
 
     @method_decorator(ratelimit(key='user', rate='5/s', method='GET', block=True))
     def list(self, request):
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
-        if page is None:
-            queryset = NewsFeed.objects.filter(user=request.user)
-            page = self.paginate_queryset(queryset)
+        # push 的 newsfeeds 和关注的大 v 的 tweets 合并，cache 里没有的部分各自读数据库
+        page = self.paginator.paginate_cached_list(
+            partial(NewsFeedService.get_merged_newsfeeds_window, request.user.id),
+            request,
+        )
         serializer = NewsFeedSerializer(page, context={'request': request}, many=True)
         
         return self.get_paginated_response(serializer.data)
+
+
+def fanout_metrics_view(request):
+    # 每个 fanout lane 的队列长度和延迟，prometheus 的 text exposition format
+    if not is_metrics_allowed(request):
+        return HttpResponseForbidden()
+    lane_stats = FanoutLaneService.get_lane_stats()
+    lines = []
+    for name, metric_type, description in FANOUT_LANE_METRICS:
+        lines.append('# HELP fanout_{} {}'.format(name, description))
+        lines.append('# TYPE fanout_{} {}'.format(name, metric_type))
+        for lane, stats in lane_stats.items():
+            if stats.get(name) is not None:
+                lines.append('fanout_{}{{lane="{}"}} {}'.format(name, lane, stats[name]))
+
+    # 每条 tweet 从开始 fanout 到所有 batch 结束的耗时
+    lines.append('# HELP fanout_jobs_in_flight Number of tweets whose fanout has not finished')
+    lines.append('# TYPE fanout_jobs_in_flight gauge')
+    lines.append('fanout_jobs_in_flight {}'.format(len(FanoutJobService.get_in_flight_jobs())))
+    percentiles = FanoutJobService.get_duration_percentiles()
+    lines.append('# HELP fanout_job_seconds Seconds from posting to every fanout batch finishing')
+    lines.append('# TYPE fanout_job_seconds summary')
+    for percent in (50, 90, 99):
+        value = percentiles['p{}'.format(percent)]
+        if value is not None:
+            lines.append('fanout_job_seconds{{quantile="{}"}} {}'.format(percent / 100, value))
+    return HttpResponse('\n'.join(lines) + '\n', content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.4 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweets', '0004_auto_20210729_1506'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweet',
+            name='deleted_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='tweet',
+            name='has_deleted',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -5,8 +5,10 @@ from likes.models import Like
 from django.contrib.contenttypes.models import ContentType
 from utils.time_helpers import utc_now
 from utils.memcached_helper import MemcachedHelper
+from accounts.services import UserService
 from django.db.models.signals import post_save, pre_delete
 from utils.listeners import invalidate_object_cache
+from utils.redis_serializers import CompactModelSerializer
 from .listeners import push_tweet_to_cache
 
 class Tweet(models.Model):
@@ -17,6 +19,10 @@ class Tweet(models.Model):
     likes_count = models.IntegerField(default=0, null=True)
     comments_count = models.IntegerField(default=0, null=True)
 
+    # 软删除，newsfeeds 里的记录和 cache 由后台任务分批撤回
+    has_deleted = models.BooleanField(default=False)
+    deleted_at = models.DateTimeField(null=True)
+
     class Meta:
         index_together = (('user', 'created_at'),)
         ordering = ('user', '-created_at')
@@ -37,8 +43,18 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
+    @property
+    def cached_user_card(self):
+        # 列表序列化时由 BatchLoadSerializerMixin 批量预先填好
+        if hasattr(self, '_cached_user_card'):
+            return self._cached_user_card
+        return UserService.get_user_card(self.user_id)
+
 class TweetPhoto(models.Model):
     tweet = models.ForeignKey(Tweet, on_delete=models.SET_NULL, null=True)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
@@ -67,6 +83,23 @@ class TweetPhoto(models.Model):
         return f'{self.tweet_id}: {self.file}'
 
 
+class CountFlush(models.Model):
+    # 已经写回数据库的一批计数增量，和 UPDATE 在同一个事务里写入，同一批增量不会被写回两次
+    flush_id = models.CharField(max_length=32, unique=True)
+    # 定期清理很久以前的记录
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+# redis 里缓存的 tweet 格式，字段变化时注册一个新的 version
+CompactModelSerializer.register(Tweet, version=1, fields=(
+    'id',
+    'user_id',
+    'created_at',
+    'likes_count',
+    'comments_count',
+    'content',
+))
+
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
 post_save.connect(invalidate_object_cache, sender=Tweet)
 post_save.connect(push_tweet_to_cache, sender=Tweet)
\ No newline at end of file
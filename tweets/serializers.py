@@ -3,40 +3,52 @@ from likes.serializers import LikeSerializer
 from comments.serializers import CommentSerializer
 from friendships.models import Friendships
 from accounts.serializers import UserSerializerForTweet
+from accounts.services import UserService
 from rest_framework import serializers
 from .models import Tweet
+from functools import partial
 from likes.services import LikeService
+from utils.data_loader import BatchLoadListSerializer, BatchLoadSerializerMixin
 from .services import TweetService
-from utils.redis_helper import RedisHelper
 
 
 TWEET_PHOTOS_UPLOAD_LIMIT = 9
 
-class TweetSerializer(serializers.ModelSerializer):
-    user = UserSerializerForTweet(source='cached_user')
+
+class TweetSerializer(BatchLoadSerializerMixin, serializers.ModelSerializer):
+    user = UserSerializerForTweet(source='cached_user_card')
     comments_count = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
     has_liked = serializers.SerializerMethodField()
     photo_urls = serializers.SerializerMethodField()
 
+    def get_batch_loads(self):
+        return [
+            ('user_cards', '_cached_user_card', 'user_id', UserService.get_user_cards),
+            ('tweet_counts', '_cached_counts', 'id', TweetService.get_counts),
+            ('tweet_has_liked', '_cached_has_liked', 'id', partial(
+                LikeService.get_has_liked_map, self.context['request'].user, Tweet,
+            )),
+            ('tweet_photo_urls', '_cached_photo_urls', 'id', TweetService.get_photo_urls),
+        ]
+
     def get_comments_count(self, obj):
         # return obj.comment_set.count()
-        return RedisHelper.get_count(obj, 'comments_count')
+        return TweetService.get_count(obj, 'comments_count')
 
     def get_likes_count(self, obj):
         # return obj.like_set.count()
-        return RedisHelper.get_count(obj, 'likes_count')
+        return TweetService.get_count(obj, 'likes_count')
 
     def get_has_liked(self, obj):
-        return LikeService.has_liked(self.context['request'].user, obj)
+        return obj._cached_has_liked
 
     def get_photo_urls(self, obj):
-        photo_urls = []
-        for photo in obj.tweetphoto_set.all().order_by('order'):
-            photo_urls.append(photo.file.url)
-        return photo_urls
+        return obj._cached_photo_urls
+
     class Meta:
         model = Tweet
+        list_serializer_class = BatchLoadListSerializer
         fields = ('id', 'user', 'content', 'created_at', 'likes_count', 'has_liked', 'comments_count', 'photo_urls')
 
 class TweetCreateSerializer(serializers.ModelSerializer):
@@ -73,6 +85,7 @@ class TweetSerializerForDetail(TweetSerializer):
 
     class Meta:
         model = Tweet
+        list_serializer_class = BatchLoadListSerializer
         fields = (
             'id', 
             'user', 
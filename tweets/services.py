@@ -1,7 +1,18 @@
+from functools import partial
+from django.conf import settings
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
 from .models import TweetPhoto
 from core.cache import USER_TWEETS_PATTERN
-from .models import Tweet
+from .models import CountFlush, Tweet
+from utils.redis_client import RedisClient
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
+from utils.time_helpers import utc_now
+from .tasks import rebuild_tweets_cache_task
+
+# 这些计数都存在 redis 里同一个 hash 中
+TWEET_COUNT_FIELDS = ('likes_count', 'comments_count')
 
 class TweetService(object):
 
@@ -21,12 +32,151 @@ class TweetService(object):
 
     @classmethod
     def get_cached_tweets(cls, user_id):
-        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        queryset = Tweet.objects.filter(user_id=user_id, has_deleted=False).order_by('-created_at')
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        return RedisHelper.load_objects(
+            key,
+            queryset,
+            partial(rebuild_tweets_cache_task.delay, user_id),
+        )
+
+    @classmethod
+    def get_cached_tweets_window(cls, user_id, created_at__lt=None, created_at__gt=None, limit=None, ascending=False):
+        return cls.get_cached_tweets_windows([user_id], created_at__lt, created_at__gt, limit, ascending)[user_id]
+
+    @classmethod
+    def get_cached_tweets_windows(
+        cls, user_ids, created_at__lt=None, created_at__gt=None, limit=None, ascending=False,
+    ):
+        """
+        一次 pipeline 读出多个用户的 tweets 的同一个窗口，返回 {user_id: tweets}
+        cache 里没有或者超出 cache 范围的用户对应 None
+        """
+        keys = [USER_TWEETS_PATTERN.format(user_id=user_id) for user_id in user_ids]
+        windows = RedisHelper.load_objects_windows(
+            Tweet,
+            keys,
+            [partial(rebuild_tweets_cache_task.delay, user_id) for user_id in user_ids],
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+            limit=limit,
+            ascending=ascending,
+        )
+        windows = dict(zip(user_ids, windows))
+        stale_user_ids = cls._get_stale_user_ids(windows)
+        if stale_user_ids:
+            # 删除之前开始的重建可能在删除之后才写进 cache，整个列表作废，这一页从数据库读
+            RedisClient.get_connection().delete(*[
+                USER_TWEETS_PATTERN.format(user_id=user_id)
+                for user_id in stale_user_ids
+            ])
+            windows.update({user_id: None for user_id in stale_user_ids})
+        return windows
+
+    @classmethod
+    def _get_stale_user_ids(cls, windows):
+        # cache 里的 tweet 不带 has_deleted，按 memcached 里的 tweet 判断，删除的时候会被作废
+        tweet_ids = [tweet.id for window in windows.values() if window for tweet in window]
+        loaded = MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+        return [
+            user_id
+            for user_id, window in windows.items()
+            if window and any(
+                tweet.id not in loaded or loaded[tweet.id].has_deleted
+                for tweet in window
+            )
+        ]
+
+    @classmethod
+    def get_tweets_window(cls, user_id, created_at__lt=None, created_at__gt=None, limit=None, ascending=False):
+        return cls.get_tweets_windows([user_id], created_at__lt, created_at__gt, limit, ascending)[user_id]
+
+    @classmethod
+    def get_tweets_windows(cls, user_ids, created_at__lt=None, created_at__gt=None, limit=None, ascending=False):
+        """
+        先读 cache，cache 里没有或者超出 cache 范围的用户一起读数据库，返回 {user_id: tweets}
+        ascending 的时候从 created_at__gt 开始从旧到新取，没有 limit 的时候最多取 cache 的长度那么多
+        """
+        limit = limit or settings.REDIS_LIST_LENGTH_LIMIT
+        windows = {}
+        if user_ids:
+            windows = cls.get_cached_tweets_windows(user_ids, created_at__lt, created_at__gt, limit, ascending)
+        missing_user_ids = [user_id for user_id, tweets in windows.items() if tweets is None]
+        if not missing_user_ids:
+            return windows
+
+        queryset = Tweet.objects.filter(user_id__in=missing_user_ids, has_deleted=False)
+        if created_at__lt is not None:
+            queryset = queryset.filter(created_at__lt=created_at__lt)
+        if created_at__gt is not None:
+            queryset = queryset.filter(created_at__gt=created_at__gt)
+        # 一条查询给每个用户取前 limit 条，按 user_id 分区编号之后只留编号不超过 limit 的
+        order = F('created_at').asc() if ascending else F('created_at').desc()
+        queryset = queryset.order_by().annotate(window_position=Window(
+            RowNumber(),
+            partition_by=[F('user_id')],
+            order_by=[order],
+        ))
+        sql, params = queryset.query.sql_with_params()
+        tweets = Tweet.objects.raw(
+            'SELECT * FROM ({}) windows WHERE window_position <= %s'.format(sql),
+            params + (limit,),
+        )
+        windows.update({user_id: [] for user_id in missing_user_ids})
+        for tweet in sorted(tweets, key=lambda tweet: tweet.created_at, reverse=not ascending):
+            windows[tweet.user_id].append(tweet)
+        return windows
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
-        queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, queryset)
\ No newline at end of file
+        RedisHelper.push_object(
+            key,
+            tweet,
+            partial(rebuild_tweets_cache_task.delay, tweet.user_id),
+        )
+
+    @classmethod
+    def rebuild_tweets_cache(cls, user_id, token):
+        queryset = Tweet.objects.filter(user_id=user_id, has_deleted=False).order_by('-created_at')
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        RedisHelper.fill_objects(key, queryset, token)
+
+    @classmethod
+    def soft_delete_tweet(cls, tweet):
+        """
+        只标记删除，不在请求里更新 newsfeeds, comments, photos 这些记录
+        followers 的 newsfeeds 撤回完成之前，读取的时候按 has_deleted 过滤掉
+        """
+        tweet.has_deleted = True
+        tweet.deleted_at = utc_now()
+        tweet.save(update_fields=['has_deleted', 'deleted_at'])
+        # 作者自己的 tweets 列表直接删掉，下次读取的时候从数据库重建
+        RedisClient.get_connection().delete(USER_TWEETS_PATTERN.format(user_id=tweet.user_id))
+
+    @classmethod
+    def get_counts(cls, tweet_ids):
+        # 一批 tweets 的计数一次性从 redis 里取出来，返回 {tweet_id: {attr: count}}
+        return RedisHelper.get_counts(Tweet, tweet_ids, TWEET_COUNT_FIELDS, CountFlush)
+
+    @classmethod
+    def fill_cached_counts(cls, tweets):
+        counts = cls.get_counts([tweet.id for tweet in tweets])
+        for tweet in tweets:
+            tweet._cached_counts = counts.get(tweet.id, {})
+        return tweets
+
+    @classmethod
+    def get_count(cls, tweet, attr):
+        if not hasattr(tweet, '_cached_counts'):
+            cls.fill_cached_counts([tweet])
+        return (tweet._cached_counts or {}).get(attr, getattr(tweet, attr))
+
+    @classmethod
+    def get_photo_urls(cls, tweet_ids):
+        # 一次查询取出一批 tweets 的图片，返回 {tweet_id: [url, ...]}
+        photo_urls = {tweet_id: [] for tweet_id in tweet_ids}
+        photos = TweetPhoto.objects.filter(tweet_id__in=tweet_ids).order_by('tweet_id', 'order')
+        for photo in photos:
+            photo_urls[photo.tweet_id].append(photo.file.url)
+        return photo_urls
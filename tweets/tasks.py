@@ -0,0 +1,17 @@
+from celery import shared_task
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def rebuild_tweets_cache_task(user_id, token):
+    from tweets.services import TweetService
+    TweetService.rebuild_tweets_cache(user_id, token)
+    return 'tweets cache of user {} rebuilt'.format(user_id)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_tweet_counts_task():
+    from tweets.models import CountFlush, Tweet
+    from utils.redis_helper import RedisHelper
+    updated = RedisHelper.flush_count_deltas(Tweet, CountFlush)
+    return '{} tweets counts flushed'.format(updated)
@@ -1,17 +1,22 @@
 from rest_framework.test import APIClient
+from django.test import override_settings
 from testing.testcases import TestCase
 from django.contrib.auth.models import User
-from tweets.models import Tweet, TweetPhoto
+from tweets.models import CountFlush, Tweet, TweetPhoto
 from datetime import timedelta
 from utils.time_helpers import utc_now
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from .constants import TweetPhotoStatus
 from django.core.files.uploadedfile import SimpleUploadedFile
 from utils.paginations import EndlessPagination
 from utils.redis_client import RedisClient
 from utils.redis_serializers import DjangoModelSerializer
 from core.cache import USER_TWEETS_PATTERN
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedService
 from .services import TweetService
+from utils.redis_helper import RedisHelper
 
 TWEET_LIST_API = '/api/tweets/'
 TWEET_CREATE_API = '/api/tweets/'
@@ -222,6 +227,91 @@ class TweetApiTests(TestCase):
         self.assertEqual(res.data['results'][0]['id'], new_tweet.id)
 
 
+    def test_cursor_pagination(self):
+        page_size = EndlessPagination.page_size
+        tweets = [self.create_tweet(self.user1, 'tweet{}'.format(i)) for i in range(page_size * 2 + 5)]
+        # 跨过第一页和第二页的 10 条 tweets 时间戳相同，比如 fanout 的时候一批写入的
+        tied_ids = [tweet.id for tweet in tweets[page_size - 5:page_size + 5]]
+        Tweet.objects.filter(id__in=tied_ids).update(created_at=tweets[page_size].created_at)
+        expected_ids = list(
+            Tweet.objects.filter(user=self.user1)
+            .order_by('-created_at', '-id')
+            .values_list('id', flat=True)
+        )
+
+        # 先从数据库读 (cache 里没有)，再从重建好的 cache 里读
+        for from_db in (True, False):
+            self.clear_cache()
+            if not from_db:
+                TweetService.get_tweets_window(self.user1.id, limit=1)
+            ids, params = [], {'user_id': self.user1.id}
+            while True:
+                if from_db:
+                    self.clear_cache()
+                res = self.user1_client.get(TWEET_LIST_API, params)
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                ids.extend(tweet['id'] for tweet in res.data['results'])
+                if not res.data['has_next_page']:
+                    break
+                params['cursor'] = res.data['next_cursor']
+            self.assertEqual(ids, expected_ids)
+
+            # 从最早的一条开始用 since 往新的方向翻，跨过时间戳相同的那一组也不会跳过或者重复
+            paginator = EndlessPagination()
+            oldest = Tweet.objects.get(id=expected_ids[-1])
+            ids, params = [], {'user_id': self.user1.id, 'since': paginator.encode_cursor(oldest)}
+            while True:
+                if from_db:
+                    self.clear_cache()
+                res = self.user1_client.get(TWEET_LIST_API, params)
+                ids = [tweet['id'] for tweet in res.data['results']] + ids
+                if not res.data['has_previous_page']:
+                    break
+                params['since'] = res.data['previous_cursor']
+            self.assertEqual(ids, expected_ids[:-1])
+
+        # since 从旧到新读一页多一条，窗口的最后落在时间戳相同的那一组里才扩大，不会把比它新的全部读出来
+        calls = []
+
+        def load_cached_window(**kwargs):
+            calls.append(kwargs)
+            return TweetService.get_tweets_window(self.user1.id, **kwargs)
+
+        paginator = EndlessPagination()
+        page = paginator._load_since(load_cached_window, paginator.get_cursor_key(oldest))
+        self.assertEqual([tweet.id for tweet in page], expected_ids[-page_size - 1:-1])
+        self.assertEqual([call['limit'] for call in calls], [page_size + 1, (page_size + 1) * 2])
+        self.assertTrue(all(call['ascending'] for call in calls))
+
+        # since 从最新的位置往新的方向取，每次最多一页
+        res = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        since = res.data['previous_cursor']
+        new_tweets = [self.create_tweet(self.user1, 'new{}'.format(i)) for i in range(page_size + 2)]
+        res = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id, 'since': since})
+        self.assertEqual(res.data['has_previous_page'], True)
+        self.assertEqual(
+            [tweet['id'] for tweet in res.data['results']],
+            [tweet.id for tweet in new_tweets[:page_size]][::-1],
+        )
+        res = self.user1_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'since': res.data['previous_cursor'],
+        })
+        self.assertEqual(res.data['has_previous_page'], False)
+        self.assertEqual(
+            [tweet['id'] for tweet in res.data['results']],
+            [new_tweets[-1].id, new_tweets[-2].id],
+        )
+
+        # cursor 被修改过就不能用了
+        paginator = EndlessPagination()
+        cursor = paginator.encode_cursor(new_tweets[0])
+        self.assertEqual(paginator.decode_cursor(cursor)[1], new_tweets[0].id)
+        with self.assertRaises(NotFound):
+            paginator.decode_cursor(cursor[:-2])
+        with self.assertRaises(NotFound):
+            paginator.decode_cursor(paginator.encode_cursor_key((1, 2)).replace('M', 'N'))
+
     def test_cache_tweet_in_redis(self):
         tweet = self.create_tweet(self.user1)
         conn = RedisClient.get_connection()
@@ -234,6 +324,55 @@ class TweetApiTests(TestCase):
         cached_tweet = DjangoModelSerializer.deserialize(data)
         self.assertEqual(tweet, cached_tweet)    
 
+    def test_destroy_api(self):
+        followers = [self.user2] + [self.create_user('follower{}'.format(i)) for i in range(4)]
+        for follower in followers:
+            self.create_friendships(follower, self.user1)
+        tweet = self.create_tweet(self.user1, 'to be deleted')
+        NewsFeedService.fanout_to_followers(tweet)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 6)
+        newsfeeds = NewsFeedService.get_merged_newsfeeds_window(self.user2.id, limit=10)
+        self.assertEqual(newsfeeds[0].tweet_id, tweet.id)
+
+        url = TWEET_RETRIEVE_API.format(tweet.id)
+        response = self.anonymous_client.delete(url)
+        self.assertEqual(response.status_code, 403)
+        response = self.user2_client.delete(url)
+        self.assertEqual(response.status_code, 403)
+        response = self.user1_client.delete(url)
+        self.assertEqual(response.status_code, 200)
+
+        tweet.refresh_from_db()
+        self.assertTrue(tweet.has_deleted)
+        self.assertIsNotNone(tweet.deleted_at)
+        # 所有 followers 的 newsfeeds 分批撤回，cache 里也没有了
+        self.assertFalse(NewsFeed.objects.filter(tweet=tweet).exists())
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertNotIn(tweet.id, [newsfeed.tweet_id for newsfeed in newsfeeds])
+        tweets = TweetService.get_cached_tweets(self.user1.id)
+        self.assertNotIn(tweet.id, [t.id for t in tweets])
+
+        # 删除之前读过数据库的重建在删除之后才写进 cache，列表接口也不会再返回这条 tweet
+        key = USER_TWEETS_PATTERN.format(user_id=self.user1.id)
+        token = RedisHelper.acquire_fill_lock(key)
+        RedisHelper.fill_objects(key, Tweet.objects.filter(id=tweet.id), token)
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertNotIn(tweet.id, [t['id'] for t in response.data['results']])
+        self.assertFalse(RedisClient.get_connection().exists(key))
+
+        # 撤回之后才完成的 fanout 又写进来的 newsfeed，读取的时候按 has_deleted 过滤掉，
+        # 不够 limit 的时候多读一条补上
+        older_tweet = self.create_tweet(self.user1, 'older')
+        NewsFeed.objects.create(user=self.user2, tweet=older_tweet)
+        NewsFeed.objects.create(user=self.user2, tweet=tweet)
+        newsfeeds = NewsFeedService.get_merged_newsfeeds_window(self.user2.id, limit=1)
+        self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [older_tweet.id])
+
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.status_code, 404)
+        response = self.user1_client.delete(url)
+        self.assertEqual(response.status_code, 404)
+
 class TweetPhotoApiTests(TestCase):
 
     def setUp(self):
@@ -339,4 +478,157 @@ class TweetServiceTests(TestCase):
 
         tweets = TweetService.get_cached_tweets(self.alex.id)
         self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
-       
\ No newline at end of file
+       
+    def test_get_cached_tweets_window(self):
+        tweets = [self.create_tweet(self.alex, 'tweet {}'.format(i)) for i in range(5)]
+        tweets = tweets[::-1]
+
+        # cache miss 时返回 None 去读数据库，同时触发重建
+        RedisClient.clear()
+        window = TweetService.get_cached_tweets_window(self.alex.id, limit=2)
+        self.assertEqual(window, None)
+
+        # cache hit
+        window = TweetService.get_cached_tweets_window(self.alex.id, limit=2)
+        self.assertEqual([t.id for t in window], [tweets[0].id, tweets[1].id])
+        window = TweetService.get_cached_tweets_window(
+            self.alex.id,
+            created_at__lt=tweets[1].created_at,
+            limit=2,
+        )
+        self.assertEqual([t.id for t in window], [tweets[2].id, tweets[3].id])
+
+        window = TweetService.get_cached_tweets_window(
+            self.alex.id,
+            created_at__gt=tweets[2].created_at,
+        )
+        self.assertEqual([t.id for t in window], [tweets[0].id, tweets[1].id])
+
+    def test_rebuild_tweets_cache_single_flight(self):
+        tweet1 = self.create_tweet(self.alex, 'tweet1')
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_PATTERN.format(user_id=self.alex.id)
+
+        # 别的 worker 正在重建，这里不会再重建，新的 tweet 先放到 pending 里
+        token = RedisHelper.acquire_fill_lock(key)
+        self.assertNotEqual(token, None)
+        self.assertEqual(TweetService.get_cached_tweets_window(self.alex.id, limit=2), None)
+        tweet2 = self.create_tweet(self.alex, 'tweet2')
+        self.assertEqual(conn.exists(key), False)
+
+        # 重建完成后 pending 里的 tweet 也会合并进去
+        RedisHelper.fill_objects(key, Tweet.objects.filter(id=tweet1.id), token)
+        tweets = TweetService.get_cached_tweets(self.alex.id)
+        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+        self.assertEqual(conn.exists(RedisHelper.get_fill_lock_key(key)), False)
+
+    def test_fill_cached_counts(self):
+        bob = self.create_user('bob')
+        tweets = [self.create_tweet(self.alex, 'tweet {}'.format(i)) for i in range(3)]
+        self.create_like(bob, tweets[0])
+        self.create_comment(bob, tweets[1])
+        RedisClient.clear()
+
+        # cache miss 时用一次 IN 查询补齐，并且写回的 key 有过期时间
+        with self.assertNumQueries(1):
+            TweetService.fill_cached_counts(tweets)
+        self.assertEqual(
+            [(t._cached_counts['likes_count'], t._cached_counts['comments_count']) for t in tweets],
+            [(1, 0), (0, 1), (0, 0)],
+        )
+        conn = RedisClient.get_connection('counters')
+        key = RedisHelper.get_counts_key(Tweet, tweets[0].id)
+        self.assertGreater(conn.ttl(key), 0)
+
+        # cache hit 不需要查数据库
+        self.create_like(bob, tweets[1])
+        tweets = [Tweet.objects.get(id=t.id) for t in tweets]
+        with self.assertNumQueries(0):
+            TweetService.fill_cached_counts(tweets)
+        self.assertEqual(TweetService.get_count(tweets[1], 'likes_count'), 1)
+
+    @override_settings(COUNTERS_WRITE_BEHIND=True)
+    def test_write_behind_counts(self):
+        bob = self.create_user('bob')
+        lisa = self.create_user('lisa')
+        tweet = self.create_tweet(self.alex)
+        RedisClient.clear()
+
+        self.create_like(bob, tweet)
+        self.create_like(lisa, tweet)
+        comment = self.create_comment(bob, tweet)
+        # 数据库还没有更新，读到的是 redis 里的计数
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (0, 0))
+        self.assertEqual(TweetService.get_count(tweet, 'likes_count'), 2)
+
+        # 计数的 cache 过期之后，数据库的值加上没写回的增量
+        conn = RedisClient.get_connection('counters')
+        conn.delete(RedisHelper.get_counts_key(Tweet, tweet.id))
+        self.assertEqual(TweetService.get_count(tweet, 'likes_count'), 2)
+        self.assertEqual(TweetService.get_count(tweet, 'comments_count'), 1)
+
+        comment.delete()
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, CountFlush), 1)
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (2, 0))
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, CountFlush), 0)
+        self.assertEqual(TweetService.get_count(tweet, 'likes_count'), 2)
+
+        # 上一次 flush 中途失败留下的增量会在下一次 flush 时写回
+        self.create_like(self.alex, tweet)
+        conn.rename(
+            RedisHelper.get_count_deltas_key(Tweet),
+            RedisHelper.get_count_flushing_key(Tweet),
+        )
+        self.create_comment(lisa, tweet)
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, CountFlush), 1)
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (3, 0))
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, CountFlush), 1)
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (3, 1))
+
+        # 已经提交但是 flushing 没来得及删除，下一次 flush 不会再写一次
+        other_tweet = self.create_tweet(bob)
+        self.create_like(lisa, other_tweet)
+        conn.rename(
+            RedisHelper.get_count_deltas_key(Tweet),
+            RedisHelper.get_count_flushing_key(Tweet),
+        )
+        conn.hset(RedisHelper.get_count_flushing_key(Tweet), 'flush_id', 'committed')
+        Tweet.objects.filter(id=other_tweet.id).update(likes_count=1)
+        CountFlush.objects.create(flush_id='committed')
+        # 读计数的时候也不会把已经写回的增量再加一次
+        conn.delete(RedisHelper.get_counts_key(Tweet, other_tweet.id))
+        self.assertEqual(TweetService.get_count(other_tweet, 'likes_count'), 1)
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, CountFlush), 0)
+        other_tweet.refresh_from_db()
+        self.assertEqual(other_tweet.likes_count, 1)
+        self.assertFalse(conn.exists(RedisHelper.get_count_flushing_key(Tweet)))
+
+        # 计数不在 cache 里的时候只记增量，不会用读到的值再加上已经写回的 flushing
+        third_tweet = self.create_tweet(bob)
+        self.create_like(lisa, third_tweet)
+        conn.rename(
+            RedisHelper.get_count_deltas_key(Tweet),
+            RedisHelper.get_count_flushing_key(Tweet),
+        )
+        conn.hset(RedisHelper.get_count_flushing_key(Tweet), 'flush_id', 'committed_again')
+        Tweet.objects.filter(id=third_tweet.id).update(likes_count=1)
+        CountFlush.objects.create(flush_id='committed_again')
+        conn.delete(RedisHelper.get_counts_key(Tweet, third_tweet.id))
+        self.create_like(self.alex, third_tweet)
+        self.assertFalse(conn.exists(RedisHelper.get_counts_key(Tweet, third_tweet.id)))
+        self.assertEqual(TweetService.get_count(third_tweet, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, CountFlush), 0)
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, CountFlush), 1)
+        third_tweet.refresh_from_db()
+        self.assertEqual(third_tweet.likes_count, 2)
+
+        # 别的 worker 的锁不会被释放
+        lock_key = '{}:lock'.format(RedisHelper.get_count_flushing_key(Tweet))
+        conn.set(lock_key, 'other')
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, CountFlush), 0)
+        self.assertEqual(conn.get(lock_key), b'other')
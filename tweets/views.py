@@ -1,3 +1,4 @@
+from functools import partial
 from rest_framework import viewsets
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
@@ -5,19 +6,22 @@ from .models import Tweet
 from .serializers import TweetSerializer, TweetCreateSerializer, TweetSerializerForDetail
 from newsfeeds.services import NewsFeedService
 from utils.decorator import required_params
+from utils.permissions import IsObjectOwner
 from utils.paginations import EndlessPagination
 from .services import TweetService
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
 
 class TweetViewSet(viewsets.GenericViewSet):
-    queryset = Tweet.objects.all()
+    queryset = Tweet.objects.filter(has_deleted=False)
     serializer_class = TweetCreateSerializer
     pagination_class = EndlessPagination
 
     def get_permissions(self):
         if self.action in ['list', 'retrieve']:
             return [AllowAny()]
+        if self.action == 'destroy':
+            return [IsAuthenticated(), IsObjectOwner()]
         return [IsAuthenticated()]
 
     # 用户创建一条推文
@@ -45,12 +49,14 @@ class TweetViewSet(viewsets.GenericViewSet):
         #     return Response('missing user_id', status=400)
 
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id)
 
         # tweets = TweetService.get_cached_tweets(user_id=request.query_params['user_id'])
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        page = self.paginator.paginate_cached_list(
+            partial(TweetService.get_cached_tweets_window, user_id),
+            request,
+        )
         if page is None:
-            queryset = Tweet.objects.filter(user_id=user_id)
+            queryset = Tweet.objects.filter(user_id=user_id, has_deleted=False)
             page = self.paginate_queryset(queryset)
         serializer = TweetSerializer(page, context={'request': request}, many=True)
         return self.get_paginated_response(serializer.data)
@@ -60,4 +66,11 @@ class TweetViewSet(viewsets.GenericViewSet):
     @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True))
     def retrieve(self, request, *args, **kwargs):
         tweet = self.get_object()
-        return Response(TweetSerializerForDetail(tweet, context={'request': request}).data)
\ No newline at end of file
+        return Response(TweetSerializerForDetail(tweet, context={'request': request}).data)
+
+    # 删除自己的一条推文，只做软删除，followers 的 newsfeeds 在后台分批撤回
+    def destroy(self, request, *args, **kwargs):
+        tweet = self.get_object()
+        TweetService.soft_delete_tweet(tweet)
+        NewsFeedService.retract_from_followers(tweet)
+        return Response({'success': True}, status=200)
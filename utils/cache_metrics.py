@@ -0,0 +1,198 @@
+from contextlib import contextmanager
+from core.cache import get_key_namespace
+from django.conf import settings
+from utils.local_cache import LocalCache
+from utils.redis_client import RedisClient
+import os
+import threading
+import time
+
+METRICS = (
+    ('hits', 'counter', 'Number of keys found in the cache'),
+    ('misses', 'counter', 'Number of keys not found in the cache'),
+    ('fills', 'counter', 'Number of times missing data was loaded and written back'),
+    ('fill_seconds', 'counter', 'Total seconds spent loading and writing back missing data'),
+    ('bytes', 'counter', 'Payload bytes read from redis, memcached values are not measured'),
+    ('errors', 'counter', 'Number of failed cache operations'),
+)
+
+# 每个进程自己的 redis 连接池，prometheus 分别抓取每个进程
+POOL_METRICS = (
+    ('max_connections', 'Max connections allowed in the redis pool'),
+    ('created_connections', 'Connections created by the redis pool'),
+    ('in_use_connections', 'Connections currently checked out of the redis pool'),
+    ('available_connections', 'Idle connections in the redis pool'),
+    ('utilization', 'In use connections divided by max connections'),
+)
+
+# 每个进程自己的 LocalCache
+LOCAL_CACHE_METRICS = (
+    ('hits', 'counter', 'Number of keys found in the process local cache'),
+    ('misses', 'counter', 'Number of keys not found in the process local cache'),
+    ('evictions', 'counter', 'Number of entries evicted by the entry or byte limit'),
+    ('invalidations', 'counter', 'Number of entries removed by invalidation'),
+    ('entries', 'gauge', 'Number of entries in the process local cache'),
+    ('bytes', 'gauge', 'Pickled bytes held by the process local cache'),
+    ('subscribed', 'gauge', 'Whether the invalidation subscriber is connected'),
+)
+
+
+class CacheMetrics:
+    """
+    记录每一种 cache (memcached, redis) 每一类 key (core/cache.py 里的 patterns 和 model 名字) 的
+    hits, misses, fills, fill 耗时, 数据大小和错误次数
+
+    先在进程内累加，每隔 CACHE_METRICS_FLUSH_INTERVAL 秒用一次 pipeline 加到 redis 的一个 hash 里，
+    这样所有 gunicorn / celery 进程的数据都汇总在一起，不会给每次读 cache 多加一次网络往返
+    """
+
+    pid = None
+    lock = threading.Lock()
+    # (cache_name, namespace, metric) -> value
+    pending = {}
+    last_flushed_at = 0
+
+    @classmethod
+    def _check_pid(cls):
+        if cls.pid == os.getpid():
+            return
+        cls.pid = os.getpid()
+        cls.lock = threading.Lock()
+        cls.pending = {}
+        cls.last_flushed_at = time.monotonic()
+
+    @classmethod
+    def get_namespace(cls, key):
+        # 'v1:user_tweets:1' -> 'user_tweets', 'Tweet.counts:1' -> 'Tweet.counts'
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        return get_key_namespace(key)
+
+    @classmethod
+    def incr(cls, cache_name, namespace, metric, value=1):
+        if not settings.CACHE_METRICS_ENABLED or not value:
+            return
+        cls._check_pid()
+        field = (cache_name, namespace, metric)
+        with cls.lock:
+            cls.pending[field] = cls.pending.get(field, 0) + value
+            should_flush = time.monotonic() - cls.last_flushed_at >= settings.CACHE_METRICS_FLUSH_INTERVAL
+        if should_flush:
+            cls.flush()
+
+    @classmethod
+    def incr_keys(cls, cache_name, keys, metric):
+        # 一批 keys 按 namespace 分组计数
+        if not settings.CACHE_METRICS_ENABLED:
+            return
+        namespaces = {}
+        for key in keys:
+            namespace = cls.get_namespace(key)
+            namespaces[namespace] = namespaces.get(namespace, 0) + 1
+        for namespace, count in namespaces.items():
+            cls.incr(cache_name, namespace, metric, count)
+
+    @classmethod
+    @contextmanager
+    def count_errors(cls, cache_name, namespace):
+        try:
+            yield
+        except Exception:
+            cls.incr(cache_name, namespace, 'errors')
+            raise
+
+    @classmethod
+    @contextmanager
+    def measure_fill(cls, cache_name, namespace):
+        """
+        with CacheMetrics.measure_fill('memcached', 'usercard'):
+            ... 从数据库读取并写回 cache
+
+        正常结束记一次 fills 和耗时，抛出异常记一次 errors
+        """
+        started_at = time.monotonic()
+        with cls.count_errors(cache_name, namespace):
+            yield
+        cls.incr(cache_name, namespace, 'fills')
+        cls.incr(cache_name, namespace, 'fill_seconds', time.monotonic() - started_at)
+
+    @classmethod
+    def flush(cls):
+        cls._check_pid()
+        with cls.lock:
+            pending, cls.pending = cls.pending, {}
+            cls.last_flushed_at = time.monotonic()
+        if not pending:
+            return
+        try:
+            conn = RedisClient.get_connection('counters')
+            pipe = conn.pipeline(transaction=False)
+            for (cache_name, namespace, metric), value in pending.items():
+                field = '{}|{}|{}'.format(cache_name, namespace, metric)
+                if isinstance(value, float):
+                    pipe.hincrbyfloat(settings.CACHE_METRICS_KEY, field, value)
+                else:
+                    pipe.hincrby(settings.CACHE_METRICS_KEY, field, value)
+            pipe.execute()
+        except Exception:
+            # 统计数据写不进去不能影响正常的请求，这一批数据就丢掉了
+            pass
+
+    @classmethod
+    def get_metrics(cls):
+        """
+        返回 {(cache_name, namespace): {metric: value}}
+        """
+        cls.flush()
+        conn = RedisClient.get_connection('counters')
+        metrics = {}
+        for field, value in conn.hgetall(settings.CACHE_METRICS_KEY).items():
+            cache_name, namespace, metric = field.decode('utf-8').split('|')
+            value = float(value)
+            metrics.setdefault((cache_name, namespace), {})[metric] = value
+        return metrics
+
+    @classmethod
+    def to_prometheus(cls, metrics=None):
+        if metrics is None:
+            metrics = cls.get_metrics()
+        lines = []
+        for metric, metric_type, description in METRICS:
+            name = 'cache_{}_total'.format(metric)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for (cache_name, namespace), values in sorted(metrics.items()):
+                lines.append('{}{{cache="{}",namespace="{}"}} {}'.format(
+                    name, cache_name, namespace, _format_value(values.get(metric, 0)),
+                ))
+
+        pool_stats = RedisClient.get_pool_stats()
+        for metric, description in POOL_METRICS:
+            name = 'redis_pool_{}'.format(metric)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} gauge'.format(name))
+            for pool_name, stats in sorted(pool_stats.items()):
+                lines.append('{}{{pool="{}"}} {}'.format(name, pool_name, _format_value(stats[metric])))
+
+        local_cache_stats = LocalCache.get_stats()
+        for metric, metric_type, description in LOCAL_CACHE_METRICS:
+            name = 'local_cache_{}'.format(metric)
+            if metric_type == 'counter':
+                name += '_total'
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            lines.append('{} {}'.format(name, _format_value(local_cache_stats[metric])))
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def reset(cls):
+        cls._check_pid()
+        with cls.lock:
+            cls.pending = {}
+        RedisClient.get_connection('counters').delete(settings.CACHE_METRICS_KEY)
+
+
+def _format_value(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return '{:.6f}'.format(value)
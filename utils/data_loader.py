@@ -0,0 +1,81 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class DataLoader:
+    """
+    一个请求（一次序列化）内共享，同一种数据按 key 批量读取，读过的 key 会记住
+    比如同一个 user 出现在一页的很多条 tweets 里，只会被读取一次
+    """
+
+    def __init__(self):
+        # kind -> {key: value}
+        self.loaded = {}
+
+    @classmethod
+    def from_context(cls, context):
+        if 'data_loader' not in context:
+            context['data_loader'] = cls()
+        return context['data_loader']
+
+    def load_many(self, kind, load, keys):
+        """
+        load(keys) 需要返回 {key: value}，没有返回的 key 当作 None
+        """
+        loaded = self.loaded.setdefault(kind, {})
+        missing_keys = list(dict.fromkeys(
+            key for key in keys if key is not None and key not in loaded
+        ))
+        if missing_keys:
+            values = load(missing_keys)
+            for key in missing_keys:
+                loaded[key] = values.get(key)
+        return loaded
+
+
+class BatchLoadSerializerMixin:
+    """
+    serializer 在 get_batch_loads 里声明每个 object 需要的数据:
+        (kind, 填到 object 上的属性名, 作为 key 的属性名, load 函数)
+    序列化一页数据之前先把整页的 keys 收集起来，每种数据只读一次，嵌套的 serializer 也一样
+    这样一页需要的 I/O 次数只和数据的种类有关，和这一页有多少条数据无关
+    """
+
+    def get_batch_loads(self):
+        return []
+
+    def batch_load(self, instances):
+        loader = DataLoader.from_context(self.context)
+        for kind, attr, key_attr, load in self.get_batch_loads():
+            keys = [getattr(instance, key_attr) for instance in instances]
+            values = loader.load_many(kind, load, keys)
+            for instance, key in zip(instances, keys):
+                setattr(instance, attr, values.get(key))
+
+        # 上面填好的数据（比如 newsfeed 的 tweet）再交给嵌套的 serializer 继续批量读取
+        for field in self.fields.values():
+            if not isinstance(field, BatchLoadSerializerMixin):
+                continue
+            nested_instances = [field.get_attribute(instance) for instance in instances]
+            field.batch_load([
+                nested_instance
+                for nested_instance in nested_instances
+                if nested_instance is not None
+            ])
+
+    def to_representation(self, instance):
+        # 单独序列化一个 object 的时候（比如详情页）也走同样的逻辑
+        if not all(
+            hasattr(instance, attr)
+            for _, attr, _, _ in self.get_batch_loads()
+        ):
+            self.batch_load([instance])
+        return super().to_representation(instance)
+
+
+class BatchLoadListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        instances = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.batch_load(instances)
+        return super().to_representation(instances)
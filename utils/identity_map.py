@@ -0,0 +1,65 @@
+import threading
+
+# 和 None 区分开，表示 identity map 里没有这个 key
+MISSING = object()
+
+
+class IdentityMap:
+    """
+    一个请求（或者一个 celery task）内，同一个 key 只从 memcached / redis 读一次
+    key 和 cache 里的 key 相同，比如 'v1:User:1'，'v1:userprofile:1'
+    只在 begin() 和 end() 之间生效，其他时候读写都直接跳过，避免进程里留下过期的数据
+    """
+
+    _local = threading.local()
+
+    @classmethod
+    def _get_store(cls):
+        return getattr(cls._local, 'store', None)
+
+    @classmethod
+    def begin(cls):
+        # eager 模式下 task 在请求里面执行，嵌套的时候共用外层的 map
+        depth = getattr(cls._local, 'depth', 0)
+        if depth == 0:
+            cls._local.store = {}
+        cls._local.depth = depth + 1
+
+    @classmethod
+    def end(cls):
+        depth = getattr(cls._local, 'depth', 0) - 1
+        cls._local.depth = max(depth, 0)
+        if depth <= 0:
+            cls._local.store = None
+
+    @classmethod
+    def get(cls, key):
+        store = cls._get_store()
+        if store is None:
+            return MISSING
+        return store.get(key, MISSING)
+
+    @classmethod
+    def get_many(cls, keys):
+        store = cls._get_store()
+        if store is None:
+            return {}
+        return {key: store[key] for key in keys if key in store}
+
+    @classmethod
+    def set(cls, key, value):
+        store = cls._get_store()
+        if store is not None:
+            store[key] = value
+
+    @classmethod
+    def set_many(cls, mapping):
+        store = cls._get_store()
+        if store is not None:
+            store.update(mapping)
+
+    @classmethod
+    def delete(cls, key):
+        store = cls._get_store()
+        if store is not None:
+            store.pop(key, None)
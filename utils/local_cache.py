@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from core.cache import get_key_namespace
+from django.conf import settings
+from utils.identity_map import MISSING
+from utils.redis_client import RedisClient
+import os
+import pickle
+import redis
+import threading
+import time
+
+
+class LocalCache:
+    """
+    进程内的 LRU + TTL cache，放在 memcached 前面，用来挡住最热的那一小部分 key
+    按条数和字节数两个维度淘汰，存的是 pickle 之后的数据，每次读出来都是新的 object，
+    不会被不同的请求共用和修改
+
+    修改的时候通过 redis pub/sub 通知所有进程删除本地的数据
+    订阅断开的时候可能错过通知，所以没有订阅成功时不读也不写本地 cache
+    """
+
+    pid = None
+    lock = threading.Lock()
+    # key -> (expire_at, pickled data)
+    entries = OrderedDict()
+    total_bytes = 0
+    stats = {}
+    subscriber = None
+    subscribed = threading.Event()
+
+    @classmethod
+    def _check_pid(cls):
+        # fork 出来的子进程里没有订阅线程，数据也可能已经过期，全部重新来
+        if cls.pid == os.getpid():
+            return
+        cls.pid = os.getpid()
+        cls.lock = threading.Lock()
+        cls.entries = OrderedDict()
+        cls.total_bytes = 0
+        cls.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+        cls.subscriber = None
+        cls.subscribed = threading.Event()
+
+    @classmethod
+    def is_enabled(cls, key):
+        if not settings.LOCAL_CACHE_ENABLED:
+            return False
+        return get_key_namespace(key) in settings.LOCAL_CACHE_NAMESPACES
+
+    @classmethod
+    def _is_ready(cls, key):
+        if not cls.is_enabled(key):
+            return False
+        cls._check_pid()
+        cls._ensure_subscriber()
+        return cls.subscribed.is_set()
+
+    @classmethod
+    def _remove(cls, key):
+        entry = cls.entries.pop(key, None)
+        if entry is not None:
+            cls.total_bytes -= len(entry[1])
+        return entry
+
+    @classmethod
+    def get(cls, key):
+        if not cls._is_ready(key):
+            return MISSING
+        with cls.lock:
+            entry = cls.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                cls._remove(key)
+                entry = None
+            if entry is None:
+                cls.stats['misses'] += 1
+                return MISSING
+            cls.entries.move_to_end(key)
+            cls.stats['hits'] += 1
+            data = entry[1]
+        return pickle.loads(data)
+
+    @classmethod
+    def get_many(cls, keys):
+        values = {}
+        for key in keys:
+            value = cls.get(key)
+            if value is not MISSING:
+                values[key] = value
+        return values
+
+    @classmethod
+    def set(cls, key, value):
+        if not cls._is_ready(key):
+            return
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > settings.LOCAL_CACHE_MAX_BYTES:
+            return
+        with cls.lock:
+            cls._remove(key)
+            cls.entries[key] = (time.monotonic() + settings.LOCAL_CACHE_TIMEOUT, data)
+            cls.total_bytes += len(data)
+            while len(cls.entries) > settings.LOCAL_CACHE_MAX_ENTRIES \
+                    or cls.total_bytes > settings.LOCAL_CACHE_MAX_BYTES:
+                _, (_, evicted) = cls.entries.popitem(last=False)
+                cls.total_bytes -= len(evicted)
+                cls.stats['evictions'] += 1
+
+    @classmethod
+    def set_many(cls, mapping):
+        for key, value in mapping.items():
+            cls.set(key, value)
+
+    @classmethod
+    def delete(cls, key):
+        cls._check_pid()
+        with cls.lock:
+            if cls._remove(key) is not None:
+                cls.stats['invalidations'] += 1
+
+    @classmethod
+    def invalidate(cls, key):
+        # 本进程立即删除，其他进程通过订阅收到通知后删除
+        if not cls.is_enabled(key):
+            return
+        cls.delete(key)
+        conn = RedisClient.get_connection('broker')
+        conn.publish(settings.LOCAL_CACHE_CHANNEL, key)
+
+    @classmethod
+    def clear(cls):
+        cls._check_pid()
+        with cls.lock:
+            cls.entries.clear()
+            cls.total_bytes = 0
+
+    @classmethod
+    def get_stats(cls):
+        cls._check_pid()
+        with cls.lock:
+            stats = dict(cls.stats)
+            stats['entries'] = len(cls.entries)
+            stats['bytes'] = cls.total_bytes
+        stats['subscribed'] = cls.subscribed.is_set()
+        return stats
+
+    @classmethod
+    def _ensure_subscriber(cls):
+        if cls.subscriber is not None and cls.subscriber.is_alive():
+            return
+        with cls.lock:
+            if cls.subscriber is not None and cls.subscriber.is_alive():
+                return
+            cls.subscriber = threading.Thread(
+                target=cls._listen,
+                args=(cls.subscribed,),
+                name='local-cache-invalidation',
+                daemon=True,
+            )
+            cls.subscriber.start()
+
+    @classmethod
+    def _listen(cls, subscribed):
+        while True:
+            try:
+                pubsub = RedisClient.get_connection('broker').pubsub(
+                    ignore_subscribe_messages=True,
+                )
+                pubsub.subscribe(settings.LOCAL_CACHE_CHANNEL)
+                subscribed.set()
+                while True:
+                    # 用 get_message 的 timeout 轮询，不会触发连接上的 socket_timeout
+                    message = pubsub.get_message(timeout=1)
+                    if message is not None and message['type'] == 'message':
+                        cls.delete(message['data'].decode('utf-8'))
+            except redis.RedisError:
+                pass
+            # 断开期间的通知都收不到了，清空之后等重新订阅成功再用
+            subscribed.clear()
+            cls.clear()
+            time.sleep(1)
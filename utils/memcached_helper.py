@@ -1,25 +1,259 @@
+from core.cache import OBJECT_PATTERN
 from django.conf import settings
 from django.core.cache import caches
+from utils.cache_metrics import CacheMetrics
+from utils.identity_map import IdentityMap
+from utils.local_cache import LocalCache
+import random
+import time
+import uuid
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# 数据库里不存在的 object 也 cache 一小段时间，避免不存在的 id 每次都打到数据库
+NOT_FOUND = '__not_found__'
+
 class MemcachedHelper:
+    """
+    读取的顺序: identity map (当前请求) -> LocalCache (当前进程) -> memcached -> 数据库
+    下层读到的数据会回填到上面的每一层
+
+    memcached 里每个 key 都有一个 generation，数据存成 (generation, soft_expire_at, value)
+    invalidate 的时候换一个新的 generation，读的时候 generation 对不上的数据直接丢弃
+    这样在 invalidate 之前从数据库读到旧数据的请求，就算之后再写回 cache 也不会被读到
+    generation 不存在 (第一次写入或者被 memcached 淘汰) 的时候数据一律当作没有命中，
+    去数据库读取之前先用 add 创建 generation
+
+    过了 soft_expire_at 之后，只有拿到 lease 的那一个请求去数据库刷新，其他请求继续使用旧的数据
+    soft_expire_at 是 None 的数据只有 memcached 的过期时间
+    memcached 里完全没有的数据也是拿到 lease 的请求去数据库读，其他请求等一小会儿再读 memcached，
+    等不到的话才自己去数据库读
+    """
 
     @classmethod
     def get_key(cls, model_class, object_id):
-        return '{}:{}'.format(model_class.__name__, object_id)
+        return OBJECT_PATTERN.format(model_name=model_class.__name__, object_id=object_id)
+
+    @classmethod
+    def get_generation_key(cls, key):
+        return '{}:gen'.format(key)
+
+    @classmethod
+    def get_lease_key(cls, key):
+        return '{}:lease'.format(key)
+
+    @classmethod
+    def _ensure_generations(cls, generations):
+        """
+        给没有 generation 的 keys 创建一个，add 失败说明别的请求已经创建了，重新读一次
+        """
+        missing_keys = [key for key, generation in generations.items() if generation is None]
+        if not missing_keys:
+            return
+        for key in missing_keys:
+            cache.add(cls.get_generation_key(key), uuid.uuid4().hex, settings.MEMCACHED_GENERATION_TIMEOUT)
+        generation_keys = {cls.get_generation_key(key): key for key in missing_keys}
+        for generation_key, generation in cache.get_many(list(generation_keys)).items():
+            generations[generation_keys[generation_key]] = generation
+
+    @classmethod
+    def acquire_lease(cls, key):
+        # add 只有在 key 不存在的时候才会成功，同一时间只有一个请求能拿到
+        return cache.add(cls.get_lease_key(key), 1, settings.MEMCACHED_LEASE_TIMEOUT)
+
+    @classmethod
+    def release_leases(cls, keys):
+        cache.delete_many([cls.get_lease_key(key) for key in keys])
+
+    @classmethod
+    def get_soft_expire_at(cls, soft_timeout):
+        if soft_timeout is None:
+            return None
+        jitter = settings.MEMCACHED_OBJECT_TIMEOUT_JITTER
+        return time.time() + soft_timeout * (1 + random.uniform(-jitter, jitter))
+
+    @classmethod
+    def get_timeout(cls):
+        # 加一点随机，避免同一批写入的 key 在同一时刻一起过期
+        jitter = settings.MEMCACHED_OBJECT_TIMEOUT_JITTER
+        return int(settings.MEMCACHED_OBJECT_TIMEOUT * (1 + random.uniform(-jitter, jitter)))
+
+    @classmethod
+    def get_many_through_cache(cls, keys, load, soft_timeout=None):
+        """
+        load(missing_keys) 从数据库读取没有命中的 keys，返回 {key: value}
+        不存在的数据可以返回 NOT_FOUND，会被 cache 一小段时间
+        soft_timeout 秒之后数据需要刷新，刷新期间其他请求读到的是旧数据
+        """
+        values = IdentityMap.get_many(keys)
+        missing_keys = [key for key in keys if key not in values]
+        if not missing_keys:
+            return values
+
+        local_values = LocalCache.get_many(missing_keys)
+        IdentityMap.set_many(local_values)
+        values.update(local_values)
+        missing_keys = [key for key in missing_keys if key not in local_values]
+        if not missing_keys:
+            return values
+
+        # 数据和 generation 在同一次 get_many 里读出来
+        namespace = CacheMetrics.get_namespace(missing_keys[0])
+        generation_keys = [cls.get_generation_key(key) for key in missing_keys]
+        with CacheMetrics.count_errors('memcached', namespace):
+            cached = cache.get_many(missing_keys + generation_keys)
+        generations = {}
+        memcached_values = {}
+        leased_keys = []
+        now = time.time()
+        for key, generation_key in zip(missing_keys, generation_keys):
+            generations[key] = cached.get(generation_key)
+            entry = cached.get(key)
+            if entry is None or generations[key] is None or entry[0] != generations[key]:
+                continue
+            _, soft_expire_at, value = entry
+            if soft_expire_at is not None and soft_expire_at < now and cls.acquire_lease(key):
+                leased_keys.append(key)
+                continue
+            memcached_values[key] = value
+        CacheMetrics.incr_keys('memcached', memcached_values, 'hits')
+        cls._set_local(memcached_values)
+        values.update(memcached_values)
+        missing_keys = [key for key in missing_keys if key not in memcached_values]
+        if not missing_keys:
+            return values
+
+        CacheMetrics.incr_keys('memcached', missing_keys, 'misses')
+        cls._ensure_generations(generations)
+        waiting_keys = []
+        for key in missing_keys:
+            if key in leased_keys:
+                continue
+            if cls.acquire_lease(key):
+                leased_keys.append(key)
+            else:
+                waiting_keys.append(key)
+        if waiting_keys:
+            filled_values = cls._wait_for_fill(waiting_keys, generations)
+            cls._set_local(filled_values)
+            values.update(filled_values)
+            missing_keys = [key for key in missing_keys if key not in filled_values]
+            if not missing_keys:
+                return values
+
+        try:
+            with CacheMetrics.measure_fill('memcached', namespace):
+                loaded_values = load(missing_keys)
+                cls._set_many(loaded_values, generations, soft_timeout)
+        finally:
+            if leased_keys:
+                cls.release_leases(leased_keys)
+        values.update(loaded_values)
+        return values
+
+    @classmethod
+    def _set_local(cls, mapping):
+        IdentityMap.set_many(mapping)
+        LocalCache.set_many({
+            key: value
+            for key, value in mapping.items()
+            if value != NOT_FOUND
+        })
+
+    @classmethod
+    def _wait_for_fill(cls, keys, generations):
+        """
+        别的请求拿着 lease 正在去数据库读，隔一小会儿重新读 memcached，返回等到的 {key: value}
+        """
+        values = {}
+        for _ in range(settings.MEMCACHED_LEASE_WAIT_ATTEMPTS):
+            time.sleep(settings.MEMCACHED_LEASE_WAIT_INTERVAL)
+            generation_keys = [cls.get_generation_key(key) for key in keys]
+            cached = cache.get_many(keys + generation_keys)
+            for key, generation_key in zip(keys, generation_keys):
+                # 等待期间被 invalidate 的话，自己去数据库读的时候要用新的 generation
+                generations[key] = cached.get(generation_key, generations[key])
+                entry = cached.get(key)
+                if entry is not None and generations[key] is not None and entry[0] == generations[key]:
+                    values[key] = entry[2]
+            keys = [key for key in keys if key not in values]
+            if not keys:
+                break
+        return values
+
+    @classmethod
+    def _set_many(cls, mapping, generations, soft_timeout=None):
+        # 写回时用的是读之前看到的 generation，中间被 invalidate 过的话这次写入会被丢弃
+        # generation 还是 None 的话 (比如 memcached 不可用) 写进去也不会被读到
+        soft_expire_at = cls.get_soft_expire_at(soft_timeout)
+        found = {
+            key: (generations.get(key), soft_expire_at, value)
+            for key, value in mapping.items()
+            if value != NOT_FOUND
+        }
+        not_found = {
+            key: (generations.get(key), None, value)
+            for key, value in mapping.items()
+            if value == NOT_FOUND
+        }
+        if found:
+            cache.set_many(found, cls.get_timeout())
+        if not_found:
+            cache.set_many(not_found, settings.MEMCACHED_NEGATIVE_TIMEOUT)
+        IdentityMap.set_many(mapping)
+        LocalCache.set_many({key: value for key, (_, _, value) in found.items()})
+
+    @classmethod
+    def invalidate(cls, key):
+        cache.set(
+            cls.get_generation_key(key),
+            uuid.uuid4().hex,
+            settings.MEMCACHED_GENERATION_TIMEOUT,
+        )
+        cache.delete(key)
+        IdentityMap.delete(key)
+        LocalCache.invalidate(key)
 
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        obj = cache.get(key)
-        if obj is not None:
-            return obj
-        
-        obj = model_class.objects.get(id=object_id)
+
+        def load(keys):
+            obj = model_class.objects.filter(id=object_id).first()
+            return {key: obj if obj is not None else NOT_FOUND}
+
+        obj = cls.get_many_through_cache([key], load)[key]
+        if obj == NOT_FOUND:
+            raise model_class.DoesNotExist(
+                '{} matching id={} does not exist.'.format(model_class.__name__, object_id)
+            )
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        一次 get_many 取出所有 objects，没有命中的用一次 IN 查询补齐，再一次 set_many 写回
+        返回 {object_id: object}，不存在的 id 不会出现在结果里
+        """
+        keys = {
+            cls.get_key(model_class, object_id): object_id
+            for object_id in object_ids
+            if object_id is not None
+        }
+
+        def load(missing_keys):
+            fetched_objects = model_class.objects.in_bulk([keys[key] for key in missing_keys])
+            return {
+                key: fetched_objects.get(keys[key], NOT_FOUND)
+                for key in missing_keys
+            }
+
+        return {
+            keys[key]: obj
+            for key, obj in cls.get_many_through_cache(list(keys), load).items()
+            if obj != NOT_FOUND
+        }
+
     @classmethod
     def invalidate_cached_object(cls, model_class, obj):
-        key = cls.get_key(model_class, obj)
-        cache.delete(key)
\ No newline at end of file
+        cls.invalidate(cls.get_key(model_class, obj))
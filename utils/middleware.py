@@ -0,0 +1,58 @@
+from django.conf import settings
+from utils.identity_map import IdentityMap
+import redis
+import time
+
+
+class IdentityMapMiddleware:
+    # 每个请求开始时使用一个新的 identity map，请求结束时清空
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        IdentityMap.begin()
+        try:
+            return self.get_response(request)
+        finally:
+            IdentityMap.end()
+
+
+class LastActiveMiddleware:
+    """
+    记录登录用户最后一次活跃的时间，每个进程对同一个用户每隔 USER_LAST_ACTIVE_INTERVAL 秒最多写一次 redis
+    放在请求结束之后，drf 的 authentication 也已经把 user 设置好了
+    """
+
+    # user_id -> 上一次写 redis 的时间
+    touched_at = {}
+    max_entries = 100000
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            self.touch(user.id)
+        return response
+
+    @classmethod
+    def touch(cls, user_id):
+        now = time.monotonic()
+        touched_at = cls.touched_at.get(user_id)
+        if touched_at is not None and now - touched_at < settings.USER_LAST_ACTIVE_INTERVAL:
+            return
+        if len(cls.touched_at) >= cls.max_entries:
+            cls.touched_at.clear()
+        cls.touched_at[user_id] = now
+
+        from accounts.services import UserService
+        from newsfeeds.services import NewsFeedService
+        try:
+            last_active_at = UserService.touch_last_active(user_id)
+        except redis.RedisError:
+            return
+        if not UserService.is_active_at(last_active_at):
+            NewsFeedService.on_user_returned(user_id, last_active_at)
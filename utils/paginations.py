@@ -1,76 +1,199 @@
+from django.core import signing
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
 from dateutil import parser
-from django.conf import settings
+from utils.time_helpers import datetime_to_microseconds, microseconds_to_datetime
+import base64
+import binascii
+import math
+
+CURSOR_SIGNER = signing.Signer(salt='utils.paginations.cursor')
+
 
 class EndlessPagination(BasePagination):
+    """
+    按 (created_at, id) 倒序翻页，created_at 相同的时候用 id 区分，不会跳过或者重复
+    cursor=<next_cursor> 取更早的一页，since=<previous_cursor> 取更新的一页
+    以前的 created_at__lt / created_at__gt 参数仍然可以用
+    """
     page_size = 20
+    # created_at 相同的时候用来排序的字段，同一个列表里不能重复
+    cursor_tie_field = 'id'
+    cursor_query_param = 'cursor'
+    since_query_param = 'since'
+    invalid_cursor_message = 'Invalid cursor'
     
     def __init__(self) -> None:
         super(EndlessPagination, self).__init__()
         self.has_next_page = False
+        self.has_previous_page = False
+        self.page = []
+        self.since = None
 
     def to_html(self):
         pass
 
-    def paginate_ordered_list(self, reverse_ordered_list, request):
-        if 'created_at__gt' in request.query_params:
-            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            objects = []
-            for obj in reverse_ordered_list:
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
-                    break
-            self.has_next_page = False
-            return objects
-        
-        index = 0
-        if 'created_at__lt' in request.query_params:
-            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                reverse_ordered_list = []
-        self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index+self.page_size]
+    def get_cursor_key(self, obj):
+        return datetime_to_microseconds(obj.created_at), getattr(obj, self.cursor_tie_field)
 
+    def encode_cursor(self, obj):
+        return self.encode_cursor_key(self.get_cursor_key(obj))
 
-    def paginate_queryset(self, queryset, request, view=None):
+    def encode_cursor_key(self, cursor_key):
+        # 签名之后再 base64，客户端不能构造或者修改 cursor
+        value = '{}.{}'.format(*cursor_key)
+        return base64.urlsafe_b64encode(CURSOR_SIGNER.sign(value).encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        try:
+            value = CURSOR_SIGNER.unsign(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii'))
+            microseconds, object_id = value.split('.')
+            return int(microseconds), int(object_id)
+        except (signing.BadSignature, binascii.Error, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_cursors(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        since = request.query_params.get(self.since_query_param)
+        return (
+            self.decode_cursor(cursor) if cursor else None,
+            self.decode_cursor(since) if since else None,
+        )
 
-        # if type(queryset) == list:
-        #     return self.paginate_ordered_list(queryset, request)
+    def set_page(self, page, has_next_page, has_previous_page=False):
+        self.page = page
+        self.has_next_page = has_next_page
+        self.has_previous_page = has_previous_page
+        return page
 
+    def paginate_queryset(self, queryset, request, view=None):
         if 'created_at__gt' in request.query_params:
-            # 下拉
+            # 下拉，从 created_at__gt 开始往新的方向取一页，再按倒序返回
             created_at__gt = request.query_params['created_at__gt']
             queryset = queryset.filter(created_at__gt=created_at__gt)
-            self.has_next_page = False
-            return queryset.order_by('-created_at')
+            objects = list(queryset.order_by('created_at', self.cursor_tie_field)[:self.page_size + 1])
+            return self.set_page(objects[:self.page_size][::-1], False, len(objects) > self.page_size)
 
         if 'created_at__lt' in request.query_params:
             created_at__lt = request.query_params['created_at__lt']
             queryset = queryset.filter(created_at__lt=created_at__lt)
+            queryset = queryset.order_by('-created_at')[:self.page_size + 1]
+            objects = list(queryset)
+            return self.set_page(objects[:self.page_size], len(objects) > self.page_size)
+
+        # (created_at, id) < cursor 拆成两个条件，都可以用 (user, created_at) 的索引
+        cursor, self.since = self.get_cursors(request)
+        tie_field = self.cursor_tie_field
+        if self.since is not None:
+            created_at = microseconds_to_datetime(self.since[0])
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, **{tie_field + '__gt': self.since[1]})
+            )
+            # 从 since 开始往新的方向取一页，再按倒序返回
+            objects = list(queryset.order_by('created_at', tie_field)[:self.page_size + 1])
+            return self.set_page(objects[:self.page_size][::-1], False, len(objects) > self.page_size)
 
-        queryset = queryset.order_by('-created_at')[:self.page_size+1]
-        self.has_next_page = len(queryset) > self.page_size
-        return queryset[:self.page_size]
+        if cursor is not None:
+            created_at = microseconds_to_datetime(cursor[0])
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, **{tie_field + '__lt': cursor[1]})
+            )
+        objects = list(queryset.order_by('-created_at', '-' + tie_field)[:self.page_size + 1])
+        return self.set_page(objects[:self.page_size], len(objects) > self.page_size)
 
     def get_paginated_response(self, data):
+        previous_cursor = self.encode_cursor(self.page[0]) if self.page else None
+        if previous_cursor is None and self.since is not None:
+            # 没有更新的数据，下次还用同一个位置
+            previous_cursor = self.encode_cursor_key(self.since)
         return Response({
             'has_next_page': self.has_next_page,
+            'has_previous_page': self.has_previous_page,
+            'next_cursor': self.encode_cursor(self.page[-1]) if self.has_next_page else None,
+            'previous_cursor': previous_cursor,
             'results': data,
         })
 
 
-    def paginate_cached_list(self, cached_list, request):
-        paginated_list = self.paginate_ordered_list(cached_list, request)
+    def paginate_cached_list(self, load_cached_window, request):
+        """
+        load_cached_window(created_at__lt=None, created_at__gt=None, limit=None, ascending=False)
+        只从 cache 里取出这一页需要的 objects，返回 None 表示需要去数据库里读取
+        """
         if 'created_at__gt' in request.query_params:
-            return paginated_list
-        if self.has_next_page:
-            return paginated_list
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
-            return paginated_list
-        return None
-        
\ No newline at end of file
+            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+            # 比 created_at__gt 新的所有 objects，id 取无穷大，时间戳相同的都不要
+            return self._load_since(
+                load_cached_window,
+                (datetime_to_microseconds(created_at__gt), math.inf),
+            )
+
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
+            # 多取一个，用来判断是否还有下一页
+            objects = load_cached_window(
+                created_at__lt=created_at__lt,
+                limit=self.page_size + 1,
+            )
+            if objects is None:
+                return None
+            return self.set_page(objects[:self.page_size], len(objects) > self.page_size)
+
+        cursor, self.since = self.get_cursors(request)
+        if self.since is not None:
+            return self._load_since(load_cached_window, self.since)
+        return self._load_before(load_cached_window, cursor)
+
+    def _load_before(self, load_cached_window, cursor):
+        """
+        cache 里的 score 只有 created_at，窗口包含 cursor 的那个时间戳，在这里按 (created_at, id) 过滤和排序
+        窗口取满的时候最早的那个时间戳可能还有没取到的 objects，只用比它新的部分，不够一页就扩大窗口重新取
+        """
+        created_at__lt = None
+        if cursor is not None:
+            created_at__lt = microseconds_to_datetime(cursor[0] + 1)
+        limit = self.page_size + 1
+        while True:
+            window = load_cached_window(created_at__lt=created_at__lt, limit=limit)
+            if window is None:
+                return None
+            objects = sorted(window, key=self.get_cursor_key, reverse=True)
+            if cursor is not None:
+                objects = [obj for obj in objects if self.get_cursor_key(obj) < cursor]
+            if len(window) < limit:
+                # 窗口没有取满，已经是全部的 objects 了
+                break
+            oldest = datetime_to_microseconds(objects[-1].created_at)
+            complete = [obj for obj in objects if self.get_cursor_key(obj)[0] > oldest]
+            if len(complete) > self.page_size:
+                objects = complete
+                break
+            limit *= 2
+        return self.set_page(objects[:self.page_size], len(objects) > self.page_size)
+
+    def _load_since(self, load_cached_window, since):
+        """
+        从 since 开始从旧到新取一页，返回离 since 最近的一页，按倒序返回
+        和 _load_before 一样，窗口取满的时候最新的那个时间戳可能还有没取到的 objects，不够一页就扩大窗口重新取
+        """
+        created_at__gt = microseconds_to_datetime(since[0] - 1)
+        limit = self.page_size + 1
+        while True:
+            window = load_cached_window(created_at__gt=created_at__gt, limit=limit, ascending=True)
+            if window is None:
+                return None
+            objects = sorted(
+                [obj for obj in window if self.get_cursor_key(obj) > since],
+                key=self.get_cursor_key,
+            )
+            if len(window) < limit:
+                break
+            newest = max(datetime_to_microseconds(obj.created_at) for obj in window)
+            complete = [obj for obj in objects if self.get_cursor_key(obj)[0] < newest]
+            if len(complete) > self.page_size:
+                objects = complete
+                break
+            limit *= 2
+        return self.set_page(objects[:self.page_size][::-1], False, len(objects) > self.page_size)
@@ -1,24 +1,76 @@
 from django.conf import settings
+import os
 import redis
 
 class RedisClient:
-    conn = None
+    """
+    每个进程按名字各自维护一个 ConnectionPool
+    celery prefork 和 gunicorn 的 worker 都是 fork 出来的，pid 变了就重新建 pool，
+    不能和父进程共用同一个 socket
+    """
+    pid = None
+    pools = {}
+    connections = {}
 
     @classmethod
-    def get_connection(cls):
-        if cls.conn:
-            return cls.conn
-        cls.conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-        )
-        return cls.conn
+    def _check_pid(cls):
+        if cls.pid == os.getpid():
+            return
+        cls.pid = os.getpid()
+        cls.pools = {}
+        cls.connections = {}
+
+    @classmethod
+    def get_pool_options(cls, name):
+        if name not in settings.REDIS_POOLS:
+            raise ValueError('redis pool {} is not configured'.format(name))
+        options = {
+            'host': settings.REDIS_HOST,
+            'port': settings.REDIS_PORT,
+            'db': settings.REDIS_DB,
+        }
+        options.update(settings.REDIS_CONNECTION_OPTIONS)
+        options.update(settings.REDIS_POOLS[name])
+        return options
+
+    @classmethod
+    def get_pool(cls, name='cache'):
+        cls._check_pid()
+        if name not in cls.pools:
+            cls.pools[name] = redis.ConnectionPool(**cls.get_pool_options(name))
+        return cls.pools[name]
+
+    @classmethod
+    def get_connection(cls, name='cache'):
+        cls._check_pid()
+        if name not in cls.connections:
+            cls.connections[name] = redis.Redis(connection_pool=cls.get_pool(name))
+        return cls.connections[name]
+
+    @classmethod
+    def get_pool_stats(cls):
+        cls._check_pid()
+        stats = {}
+        for name, pool in cls.pools.items():
+            in_use = len(pool._in_use_connections)
+            stats[name] = {
+                'max_connections': pool.max_connections,
+                'created_connections': pool._created_connections,
+                'in_use_connections': in_use,
+                'available_connections': len(pool._available_connections),
+                'utilization': in_use / pool.max_connections,
+            }
+        return stats
 
     @classmethod
     def clear(cls):
         if not settings.TESTING:
             raise Exception('You can not flush redis in production environment')
-        conn = cls.get_connection()
-        conn.flushdb()
-
+        flushed = set()
+        for name in settings.REDIS_POOLS:
+            options = cls.get_pool_options(name)
+            location = (options['host'], options['port'], options['db'])
+            if location in flushed:
+                continue
+            flushed.add(location)
+            cls.get_connection(name).flushdb()
@@ -1,90 +1,601 @@
+import uuid
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, When
+from utils.cache_metrics import CacheMetrics
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+from utils.redis_serializers import CompactModelSerializer
+from utils.time_helpers import datetime_to_microseconds, utc_now
+from datetime import timedelta
+
+# key 存在就直接加进去；正在重建的话先放到 pending 里，等重建完成后合并
+PUSH_MEMBER_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+    return 1
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[3], ARGV[4])
+    return 2
+end
+return 0
+"""
+
+# 把临时 key 和 pending 合并之后 RENAME 成正式的 key，读的人要么看到旧的要么看到完整的
+PUBLISH_REBUILD_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    redis.call('ZUNIONSTORE', KEYS[2], 2, KEYS[2], KEYS[3])
+    redis.call('DEL', KEYS[3])
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[1]) - 1)
+redis.call('RENAME', KEYS[2], KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if redis.call('GET', KEYS[4]) == ARGV[3] then
+    redis.call('DEL', KEYS[4])
+end
+return 1
+"""
+
+# 计数已经在 cache 里就直接加减，不在的话用数据库里的值初始化
+CHANGE_COUNT_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return tonumber(ARGV[3])
+"""
+
+# write-behind 模式下同时把增量记到 deltas 里，由定时任务批量写回数据库
+# cache 里没有这个计数的时候只记增量，不知道正在写回的那一批有没有提交，交给 get_counts 初始化
+CHANGE_COUNT_WRITE_BEHIND_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], ARGV[3], ARGV[2])
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+return false
+"""
+
+# 上一次 flush 没有完成的话 flushing 还在，先把它写完；否则把当前的 deltas 整个拿走
+# 每一批 flushing 有一个 flush id，拿走 deltas 的时候 sequence 加一，读计数的时候用来判断中间有没有 flush
+TAKE_DELTAS_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return false
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('INCR', KEYS[3])
+end
+redis.call('HSETNX', KEYS[2], ARGV[1], ARGV[2])
+return redis.call('HGET', KEYS[2], ARGV[1])
+"""
+
+# 只删除自己写回的那一批 flushing
+DELETE_FLUSHING_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# 锁的值是拿锁时的 token，只释放自己的锁
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# flushing hash 里保存 flush id 的 field，增量的 field 都是 '{id}:{attr}'，不会冲突
+FLUSH_ID_FIELD = 'flush_id'
 
 class RedisHelper:
 
+    scripts = {}
+
+    @classmethod
+    def _get_script(cls, script_name, source):
+        if script_name not in cls.scripts:
+            cls.scripts[script_name] = RedisClient.get_connection().register_script(source)
+        return cls.scripts[script_name]
+
+    @classmethod
+    def _run_script(cls, script_name, source, keys, args, name='cache'):
+        conn = RedisClient.get_connection(name)
+        return cls._get_script(script_name, source)(keys=keys, args=args, client=conn)
+
+    @classmethod
+    def get_score(cls, obj):
+        return datetime_to_microseconds(obj.created_at)
+
+    @classmethod
+    def get_fill_lock_key(cls, key):
+        return '{}:filling'.format(key)
+
+    @classmethod
+    def get_pending_key(cls, key):
+        return '{}:pending'.format(key)
+
     @classmethod
-    def _load_objects_to_cache(cls, key, objects):
+    def acquire_fill_lock(cls, key):
+        """
+        同一个 key 同一时间只允许一个 worker 重建，拿到锁返回 token，否则返回 None
+        """
         conn = RedisClient.get_connection()
+        token = uuid.uuid4().hex
+        acquired = conn.set(
+            cls.get_fill_lock_key(key),
+            token,
+            nx=True,
+            ex=settings.REDIS_FILL_LOCK_TIMEOUT,
+        )
+        return token if acquired else None
 
-        serialized_list = []
+    @classmethod
+    def _schedule_rebuild(cls, key, rebuild):
+        # 只有拿到锁的那一个请求去触发异步重建，其他请求直接读数据库
+        token = cls.acquire_fill_lock(key)
+        if token is not None:
+            rebuild(token)
+
+    @classmethod
+    def fill_members(cls, key, members, token):
+        """
+        先写到临时 key 里，再原子地 RENAME 过去
+        数据库里没有数据的时候不写 cache，锁留到过期，避免空列表被反复重建
+        """
+        conn = RedisClient.get_connection()
+        tmp_key = '{}:tmp:{}'.format(key, token)
+        if members:
+            pipe = conn.pipeline()
+            pipe.zadd(tmp_key, members)
+            pipe.expire(tmp_key, settings.REDIS_FILL_LOCK_TIMEOUT)
+            pipe.execute()
+        cls._run_script(
+            'publish_rebuild',
+            PUBLISH_REBUILD_SCRIPT,
+            keys=[key, tmp_key, cls.get_pending_key(key), cls.get_fill_lock_key(key)],
+            args=[settings.REDIS_LIST_LENGTH_LIMIT, settings.REDIS_KEY_EXPIRE_TIME, token],
+        )
+
+    @classmethod
+    def fill_objects(cls, key, queryset, token):
+        serialized_mapping = {}
         # 最多只 cache REDIS_LIST_LENGTH_LIMIT 那么多个 objects
         # 超过这个限制的 objects，就去数据库里读取。一般这个限制会比较大，比如 1000
         # 因此翻页翻到 1000 的用户访问量会比较少，从数据库读取也不是大问题
-        for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
-            serialized_data = DjangoModelSerializer.serialize(obj)
-            serialized_list.append(serialized_data)
+        with CacheMetrics.measure_fill('redis', CacheMetrics.get_namespace(key)):
+            for obj in queryset[:settings.REDIS_LIST_LENGTH_LIMIT]:
+                serialized_data = CompactModelSerializer.serialize(obj)
+                serialized_mapping[serialized_data] = cls.get_score(obj)
+            cls.fill_members(key, serialized_mapping, token)
+
+    @classmethod
+    def _get_score_range(cls, created_at__lt=None, created_at__gt=None):
+        max_score = '+inf'
+        if created_at__lt is not None:
+            max_score = '({}'.format(datetime_to_microseconds(created_at__lt))
+        min_score = '-inf'
+        if created_at__gt is not None:
+            min_score = '({}'.format(datetime_to_microseconds(created_at__gt))
+        return max_score, min_score
 
-        if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+    @classmethod
+    def _read_window(cls, key, created_at__lt, created_at__gt, limit, withscores=False, ascending=False):
+        return cls._read_windows([key], created_at__lt, created_at__gt, limit, withscores, ascending)[0]
 
     @classmethod
-    def load_objects(cls, key, queryset):
+    def _read_windows(cls, keys, created_at__lt, created_at__gt, limit, withscores=False, ascending=False):
+        """
+        默认从新到旧读，ascending 的时候从 created_at__gt 开始从旧到新读，
+        同时读出 cache 里最早的 score，用来判断 created_at__gt 之后的数据是不是都还在 cache 里
+        返回和 keys 一一对应的 [(cached_count, items), ...]
+        """
         conn = RedisClient.get_connection()
+        max_score, min_score = cls._get_score_range(created_at__lt, created_at__gt)
+        page = {} if limit is None else {'start': 0, 'num': limit}
 
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            return objects
+        # 所有 keys 的 ZCARD 和 ZREVRANGEBYSCORE 放在一个 pipeline 里，只需要一次网络往返
+        pipe = conn.pipeline()
+        for key in keys:
+            pipe.zcard(key)
+            if ascending:
+                pipe.zrangebyscore(key, min_score, max_score, withscores=withscores, **page)
+                pipe.zrange(key, 0, 0, withscores=True)
+            else:
+                pipe.zrevrangebyscore(key, max_score, min_score, withscores=withscores, **page)
+        with CacheMetrics.count_errors('redis', CacheMetrics.get_namespace(keys[0])):
+            results = pipe.execute()
+
+        step = 3 if ascending else 2
+        windows = []
+        for index, key in enumerate(keys):
+            cached_count, items, *oldest = results[index * step:(index + 1) * step]
+            CacheMetrics.incr(
+                'redis',
+                CacheMetrics.get_namespace(key),
+                'bytes',
+                sum(len(item[0] if withscores else item) for item in items),
+            )
+            if ascending and cached_count >= settings.REDIS_LIST_LENGTH_LIMIT and oldest[0]:
+                # cache 已经存满了，比 created_at__gt 新的数据可能有一部分已经被挤出 cache 了
+                if created_at__gt is None or oldest[0][0][1] > datetime_to_microseconds(created_at__gt):
+                    items = None
+            windows.append((cached_count, items))
+        return windows
 
-        cls._load_objects_to_cache(key, queryset)
-        return list(queryset)
+    @classmethod
+    def _record_window(cls, key, hit):
+        CacheMetrics.incr('redis', CacheMetrics.get_namespace(key), 'hits' if hit else 'misses')
+
+    @classmethod
+    def _window_exceeds_cache(cls, cached_count, items, limit, created_at__gt=None, ascending=False):
+        if items is None:
+            return True
+        if cached_count < settings.REDIS_LIST_LENGTH_LIMIT or ascending:
+            return False
+        # cache 已经存满了，取到的数量又不够，说明更早的数据只在数据库里
+        if limit is not None and len(items) < limit:
+            return True
+        # 从 created_at__gt 往后取到了整个 cache，紧挨着 created_at__gt 的数据可能已经被挤出 cache 了
+        return created_at__gt is not None and len(items) >= cached_count
 
     @classmethod
-    def push_object(cls, key, obj, queryset):
+    def load_objects(cls, key, queryset, rebuild):
         conn = RedisClient.get_connection()
-        if not conn.exists(key):
-            cls._load_objects_to_cache(key, queryset)
-            return 
 
-        serialized_data = DjangoModelSerializer.serialize(obj)
-        conn.lpush(key, serialized_data)
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        if conn.exists(key):
+            serialized_list = conn.zrevrange(key, 0, -1)
+            cls._record_window(key, True)
+            return CompactModelSerializer.deserialize_many(queryset.model, serialized_list)
 
+        cls._record_window(key, False)
+        cls._schedule_rebuild(key, rebuild)
+        return list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
 
     @classmethod
-    def get_count_key(cls, obj, attr):
-        return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
+    def load_objects_window(
+        cls, key, queryset, rebuild, created_at__lt=None, created_at__gt=None, limit=None, ascending=False,
+    ):
+        """
+        只读取并反序列化翻页需要的那一段 objects，而不是整个 cache 的列表
+        返回 None 表示 cache 里没有或者这个窗口超出了 cache 的范围，需要去数据库里读取
+        """
+        return cls.load_objects_windows(
+            queryset.model, [key], [rebuild], created_at__lt, created_at__gt, limit, ascending,
+        )[0]
 
     @classmethod
-    def incr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
+    def load_objects_windows(
+        cls, model_class, keys, rebuilds, created_at__lt=None, created_at__gt=None, limit=None, ascending=False,
+    ):
+        """
+        一次 pipeline 读出多个列表的同一个窗口，返回和 keys 一一对应的 objects 列表，规则和 load_objects_window 一样
+        """
+        windows = []
+        read_windows = cls._read_windows(keys, created_at__lt, created_at__gt, limit, ascending=ascending)
+        for key, rebuild, (cached_count, serialized_list) in zip(keys, rebuilds, read_windows):
+            if not cached_count:
+                cls._record_window(key, False)
+                cls._schedule_rebuild(key, rebuild)
+                windows.append(None)
+            elif cls._window_exceeds_cache(cached_count, serialized_list, limit, created_at__gt, ascending):
+                cls._record_window(key, False)
+                windows.append(None)
+            else:
+                cls._record_window(key, True)
+                windows.append(CompactModelSerializer.deserialize_many(model_class, serialized_list))
+        return windows
+
+    @classmethod
+    def load_members_window(
+        cls, key, rebuild, created_at__lt=None, created_at__gt=None, limit=None, ascending=False,
+    ):
+        """
+        sorted set 里只存 id 之类的轻量 member 时使用，返回 [(member, score), ...]
+        返回 None 表示 cache 里没有或者这个窗口超出了 cache 的范围，需要去数据库里读取
+        """
+        cached_count, items = cls._read_window(
+            key, created_at__lt, created_at__gt, limit, withscores=True, ascending=ascending,
+        )
+        if not cached_count:
+            cls._record_window(key, False)
+            cls._schedule_rebuild(key, rebuild)
+            return None
+
+        if cls._window_exceeds_cache(cached_count, items, limit, created_at__gt, ascending):
+            cls._record_window(key, False)
+            return None
+        cls._record_window(key, True)
+        return [(member, int(score)) for member, score in items]
+
+    @classmethod
+    def push_object(cls, key, obj, rebuild):
+        serialized_data = CompactModelSerializer.serialize(obj)
+        cls.push_member(key, serialized_data, cls.get_score(obj), rebuild)
+
+    @classmethod
+    def _get_push_member_params(cls, key, member, score):
+        keys = [key, cls.get_fill_lock_key(key), cls.get_pending_key(key)]
+        args = [
+            member,
+            score,
+            settings.REDIS_LIST_LENGTH_LIMIT,
+            settings.REDIS_FILL_LOCK_TIMEOUT,
+        ]
+        return keys, args
 
-        if not conn.exists(key):
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
+    @classmethod
+    def push_member(cls, key, member, score, rebuild):
+        keys, args = cls._get_push_member_params(key, member, score)
+        pushed = cls._run_script('push_member', PUSH_MEMBER_SCRIPT, keys=keys, args=args)
+        # 不在 signal 里同步重建整个列表，交给异步任务去做
+        if not pushed:
+            cls._schedule_rebuild(key, rebuild)
 
-        return conn.incr(key)
+    @classmethod
+    def push_members(cls, items):
+        """
+        items 是 [(key, member, score), ...]，所有的写入放在一个 pipeline 里，只需要一次网络往返
+        cache 里没有的 key 直接跳过，不触发重建，等这个用户下次读取的时候再重建
+        返回写入了多少个 key（包括写到正在重建的 pending 里的）
+        """
+        if not items:
+            return 0
+        script = cls._get_script('push_member', PUSH_MEMBER_SCRIPT)
+        pipe = RedisClient.get_connection().pipeline(transaction=False)
+        for key, member, score in items:
+            keys, args = cls._get_push_member_params(key, member, score)
+            script(keys=keys, args=args, client=pipe)
+        return sum(1 for pushed in pipe.execute() if pushed)
+
+    @classmethod
+    def get_counts_key(cls, model_class, object_id):
+        # 每个 object 的所有计数存在一个 hash 里
+        return '{}.counts:{}'.format(model_class.__name__, object_id)
+
+    @classmethod
+    def get_count_deltas_key(cls, model_class):
+        # 同一个 model 所有还没写回数据库的增量，field 是 '{id}:{attr}'
+        return '{}.count_deltas'.format(model_class.__name__)
+
+    @classmethod
+    def get_count_flushing_key(cls, model_class):
+        return '{}:flushing'.format(cls.get_count_deltas_key(model_class))
+
+    @classmethod
+    def get_count_sequence_key(cls, model_class):
+        return '{}:sequence'.format(cls.get_count_deltas_key(model_class))
+
+    @classmethod
+    def _change_count(cls, obj, attr, delta):
+        key = cls.get_counts_key(obj.__class__, obj.id)
+        if settings.COUNTERS_WRITE_BEHIND:
+            return cls._run_script(
+                'change_count_write_behind',
+                CHANGE_COUNT_WRITE_BEHIND_SCRIPT,
+                keys=[key, cls.get_count_deltas_key(obj.__class__)],
+                args=[attr, delta, '{}:{}'.format(obj.id, attr)],
+                name='counters',
+            )
+        return cls._run_script(
+            'change_count',
+            CHANGE_COUNT_SCRIPT,
+            keys=[key],
+            args=[attr, delta, getattr(obj, attr) or 0, settings.REDIS_KEY_EXPIRE_TIME],
+            name='counters',
+        )
+
+    @classmethod
+    def incr_count(cls, obj, attr):
+        return cls._change_count(obj, attr, 1)
 
     @classmethod
     def decr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
+        return cls._change_count(obj, attr, -1)
+
+    @classmethod
+    def get_counts(cls, model_class, object_ids, attrs, flush_model):
+        """
+        一次 pipeline 读出一批 objects 的计数，没有命中的用一次 IN 查询补齐并写回 cache
+        flush_model 是记录已经写回的 flush id 的 model，由调用的 app 提供
+        返回 {object_id: {attr: count}}
+        """
+        conn = RedisClient.get_connection('counters')
+        object_ids = list(dict.fromkeys(
+            object_id for object_id in object_ids if object_id is not None
+        ))
 
-        if not conn.exists(key):      
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
+        pipe = conn.pipeline(transaction=False)
+        for object_id in object_ids:
+            pipe.hmget(cls.get_counts_key(model_class, object_id), attrs)
 
-        return conn.decr(key)
+        namespace = '{}.counts'.format(model_class.__name__)
+        with CacheMetrics.count_errors('redis', namespace):
+            results = pipe.execute()
+        counts = {}
+        missing_ids = []
+        for object_id, values in zip(object_ids, results):
+            if None in values:
+                missing_ids.append(object_id)
+                continue
+            counts[object_id] = {
+                attr: int(value)
+                for attr, value in zip(attrs, values)
+            }
+
+        CacheMetrics.incr('redis', namespace, 'hits', len(counts))
+        if not missing_ids:
+            return counts
+
+        CacheMetrics.incr('redis', namespace, 'misses', len(missing_ids))
+        with CacheMetrics.measure_fill('redis', namespace):
+            loaded, stable = cls._load_counts(model_class, missing_ids, attrs, flush_model)
+            counts.update(loaded)
+            # 读的过程中一直有 flush 在拿走增量的话，这次读到的计数不写回 cache
+            if stable:
+                pipe = conn.pipeline(transaction=False)
+                for object_id, object_counts in loaded.items():
+                    key = cls.get_counts_key(model_class, object_id)
+                    pipe.hset(key, mapping=object_counts)
+                    pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                pipe.execute()
+        return counts
 
     @classmethod
-    def get_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
+    def _load_counts(cls, model_class, object_ids, attrs, flush_model):
+        """
+        数据库里的值加上还没写回的增量才是真正的计数，返回 ({object_id: {attr: count}}, stable)
+
+        先读 redis 里的增量，再在一个事务里读数据库和 flushing 有没有写回过，
+        flushing 在这中间写回了就不再加它的增量；中间又有新的 deltas 被拿走 (sequence 变了) 就重新读
+        """
+        for _ in range(3):
+            sequence, flush_id, deltas, flushing = cls._get_pending_deltas(model_class, object_ids, attrs)
+            queryset = model_class.objects.filter(id__in=object_ids).values_list('id', *attrs)
+            flushed = False
+            if flush_id is None:
+                rows = list(queryset)
+            else:
+                with transaction.atomic():
+                    rows = list(queryset)
+                    flushed = flush_model.objects.filter(flush_id=flush_id).exists()
+            if not flushed:
+                for field, delta in flushing.items():
+                    deltas[field] = deltas.get(field, 0) + delta
+            counts = {
+                object_id: {
+                    attr: (value or 0) + deltas.get('{}:{}'.format(object_id, attr), 0)
+                    for attr, value in zip(attrs, values)
+                }
+                for object_id, *values in rows
+            }
+            if sequence == cls._get_flush_sequence(model_class):
+                return counts, True
+        return counts, False
+
+    @classmethod
+    def get_count(cls, obj, attr, flush_model):
+        counts = cls.get_counts(obj.__class__, [obj.id], [attr], flush_model)
+        return counts.get(obj.id, {}).get(attr, getattr(obj, attr))
+
+    @classmethod
+    def _get_flush_sequence(cls, model_class):
+        if not settings.COUNTERS_WRITE_BEHIND:
+            return None
+        return RedisClient.get_connection('counters').get(cls.get_count_sequence_key(model_class))
+
+    @classmethod
+    def _get_pending_deltas(cls, model_class, object_ids, attrs):
+        """
+        返回 (sequence, flushing 的 flush id, deltas 里的增量, flushing 里的增量)，在一个事务里读出来
+        """
+        if not settings.COUNTERS_WRITE_BEHIND:
+            return None, None, {}, {}
+        conn = RedisClient.get_connection('counters')
+        fields = [
+            '{}:{}'.format(object_id, attr)
+            for object_id in object_ids
+            for attr in attrs
+        ]
+        pipe = conn.pipeline()
+        pipe.get(cls.get_count_sequence_key(model_class))
+        pipe.hget(cls.get_count_flushing_key(model_class), FLUSH_ID_FIELD)
+        pipe.hmget(cls.get_count_deltas_key(model_class), fields)
+        pipe.hmget(cls.get_count_flushing_key(model_class), fields)
+        sequence, flush_id, *results = pipe.execute()
+        pending = []
+        for values in results:
+            pending.append({
+                field: int(value)
+                for field, value in zip(fields, values)
+                if value is not None
+            })
+        if flush_id is not None:
+            flush_id = flush_id.decode('utf-8')
+        return sequence, flush_id, pending[0], pending[1]
+
+    @classmethod
+    def flush_count_deltas(cls, model_class, flush_model):
+        """
+        把累积的增量批量写回数据库，每个 object 每次 flush 只更新一次
+        增量先 RENAME 到 flushing 里，数据库事务提交之后才删除，worker 中途挂掉不会丢增量
+        flush id 和 UPDATE 在同一个事务里写入 flush_model，提交之后没来得及删除的 flushing 不会被再写一次
+        返回更新的 objects 数量
+        """
+        conn = RedisClient.get_connection('counters')
+        deltas_key = cls.get_count_deltas_key(model_class)
+        flushing_key = cls.get_count_flushing_key(model_class)
+
+        # 同一时间只能有一个 worker 在写回，否则 flushing 里的增量会被写两次
+        lock_key = '{}:lock'.format(flushing_key)
+        lock_token = uuid.uuid4().hex
+        if not conn.set(lock_key, lock_token, nx=True, ex=settings.COUNTERS_FLUSH_LOCK_TIMEOUT):
+            return 0
+        try:
+            flush_id = cls._run_script(
+                'take_deltas',
+                TAKE_DELTAS_SCRIPT,
+                keys=[deltas_key, flushing_key, cls.get_count_sequence_key(model_class)],
+                args=[FLUSH_ID_FIELD, uuid.uuid4().hex],
+                name='counters',
+            )
+            if not flush_id:
+                return 0
+            flush_id = flush_id.decode('utf-8')
 
-        count = conn.get(key)
-        if count is not None:
-            return int(count)
+            # {attr: {object_id: delta}}
+            deltas = {}
+            for field, value in conn.hgetall(flushing_key).items():
+                field = field.decode('utf-8')
+                if field == FLUSH_ID_FIELD:
+                    continue
+                object_id, attr = field.split(':')
+                if int(value):
+                    deltas.setdefault(attr, {})[int(object_id)] = int(value)
 
-        obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
-        return count   
\ No newline at end of file
+            updated_ids = set()
+            batch_size = settings.COUNTERS_FLUSH_BATCH_SIZE
+            with transaction.atomic():
+                # 上一次已经提交了，只是 flushing 没来得及删除
+                if not flush_model.objects.filter(flush_id=flush_id).exists():
+                    for attr, object_deltas in deltas.items():
+                        object_ids = list(object_deltas)
+                        for start in range(0, len(object_ids), batch_size):
+                            batch_ids = object_ids[start:start + batch_size]
+                            # 一条 UPDATE ... SET attr = CASE id WHEN ... END 更新一批 objects
+                            model_class.objects.filter(id__in=batch_ids).update(**{
+                                attr: Case(
+                                    *[
+                                        When(id=object_id, then=F(attr) + object_deltas[object_id])
+                                        for object_id in batch_ids
+                                    ],
+                                    default=F(attr),
+                                ),
+                            })
+                        updated_ids.update(object_ids)
+                    flush_model.objects.create(flush_id=flush_id)
+                flush_model.objects.filter(
+                    created_at__lt=utc_now() - timedelta(seconds=settings.COUNTERS_FLUSH_RECORD_TIMEOUT),
+                ).delete()
+            cls._run_script(
+                'delete_flushing',
+                DELETE_FLUSHING_SCRIPT,
+                keys=[flushing_key],
+                args=[FLUSH_ID_FIELD, flush_id],
+                name='counters',
+            )
+            return len(updated_ids)
+        finally:
+            cls._run_script(
+                'release_lock',
+                RELEASE_LOCK_SCRIPT,
+                keys=[lock_key],
+                args=[lock_token],
+                name='counters',
+            )
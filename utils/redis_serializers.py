@@ -1,12 +1,209 @@
 from django.core import serializers
 from utils.json_encoder import JSONEncoder
+from utils.time_helpers import datetime_to_microseconds, microseconds_to_datetime
+import struct
 
 class DjangoModelSerializer:
 
     @classmethod
     def serialize(cls, instance):
         return serializers.serialize('json', [instance], cls=JSONEncoder)
-    
+
     @classmethod
     def deserialize(cls, serialized_data):
-        return list(serializers.deserialize('json', serialized_data))[0].object
\ No newline at end of file
+        return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+# 旧的 json 格式都是以 '[' 开头的，version 永远不会用到这个值
+LEGACY_JSON_PREFIX = ord('[')
+
+INT_FIELD_TYPES = (
+    'AutoField',
+    'BigAutoField',
+    'ForeignKey',
+    'OneToOneField',
+    'IntegerField',
+    'BigIntegerField',
+    'SmallIntegerField',
+    'PositiveIntegerField',
+    'PositiveSmallIntegerField',
+)
+STR_FIELD_TYPES = ('CharField', 'TextField', 'FileField')
+
+
+class CompactSchema:
+    """
+    一个 model 某个 version 的二进制格式:
+    version(1B) | null bitmap(2B) | 定长字段 | 每个字符串的长度(2B) | 字符串内容
+    """
+
+    def __init__(self, model_class, version, fields):
+        self.model_class = model_class
+        self.version = version
+        self.fields = fields
+        if len(fields) > 16:
+            raise ValueError('at most 16 fields are supported in one schema')
+
+        model_fields = {
+            field.attname: field
+            for field in model_class._meta.concrete_fields
+        }
+        fixed_format = ''
+        self.fixed_fields = []
+        self.str_fields = []
+        for attname in fields:
+            internal_type = model_fields[attname].get_internal_type()
+            if internal_type in INT_FIELD_TYPES:
+                fixed_format += 'q'
+                self.fixed_fields.append((attname, 'int'))
+            elif internal_type == 'DateTimeField':
+                fixed_format += 'q'
+                self.fixed_fields.append((attname, 'datetime'))
+            elif internal_type == 'BooleanField':
+                fixed_format += '?'
+                self.fixed_fields.append((attname, 'bool'))
+            elif internal_type in STR_FIELD_TYPES:
+                self.str_fields.append(attname)
+            else:
+                raise ValueError('{}.{} ({}) is not supported'.format(
+                    model_class.__name__, attname, internal_type,
+                ))
+
+        self.struct = struct.Struct(
+            '>BH' + fixed_format + 'H' * len(self.str_fields)
+        )
+        # from_db 要求 values 按照 concrete_fields 的顺序排列
+        self.field_names = [
+            field.attname
+            for field in model_class._meta.concrete_fields
+            if field.attname in fields
+        ]
+
+    def encode(self, instance):
+        null_bitmap = 0
+        values = []
+        for index, (attname, kind) in enumerate(self.fixed_fields):
+            value = getattr(instance, attname)
+            if value is None:
+                null_bitmap |= 1 << index
+                value = 0
+            elif kind == 'datetime':
+                value = datetime_to_microseconds(value)
+            values.append(value)
+
+        encoded_strs = []
+        for index, attname in enumerate(self.str_fields, len(self.fixed_fields)):
+            value = getattr(instance, attname)
+            if value is None:
+                null_bitmap |= 1 << index
+                value = ''
+            elif not isinstance(value, str):
+                # FieldFile 只需要存文件名
+                value = value.name or ''
+            encoded_strs.append(value.encode('utf-8'))
+
+        header = self.struct.pack(
+            self.version,
+            null_bitmap,
+            *values,
+            *[len(encoded) for encoded in encoded_strs]
+        )
+        return header + b''.join(encoded_strs)
+
+    def decode(self, data):
+        unpacked = self.struct.unpack_from(data)
+        null_bitmap = unpacked[1]
+        row = {}
+        position = 2
+        for index, (attname, kind) in enumerate(self.fixed_fields):
+            value = unpacked[position]
+            position += 1
+            if null_bitmap & (1 << index):
+                value = None
+            elif kind == 'datetime':
+                value = microseconds_to_datetime(value)
+            row[attname] = value
+
+        offset = self.struct.size
+        for index, attname in enumerate(self.str_fields, len(self.fixed_fields)):
+            length = unpacked[position]
+            position += 1
+            value = data[offset:offset + length].decode('utf-8')
+            offset += length
+            if null_bitmap & (1 << index):
+                value = None
+            row[attname] = value
+
+        return self.model_class.from_db(
+            None,
+            self.field_names,
+            [row[attname] for attname in self.field_names],
+        )
+
+
+class CompactModelSerializer:
+    """
+    按 model 注册的 schema 进行编码，每条数据的第一个字节是 version
+    schema 变化时注册一个新的 version 即可，旧 version 的数据依然可以解码，不需要清空 redis
+    没有注册 schema 的 model 会退回到 DjangoModelSerializer
+    """
+
+    # model_class -> {version: fields}
+    registered_fields = {}
+    # (model_class, version) -> CompactSchema
+    schemas = {}
+
+    @classmethod
+    def register(cls, model_class, version, fields):
+        if not 0 < version < 256 or version == LEGACY_JSON_PREFIX:
+            raise ValueError('invalid schema version {}'.format(version))
+        cls.registered_fields.setdefault(model_class, {})[version] = tuple(fields)
+
+    @classmethod
+    def get_schema(cls, model_class, version=None):
+        versions = cls.registered_fields.get(model_class)
+        if not versions:
+            return None
+        if version is None:
+            version = max(versions)
+        key = (model_class, version)
+        if key not in cls.schemas:
+            if version not in versions:
+                raise ValueError('unknown schema version {} for {}'.format(
+                    version, model_class.__name__,
+                ))
+            cls.schemas[key] = CompactSchema(model_class, version, versions[version])
+        return cls.schemas[key]
+
+    @classmethod
+    def serialize(cls, instance):
+        schema = cls.get_schema(instance.__class__)
+        if schema is None:
+            return DjangoModelSerializer.serialize(instance)
+        return schema.encode(instance)
+
+    @classmethod
+    def deserialize(cls, model_class, serialized_data):
+        if isinstance(serialized_data, str):
+            serialized_data = serialized_data.encode('utf-8')
+        version = serialized_data[0]
+        if version == LEGACY_JSON_PREFIX:
+            return DjangoModelSerializer.deserialize(serialized_data)
+        return cls.get_schema(model_class, version).decode(serialized_data)
+
+    @classmethod
+    def deserialize_many(cls, model_class, serialized_list):
+        # 一次解码整个列表，schema 只查找一次
+        schemas = {}
+        objects = []
+        for serialized_data in serialized_list:
+            if isinstance(serialized_data, str):
+                serialized_data = serialized_data.encode('utf-8')
+            version = serialized_data[0]
+            if version == LEGACY_JSON_PREFIX:
+                objects.append(DjangoModelSerializer.deserialize(serialized_data))
+                continue
+            if version not in schemas:
+                schemas[version] = cls.get_schema(model_class, version)
+            objects.append(schemas[version].decode(serialized_data))
+        return objects
@@ -1,5 +1,16 @@
+from core.cache import CACHE_KEY_PREFIX
+from django.conf import settings
 from testing.testcases import TestCase
+import threading
+import time
+from tweets.models import Tweet
+from django.test import override_settings
+from .cache_metrics import CacheMetrics
+from .identity_map import IdentityMap, MISSING
+from .local_cache import LocalCache
+from .memcached_helper import MemcachedHelper, cache
 from .redis_client import RedisClient
+from .redis_serializers import CompactModelSerializer, DjangoModelSerializer
 
 class UtilTests(TestCase):
     def setUp(self):
@@ -12,4 +23,266 @@ class UtilTests(TestCase):
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [b'2', b'1'])
 
-        
\ No newline at end of file
+    def test_redis_client_pools(self):
+        conn = RedisClient.get_connection()
+        self.assertIs(conn, RedisClient.get_connection('cache'))
+        self.assertIsNot(conn, RedisClient.get_connection('counters'))
+        conn.set('redis_key', 1)
+
+        stats = RedisClient.get_pool_stats()
+        self.assertEqual(stats['cache']['in_use_connections'], 0)
+        self.assertEqual(stats['cache']['available_connections'], 1)
+
+        # fork 之后的子进程会重新创建 pool
+        pool = RedisClient.get_pool('cache')
+        RedisClient.pid = None
+        self.assertIsNot(RedisClient.get_pool('cache'), pool)
+        self.assertEqual(RedisClient.get_connection().get('redis_key'), b'1')
+
+        with self.assertRaises(ValueError):
+            RedisClient.get_connection('not_exists')
+
+    def test_compact_model_serializer(self):
+        alex = self.create_user('alex')
+        tweet = self.create_tweet(alex, '你好 twitter')
+        data = CompactModelSerializer.serialize(tweet)
+        self.assertEqual(data[0], 1)
+        self.assertLess(len(data), len(DjangoModelSerializer.serialize(tweet)))
+
+        cached_tweet = CompactModelSerializer.deserialize(Tweet, data)
+        self.assertEqual(cached_tweet, tweet)
+        self.assertEqual(cached_tweet.user_id, alex.id)
+        self.assertEqual(cached_tweet.content, tweet.content)
+        self.assertEqual(cached_tweet.created_at, tweet.created_at)
+        self.assertEqual(cached_tweet.cached_user, alex)
+
+        # 旧的 json 格式依然可以解码
+        tweet.user = None
+        legacy_data = DjangoModelSerializer.serialize(tweet)
+        tweets = CompactModelSerializer.deserialize_many(
+            Tweet,
+            [CompactModelSerializer.serialize(tweet), legacy_data.encode('utf-8')],
+        )
+        self.assertEqual([t.id for t in tweets], [tweet.id, tweet.id])
+        self.assertEqual([t.user_id for t in tweets], [None, None])
+
+    def test_get_objects_through_cache(self):
+        self.clear_cache()
+        alex = self.create_user('alex')
+        tweets = [self.create_tweet(alex) for _ in range(3)]
+        ids = [tweet.id for tweet in tweets] + [-1]
+
+        # 没有命中时一次 IN 查询，之后全部从 cache 里读，包括不存在的 id
+        with self.assertNumQueries(1):
+            objects = MemcachedHelper.get_objects_through_cache(Tweet, ids)
+        self.assertEqual(sorted(objects), sorted(tweet.id for tweet in tweets))
+        with self.assertNumQueries(0):
+            objects = MemcachedHelper.get_objects_through_cache(Tweet, ids)
+            self.assertEqual(len(objects), 3)
+            self.assertEqual(MemcachedHelper.get_object_through_cache(Tweet, tweets[0].id), tweets[0])
+            with self.assertRaises(Tweet.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(Tweet, -1)
+
+        # 单个读取没有命中时也会写回 cache
+        MemcachedHelper.invalidate_cached_object(Tweet, tweets[1].id)
+        with self.assertNumQueries(1):
+            MemcachedHelper.get_object_through_cache(Tweet, tweets[1].id)
+        with self.assertNumQueries(0):
+            MemcachedHelper.get_object_through_cache(Tweet, tweets[1].id)
+
+    def test_identity_map(self):
+        self.clear_cache()
+        alex = self.create_user('alex')
+        tweet = self.create_tweet(alex)
+
+        # 没有 begin 的时候不生效
+        first = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        self.assertIsNot(MemcachedHelper.get_object_through_cache(Tweet, tweet.id), first)
+
+        IdentityMap.begin()
+        try:
+            first = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+            self.assertIs(MemcachedHelper.get_object_through_cache(Tweet, tweet.id), first)
+            self.assertIs(MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id])[tweet.id], first)
+
+            # 嵌套的 begin / end (比如 eager 模式下的 task) 不会清空外层的 map
+            IdentityMap.begin()
+            IdentityMap.end()
+            self.assertIs(MemcachedHelper.get_object_through_cache(Tweet, tweet.id), first)
+
+            # 修改之后 invalidate 会同时清掉 identity map
+            tweet.content = 'updated content'
+            tweet.save()
+            updated = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+            self.assertIsNot(updated, first)
+            self.assertEqual(updated.content, 'updated content')
+        finally:
+            IdentityMap.end()
+        self.assertIsNot(MemcachedHelper.get_object_through_cache(Tweet, tweet.id), updated)
+
+    @override_settings(LOCAL_CACHE_ENABLED=True, LOCAL_CACHE_MAX_ENTRIES=2)
+    def test_local_cache(self):
+        self.clear_cache()
+        LocalCache.clear()
+        alex = self.create_user('alex')
+        tweets = [self.create_tweet(alex) for _ in range(3)]
+        key = MemcachedHelper.get_key(Tweet, tweets[0].id)
+        # 等订阅线程准备好
+        LocalCache.get(key)
+        self.assertTrue(LocalCache.subscribed.wait(5))
+
+        stats = LocalCache.get_stats()
+        MemcachedHelper.get_object_through_cache(Tweet, tweets[0].id)
+        # memcached 里删掉之后依然可以从进程内读到，并且每次读到的都是新的 object
+        cache.delete(key)
+        with self.assertNumQueries(0):
+            first = MemcachedHelper.get_object_through_cache(Tweet, tweets[0].id)
+            second = MemcachedHelper.get_object_through_cache(Tweet, tweets[0].id)
+        self.assertEqual(first, tweets[0])
+        self.assertIsNot(first, second)
+        self.assertEqual(LocalCache.get_stats()['hits'], stats['hits'] + 2)
+
+        # 超过条数限制时淘汰最久没有用过的
+        MemcachedHelper.get_objects_through_cache(Tweet, [tweets[1].id, tweets[2].id])
+        self.assertEqual(LocalCache.get_stats()['entries'], 2)
+        self.assertEqual(LocalCache.get_stats()['evictions'], stats['evictions'] + 1)
+        self.assertIs(LocalCache.get(key), MISSING)
+
+        # 其他进程发出的失效通知
+        key = MemcachedHelper.get_key(Tweet, tweets[1].id)
+        RedisClient.get_connection('broker').publish(settings.LOCAL_CACHE_CHANNEL, key)
+        for _ in range(50):
+            if key not in LocalCache.entries:
+                break
+            time.sleep(0.1)
+        self.assertNotIn(key, LocalCache.entries)
+
+    def test_stale_fill_is_rejected(self):
+        self.clear_cache()
+        alex = self.create_user('alex')
+        tweet = self.create_tweet(alex, 'old content')
+        key = MemcachedHelper.get_key(Tweet, tweet.id)
+        self.assertTrue(key.startswith(CACHE_KEY_PREFIX))
+
+        # 一个慢请求在 invalidate 之前从数据库读到了旧数据，在 invalidate 之后才写回 cache
+        stale_tweet = Tweet.objects.get(id=tweet.id)
+
+        def slow_load(keys):
+            tweet.content = 'new content'
+            tweet.save()
+            return {key: stale_tweet}
+
+        MemcachedHelper.get_many_through_cache([key], slow_load)
+        cached_tweet = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        self.assertEqual(cached_tweet.content, 'new content')
+
+    def test_missing_generation_is_a_miss(self):
+        self.clear_cache()
+        alex = self.create_user('alex')
+        tweet = self.create_tweet(alex, 'old content')
+        key = MemcachedHelper.get_key(Tweet, tweet.id)
+        generation_key = MemcachedHelper.get_generation_key(key)
+
+        # 还没有 generation 的时候写入，会先创建 generation
+        cache.delete_many([key, generation_key])
+        MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        self.assertIsNotNone(cache.get(generation_key))
+
+        # invalidate 之后 generation 又被 memcached 淘汰了，以前写入的数据不能再被读到
+        tweet.content = 'new content'
+        tweet.save()
+        cache.set(key, (None, None, Tweet(id=tweet.id, user=alex, content='old content')))
+        cache.delete(generation_key)
+        LocalCache.clear()
+        cached_tweet = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        self.assertEqual(cached_tweet.content, 'new content')
+
+    def test_soft_timeout_lease(self):
+        self.clear_cache()
+        key = 'soft_timeout_key'
+        loads = []
+
+        def load(keys):
+            loads.append(keys)
+            return {key: len(loads)}
+
+        # soft_timeout 是 0，写入之后马上就需要刷新
+        self.assertEqual(MemcachedHelper.get_many_through_cache([key], load, soft_timeout=0), {key: 1})
+        # 拿到 lease 的请求去刷新
+        self.assertEqual(MemcachedHelper.get_many_through_cache([key], load, soft_timeout=0), {key: 2})
+        self.assertFalse(cache.get(MemcachedHelper.get_lease_key(key)))
+
+        # 其他请求正在刷新的时候，继续使用旧的数据
+        self.assertTrue(MemcachedHelper.acquire_lease(key))
+        self.assertEqual(MemcachedHelper.get_many_through_cache([key], load, soft_timeout=0), {key: 2})
+        self.assertEqual(len(loads), 2)
+
+        # 没有过 soft timeout 的数据不需要刷新
+        MemcachedHelper.release_leases([key])
+        self.assertEqual(MemcachedHelper.get_many_through_cache([key], load, soft_timeout=60), {key: 3})
+        self.assertEqual(MemcachedHelper.get_many_through_cache([key], load, soft_timeout=60), {key: 3})
+        self.assertEqual(len(loads), 3)
+
+    @override_settings(MEMCACHED_LEASE_WAIT_INTERVAL=0.05, MEMCACHED_LEASE_WAIT_ATTEMPTS=20)
+    def test_miss_lease(self):
+        self.clear_cache()
+        key = 'miss_lease_key'
+        loads = []
+
+        def load(keys):
+            loads.append(keys)
+            return {key: 'loaded'}
+
+        # 别的请求拿着 lease 在读数据库，等它写回 memcached 之后直接用
+        self.assertTrue(MemcachedHelper.acquire_lease(key))
+        generations = {key: None}
+        MemcachedHelper._ensure_generations(generations)
+        timer = threading.Timer(0.1, MemcachedHelper._set_many, args=({key: 'filled'}, generations))
+        timer.start()
+        self.assertEqual(MemcachedHelper.get_many_through_cache([key], load), {key: 'filled'})
+        timer.join()
+        self.assertEqual(loads, [])
+
+        # 一直等不到的话自己去数据库读
+        cache.delete(key)
+        with override_settings(MEMCACHED_LEASE_WAIT_ATTEMPTS=2):
+            self.assertEqual(MemcachedHelper.get_many_through_cache([key], load), {key: 'loaded'})
+        self.assertEqual(loads, [[key]])
+
+    def test_cache_metrics(self):
+        self.clear_cache()
+        CacheMetrics.reset()
+        tweet = self.create_tweet(self.create_user('metrics_user'))
+
+        # 第一次 miss 并从数据库读取，第二次命中
+        MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id])
+        MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id])
+        metrics = CacheMetrics.get_metrics()[('memcached', 'Tweet')]
+        self.assertEqual(metrics['hits'], 1)
+        self.assertEqual(metrics['misses'], 1)
+        self.assertEqual(metrics['fills'], 1)
+        self.assertGreaterEqual(metrics['fill_seconds'], 0)
+
+        # load 抛出异常记为 error
+        def failed_load(keys):
+            raise ValueError('db is down')
+
+        with self.assertRaises(ValueError):
+            MemcachedHelper.get_many_through_cache(['metrics_key'], failed_load)
+        self.assertEqual(CacheMetrics.get_metrics()[('memcached', 'metrics_key')]['errors'], 1)
+
+        text = CacheMetrics.to_prometheus()
+        self.assertIn('# TYPE cache_hits_total counter', text)
+        self.assertIn('cache_hits_total{cache="memcached",namespace="Tweet"} 1', text)
+        self.assertIn('redis_pool_in_use_connections{pool="counters"} 0', text)
+        self.assertIn('# TYPE local_cache_evictions_total counter', text)
+
+        # 只有 staff 和带着 token 的请求可以访问，本机转发过来的请求也不行
+        response = self.anonymous_client.get('/metrics/cache/', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 403)
+        with override_settings(METRICS_TOKEN='metrics-token'):
+            response = self.anonymous_client.get('/metrics/cache/', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+            response = self.anonymous_client.get('/metrics/cache/', HTTP_AUTHORIZATION='Bearer metrics-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'cache_misses_total{cache="memcached",namespace="Tweet"} 1', response.content)
@@ -1,5 +1,20 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
 def utc_now():
-    return datetime.now().replace(tzinfo=pytz.utc)
\ No newline at end of file
+    return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def datetime_to_microseconds(dt):
+    # 用整数微秒而不是 float 秒，避免 redis score (double) 丢失微秒精度
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=pytz.utc)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def microseconds_to_datetime(microseconds):
+    return EPOCH + timedelta(microseconds=int(microseconds))
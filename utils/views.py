@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from utils.cache_metrics import CacheMetrics
+import hmac
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def is_metrics_allowed(request):
+    # staff 用户或者带着 METRICS_TOKEN 的请求，比如 prometheus server
+    if settings.METRICS_TOKEN:
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if hmac.compare_digest(authorization, 'Bearer {}'.format(settings.METRICS_TOKEN)):
+            return True
+    return request.user.is_staff
+
+
+def cache_metrics_view(request):
+    # prometheus 的 text exposition format
+    if not is_metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(CacheMetrics.to_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)